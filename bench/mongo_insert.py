@@ -0,0 +1,56 @@
+"""Insert throughput of MongoDBDatetimeEventStore with the legacy index set, with the index of setup() ((at, _id))
+and with search=True (plus the multikey (tokens, at, _id), one key per word of the payload).
+
+Usage: python -m bench.mongo_insert --url mongodb://localhost:27017/ [--events 100000] [--batch-size 1000]
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, DESCENDING
+
+from datetime_event_store import MongoDBDatetimeEventStore
+
+# the indexes setup() created before they were trimmed to (at, _id)
+LEGACY_INDEXES = [
+    [("at", DESCENDING), ("_id", DESCENDING)],
+    [("at", ASCENDING)],
+    [("at", DESCENDING)],
+]
+
+
+async def measure(store, events, batch_size):
+    started = time.perf_counter()
+    await store.store_events_many(events, batch_size)
+    return len(events) / (time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="mongodb://localhost:27017/")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    store = MongoDBDatetimeEventStore(args.url, "bench", "events")
+    searchable = MongoDBDatetimeEventStore(args.url, "bench", "events", search=True)
+    now = datetime.now(timezone.utc)
+    events = [(now - timedelta(seconds=random.randint(0, 86400 * 30)), "Event number %d." % i)
+              for i in range(args.events)]
+
+    print(f"{'indexes':>9} {'run':>4} {'events/s':>10}")
+    for name, run_store, extra_indexes in [("legacy", store, LEGACY_INDEXES), ("setup", store, []),
+                                           ("search", searchable, [])]:
+        for run in range(args.runs):
+            await run_store.clear()
+            for index in extra_indexes:
+                await run_store.collection.create_index(index)
+            print(f"{name:>9} {run:>4} {await measure(run_store, events, args.batch_size):>10.0f}")
+    await store.collection.drop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
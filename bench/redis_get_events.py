@@ -0,0 +1,69 @@
+"""Round trips and latency of a RedisDatetimeEventStore.get_events page, per page size.
+
+Usage: python -m bench.redis_get_events --url redis://localhost:6379/0 [--events 20000] [--runs 200]
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+import redis
+
+from datetime_event_store import RedisDatetimeEventStore
+
+
+class CountingConnection(redis.Connection):
+    # every command or pipeline is written to the socket with a single send_packed_command call
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        return super().send_packed_command(command, check_health)
+
+
+def legacy_get_events(store, limit):
+    # pre-batching read path: one HGETALL per id
+    members = store.redis.zrangebylex(store.sorted_key, "-", "+", 0, limit)
+    return {"events": [store.get_event(int(member[19:])) for member in members], "next_cursor": members[-1]}
+
+
+def measure(func, runs):
+    samples = []
+    CountingConnection.round_trips = 0
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    quantiles = statistics.quantiles(samples, n=100)
+    return CountingConnection.round_trips // runs, quantiles[49], quantiles[98]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="redis://localhost:6379/0")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[10, 50, 200, 500])
+    args = parser.parse_args()
+
+    pool = redis.ConnectionPool.from_url(args.url, decode_responses=True, connection_class=CountingConnection)
+    store = RedisDatetimeEventStore(redis.Redis(connection_pool=pool), prefix="bench")
+    store.clear()
+    now = datetime.now(timezone.utc)
+    store.store_events_many(
+        (now - timedelta(seconds=random.randint(0, 86400 * 30)), "Event number %d." % i) for i in range(args.events))
+
+    print(f"{'page size':>10} {'path':>8} {'round trips':>12} {'p50 ms':>8} {'p99 ms':>8}")
+    for page_size in args.page_sizes:
+        for name, func in [
+            ("legacy", lambda: legacy_get_events(store, page_size)),
+            ("batched", lambda: store.get_events(limit=page_size)),
+        ]:
+            round_trips, p50, p99 = measure(func, args.runs)
+            print(f"{page_size:>10} {name:>8} {round_trips:>12} {p50:>8.2f} {p99:>8.2f}")
+    store.clear()
+
+
+if __name__ == "__main__":
+    main()
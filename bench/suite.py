@@ -0,0 +1,254 @@
+"""Benchmark suite: insert throughput, get_event latency, get_events pages (sizes, depths, both orders) and an
+update/delete mix, for each engine and end to end through the FastAPI app ("http-<engine>", in process).
+Results are printed (or written) as JSON, so that runs can be diffed between releases.
+
+Usage: python -m bench.suite [--engines memory columnar sharded redis redis_embedded async_redis mongo http-memory]
+                             [--events 20000] [--runs 200] [--redis-url redis://localhost:6379/0]
+                             [--mongo-url mongodb://localhost:27017/] [--fake] [--output results.json]
+
+--fake runs the Redis and MongoDB engines on fakeredis and mongomock-motor (which must be installed) instead of
+local servers: only useful to check the suite itself, not to compare numbers.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from datetime_event_store import (
+    AsyncRedisDatetimeEventStore,
+    ColumnarDatetimeEventStore,
+    DatetimeEventStore,
+    Event,
+    MongoDBDatetimeEventStore,
+    RedisDatetimeEventStore,
+    ShardedDatetimeEventStore,
+    adapt_async,
+)
+from datetime_event_store.utils import chunked
+
+ENGINES = ["memory", "columnar", "sharded", "redis", "redis_embedded", "async_redis", "mongo", "http-memory"]
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+class HttpStore:
+
+    # The engine API as calls to the FastAPI app, through httpx's in-process ASGI transport,
+    # so that routing, validation and serialization are measured on top of the engine.
+
+    def __init__(self, store):
+
+        import httpx
+
+        os.environ.setdefault("ENGINE", "memory")
+        import main
+
+        main.event_store = store
+        self.store = store
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench")
+
+    async def clear(self):
+        await adapt_async(self.store.clear)
+
+    async def _request(self, method, url, **kwargs):
+        response = await self.client.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    async def store_event(self, at: datetime, data: str):
+        return Event(**await self._request("POST", "/events/", json={"at": at.isoformat(), "data": data}))
+
+    async def store_events_many(self, events):
+        body = [{"at": at.isoformat(), "data": data} for at, data in events]
+        return [Event(**event) for event in await self._request("POST", "/events/bulk", json=body)]
+
+    async def get_event(self, event_id):
+        return Event(**await self._request("GET", f"/events/{event_id}"))
+
+    async def get_events(self, start_date=None, end_date=None, cursor=None, limit=None, desc=False):
+        params = {"order": "desc" if desc else "asc"}
+        for name, value in (("cursor", cursor), ("pageSize", limit)):
+            if value is not None:
+                params[name] = value
+        return await self._request("GET", "/events/", params=params)
+
+    async def update_event(self, event_id, at: datetime, data: str):
+        return Event(**await self._request("PUT", f"/events/{event_id}", json={"at": at.isoformat(), "data": data}))
+
+    async def delete_event(self, event_id):
+        await self._request("DELETE", f"/events/{event_id}")
+
+
+def make_store(name, args):
+
+    if name.startswith("http-"):
+        return HttpStore(make_store(name[len("http-"):], args))
+    if name == "memory":
+        return DatetimeEventStore()
+    if name == "columnar":
+        return ColumnarDatetimeEventStore()
+    if name == "sharded":
+        return ShardedDatetimeEventStore()
+    if name in ("redis", "redis_embedded", "async_redis"):
+        if args.fake:
+            import fakeredis
+
+            client_class = fakeredis.FakeAsyncRedis if name == "async_redis" else fakeredis.FakeRedis
+            client = client_class(decode_responses=True)
+        else:
+            import redis
+            import redis.asyncio
+
+            client_module = redis.asyncio if name == "async_redis" else redis
+            client = client_module.Redis.from_url(args.redis_url, decode_responses=True)
+        store_class = AsyncRedisDatetimeEventStore if name == "async_redis" else RedisDatetimeEventStore
+        return store_class(client, prefix=f"bench_{name}", embedded=name == "redis_embedded")
+    if name == "mongo":
+        store = MongoDBDatetimeEventStore(args.mongo_url, "bench", "events")
+        if args.fake:
+            import mongomock_motor
+
+            # the store builds its own client from the url, the database and every collection taken from it are swapped
+            store.client = mongomock_motor.AsyncMongoMockClient()
+            store.db = store.client["bench"]
+            store.collection = store.db[store.collection_name]
+            store.versions = store.db[f"{store.collection_name}_versions"]
+        return store
+    raise ValueError(f"unknown engine {name}, expected one of {', '.join(ENGINES)} or http-<engine>")
+
+
+def summarize(samples):
+    # latencies in ms
+    quantiles = statistics.quantiles(samples, n=100) if len(samples) > 1 else samples * 99
+    return {
+        "runs": len(samples),
+        "mean_ms": round(statistics.fmean(samples), 4),
+        "p50_ms": round(quantiles[49], 4),
+        "p99_ms": round(quantiles[98], 4),
+        "ops_per_s": round(len(samples) / sum(samples) * 1000, 1),
+    }
+
+
+async def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = await adapt_async(func, *args, **kwargs)
+    return (time.perf_counter() - started) * 1000, result
+
+
+async def bench_pages(store, args):
+    # latency of the page reached after walking `depth` pages, for every page size and order
+    results = {}
+    for desc in (False, True):
+        for page_size in args.page_sizes:
+            for depth in args.depths:
+                cursor = None
+                for _ in range(depth):
+                    cursor = (await adapt_async(store.get_events, None, None, cursor, page_size, desc))["next_cursor"]
+                    if cursor is None:
+                        break
+                key = f"{'desc' if desc else 'asc'}/size={page_size}/depth={depth}"
+                if depth and cursor is None:
+                    results[key] = None  # not enough events
+                    continue
+                samples = [
+                    (await timed(store.get_events, None, None, cursor, page_size, desc))[0] for _ in range(args.runs)
+                ]
+                results[key] = summarize(samples)
+    return results
+
+
+async def bench_engine(store, args):
+
+    rng = random.Random(args.seed)
+    events = [
+        (START + timedelta(seconds=rng.randint(0, 86400 * 30), microseconds=rng.randint(0, 999) * 1000),
+         "Event number %d." % i)
+        for i in range(args.events)
+    ]
+    await adapt_async(store.clear)
+    results = {}
+
+    started = time.perf_counter()
+    created = []
+    for batch in chunked(events, args.batch_size):
+        created += await adapt_async(store.store_events_many, batch)
+    elapsed = time.perf_counter() - started
+    results["insert_many"] = {"events": len(created), "batch_size": args.batch_size,
+                              "events_per_s": round(len(created) / elapsed, 1)}
+    single = [(await timed(store.store_event, at, data))[0] for at, data in events[:args.runs]]
+    results["insert_one"] = summarize(single)
+
+    ids = [event.id for event in created]
+    results["get_event"] = summarize([(await timed(store.get_event, rng.choice(ids)))[0] for _ in range(args.runs)])
+    results["get_events"] = await bench_pages(store, args)
+
+    # updates and deletes of random events, `update_ratio` of them being updates
+    alive = list(ids)
+    samples = {"update": [], "delete": []}
+    for _ in range(min(args.runs, len(alive))):
+        event_id = rng.choice(alive)
+        if rng.random() < args.update_ratio:
+            at = START + timedelta(seconds=rng.randint(0, 86400 * 30))
+            samples["update"].append((await timed(store.update_event, event_id, at, "updated"))[0])
+        else:
+            alive.remove(event_id)
+            samples["delete"].append((await timed(store.delete_event, event_id))[0])
+    results["update_delete_mix"] = {
+        "update_ratio": args.update_ratio,
+        **{op: summarize(op_samples) for op, op_samples in samples.items() if op_samples},
+        "ops_per_s": summarize(samples["update"] + samples["delete"])["ops_per_s"],
+    }
+
+    await adapt_async(store.clear)
+    return results
+
+
+async def run(args):
+
+    report = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            **{name: getattr(args, name) for name in (
+                "events", "runs", "batch_size", "page_sizes", "depths", "update_ratio", "seed", "fake")},
+        },
+        "results": {},
+    }
+    for name in args.engines:
+        print(f"benchmarking {name}", file=sys.stderr)
+        report["results"][name] = await bench_engine(make_store(name, args), args)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines", nargs="+", default=ENGINES)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--runs", type=int, default=200, help="samples per latency measurement")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 10, 50], help="pages walked before measuring")
+    parser.add_argument("--update-ratio", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--redis-url", default="redis://localhost:6379/0")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017/")
+    parser.add_argument("--fake", action="store_true", help="fakeredis and mongomock-motor instead of servers")
+    parser.add_argument("--output", help="JSON file, printed if not set")
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,41 @@
-from .models import CursorPaginatedEvents, Event  # noqa: F401
-from .store import DatetimeEventStore, MongoDBDatetimeEventStore, RedisDatetimeEventStore  # noqa: F401
+from importlib import import_module
+
+from .cache import CachedDatetimeEventStore  # noqa: F401
+from .feed import Broadcaster, ChangeFeed  # noqa: F401
+from .ingest import IngestBuffer  # noqa: F401
+from .models import CursorPaginatedEvents, Event, EventChange, EventRow, EventStats, HistogramBucket  # noqa: F401
+from .registry import create_engine, engine_names, load_engine  # noqa: F401
 from .utils import adapt_async  # noqa: F401
 
+# engines are imported on first use, along with their drivers (see registry)
+_ENGINES = {
+    "DatetimeEventStore": ".memory",
+    "ColumnarDatetimeEventStore": ".columnar",
+    "PersistentDatetimeEventStore": ".persistence",
+    "ShardedDatetimeEventStore": ".sharded",
+    "RedisDatetimeEventStore": ".redis_store",
+    "AsyncRedisDatetimeEventStore": ".redis_store",
+    "MongoDBDatetimeEventStore": ".mongodb_store",
+}
+
+
+def __getattr__(name):
+    if name in _ENGINES:
+        return getattr(import_module(_ENGINES[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted([*globals(), *_ENGINES])
+
 
 def genDatetimeEventStoreFromJson(json_data):
-    return DatetimeEventStore(
-        json_data["id"],
-        [(item[0], item[1]) for item in json_data["ordered_events_meta"]],
-        {int(k): v for k, v in json_data['events_by_id'].items()})
+    # json_data["id"] is the next id to assign, "ordered_events_meta" is rebuilt from the events
+    from dateutil.parser import isoparse
+
+    from .memory import DatetimeEventStore
+
+    store = DatetimeEventStore(json_data["id"])
+    for event_id, event in json_data["events_by_id"].items():
+        store._put(int(event_id), isoparse(event["at"]) if isinstance(event["at"], str) else event["at"], event["data"])
+    return store
@@ -0,0 +1,176 @@
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime
+
+from .utils import adapt_async, convert_to_utc
+
+MISSING = object()
+
+
+class TTLCache:
+
+    # LRU cache whose entries also expire `ttl` seconds after being stored
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return MISSING
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+class CachedDatetimeEventStore:
+
+    # Read-through cache in front of any engine: single events are cached by id and get_events results by
+    # (start, end, cursor, limit, desc, raw, query), along with the time range the result depends on.
+    # Writes only drop the pages whose range covers the `at` they touch (the old and the new one for updates).
+    # A full ascending page depends on [start, at of its last event], a full descending one on
+    # [at of its last event, end], a partial page on the whole [start, end] range.
+    # Other processes write to the same backend without invalidating anything here: with an engine that has
+    # range_version, every result is cached with the version of what it depends on (the whole store for an event,
+    # the range above for a page), and only served while the version is unchanged, so a cached result is never
+    # older than the ETag the API derives from the same versions.
+    # Results are shared between callers and must not be mutated.
+    # Every method is async, whatever the wrapped engine; anything else is delegated to it.
+
+    def __init__(self, store, maxsize=4096, page_maxsize=256, ttl=60.0):
+
+        self.store = store
+        self.events = TTLCache(maxsize, ttl)
+        self.pages = TTLCache(page_maxsize, ttl)
+        # bumped on every write, results read while a write was in flight are not cached
+        self._writes = 0
+        self._versioned = hasattr(store, "range_version")
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def stats(self):
+        return {"events": self.events.stats(), "pages": self.pages.stats()}
+
+    async def clear(self):
+        await adapt_async(self.store.clear)
+        self._writes += 1
+        self.events.clear()
+        self.pages.clear()
+
+    async def _version(self, start_date: datetime = None, end_date: datetime = None):
+
+        return await adapt_async(self.store.range_version, start_date, end_date) if self._versioned else None
+
+    def _cache_event(self, event):
+        # a write can't tell the version its result belongs to, the next read fetches it
+        if self._versioned:
+            self.events.pop(str(event.id))
+        else:
+            self.events.set(str(event.id), (None, event))
+
+    def _invalidate(self, *ats: datetime):
+        ats = sorted(convert_to_utc(at) for at in ats)
+        for key, (_, (lower, upper, _, _)) in list(self.pages.entries.items()):
+            index = bisect_left(ats, lower) if lower else 0
+            if index < len(ats) and (upper is None or ats[index] <= upper):
+                self.pages.pop(key)
+
+    async def get_event(self, event_id):
+        entry = self.events.get(str(event_id))
+        version = await self._version()
+        if entry is not MISSING and entry[0] == version:
+            return entry[1]
+        writes = self._writes
+        event = await adapt_async(self.store.get_event, event_id)
+        if writes == self._writes:
+            self.events.set(str(event_id), (version, event))
+        return event
+
+    async def store_event(self, at: datetime, data: str):
+
+        event = await adapt_async(self.store.store_event, at, data)
+        self._writes += 1
+        self._invalidate(event.at)
+        self._cache_event(event)
+        return event
+
+    async def store_events_many(self, events, **kwargs):
+
+        created = await adapt_async(self.store.store_events_many, events, **kwargs)
+        self._writes += 1
+        self._invalidate(*(event.at for event in created))
+        return created
+
+    async def update_event(self, event_id, at: datetime = None, data: str = None):
+        old_event = await self.get_event(event_id)
+        event = await adapt_async(self.store.update_event, event_id, at=at, data=data)
+        self._writes += 1
+        self._invalidate(old_event.at, event.at)
+        self._cache_event(event)
+        return event
+
+    async def delete_event(self, event_id):
+
+        old_entry = self.events.get(str(event_id))
+        await adapt_async(self.store.delete_event, event_id)
+        self._writes += 1
+        self.events.pop(str(event_id))
+        if old_entry is MISSING:
+            # not worth a round trip to find out its `at`
+            self.pages.clear()
+        else:
+            self._invalidate(old_entry[1].at)
+
+    async def get_events(self, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None,
+                         desc=False, raw=False, query: str = None):
+
+        key = (start_date, end_date, cursor, limit, desc, raw, query)
+        page = self.pages.get(key)
+        if page is not MISSING and await self._version(page[0], page[1]) == page[2]:
+            return page[3]
+
+        writes = self._writes
+        version = await self._version(start_date, end_date)
+        result = await adapt_async(self.store.get_events, start_date, end_date, cursor, limit, desc, raw=raw,
+                                   query=query)
+        if writes == self._writes:
+            lower = convert_to_utc(start_date) if start_date else None
+            upper = convert_to_utc(end_date) if end_date else None
+            if limit and len(result["events"]) == limit:
+                if desc:
+                    lower = result["events"][-1].at
+                else:
+                    upper = result["events"][-1].at
+                if self._versioned:
+                    # the version of the narrower range, unless a write of the whole range may have come first
+                    narrowed = await self._version(lower, upper)
+                    if await self._version(start_date, end_date) != version:
+                        return result
+                    version = narrowed
+            self.pages.set(key, (lower, upper, version, result))
+        return result
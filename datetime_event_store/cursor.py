@@ -0,0 +1,56 @@
+import base64
+import struct
+from datetime import datetime, timezone
+
+from .utils import datetime_to_us
+
+# Page cursors of every engine: the timestamp of the last event of the page as an int64 (microseconds since
+# 0001-01-01, see datetime_to_us), followed by its id, an uint64 or the 12 bytes of a MongoDB ObjectId, in url-safe
+# base64 without padding (22 or 27 characters). A cursor with the timestamp only (11 characters) is a date cursor:
+# the next page starts with the first event at (or, in descending order, before) that instant.
+_TIMESTAMP = struct.Struct(">q")
+_TIMESTAMP_AND_ID = struct.Struct(">qQ")
+# timestamps a datetime can have, the others can't be cursors of any event
+MAX_TIMESTAMP = datetime_to_us(datetime.max.replace(tzinfo=timezone.utc))
+
+
+def pack_cursor(timestamp: int, event_id=None) -> str:
+
+    if event_id is None:
+        packed = _TIMESTAMP.pack(timestamp)
+    elif hasattr(event_id, "binary"):  # an ObjectId, bson is only imported by the MongoDB engine
+        packed = _TIMESTAMP.pack(timestamp) + event_id.binary
+    else:
+        packed = _TIMESTAMP_AND_ID.pack(timestamp, int(event_id))
+    return base64.urlsafe_b64encode(packed).rstrip(b"=").decode()
+
+
+def unpack_cursor(cursor: str):
+    """
+    (timestamp, id) of a cursor, id being None for a date cursor. Raise ValueError if it isn't a cursor, or if its
+    timestamp is out of the range of datetime.
+    """
+    try:
+        packed = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    except (ValueError, TypeError):
+        raise ValueError(f"invalid cursor {cursor!r}")
+    if len(packed) == _TIMESTAMP_AND_ID.size:
+        timestamp, event_id = _TIMESTAMP_AND_ID.unpack(packed)
+    elif len(packed) == _TIMESTAMP.size:
+        timestamp, event_id = _TIMESTAMP.unpack(packed)[0], None
+    elif len(packed) == _TIMESTAMP.size + 12:
+        from bson import ObjectId
+
+        timestamp, event_id = _TIMESTAMP.unpack_from(packed)[0], ObjectId(packed[_TIMESTAMP.size:])
+    else:
+        raise ValueError(f"invalid cursor {cursor!r}")
+    if not 0 <= timestamp <= MAX_TIMESTAMP:
+        raise ValueError(f"invalid cursor {cursor!r}, its date is out of range")
+    return timestamp, event_id
+
+
+def date_cursor(at: datetime) -> str:
+    """
+    Cursor of a page starting at `at`, to jump to a date without walking the pages before it.
+    """
+    return pack_cursor(datetime_to_us(at))
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import uuid
+from collections import deque
+from itertools import count
+
+from .models import EventChange
+
+
+class _Subscriber:
+
+    __slots__ = ("loop", "queue", "maxsize", "overflowed")
+
+    def __init__(self, loop, maxsize):
+
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.maxsize = maxsize
+        self.overflowed = False
+
+
+class ChangeFeed:
+
+    # In-process fan-out of changes: every subscriber has its own queue, fed from whatever thread publishes.
+    # The last `history` changes are kept, so that a subscriber can resume right after the position it last saw.
+    # A subscriber that falls more than `maxsize` changes behind is disconnected, it can resume from its position.
+    # A subscriber resuming from a position that is no longer in the history (or was never in it) may have missed
+    # changes: it first gets a "reset" change, without id, positioned at the last change, to reload what it shows.
+
+    def __init__(self, history=1000, maxsize=1000):
+
+        self.maxsize = maxsize
+        self.history = deque(maxlen=history)
+        self.subscribers = set()
+        # positions of a previous process are never found in the history
+        self._epoch = uuid.uuid4().hex[:8]
+        self._positions = count(1)
+        # position of a reset before anything was published, and whether the history has forgotten changes since
+        self._origin = f"{self._epoch}-0"
+        self._evicted = False
+        self._lock = threading.Lock()
+
+    def publish(self, op: str, event_id, event=None, position: str = None):
+
+        with self._lock:
+            change = EventChange(position=position or f"{self._epoch}-{next(self._positions)}", op=op, id=event_id,
+                                 event=event)
+            self._evicted = self._evicted or len(self.history) == self.history.maxlen
+            self.history.append(change)
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.loop.call_soon_threadsafe(self._deliver, subscriber, change)
+        return change
+
+    def _deliver(self, subscriber: _Subscriber, change: EventChange):
+
+        if subscriber.overflowed:
+            return
+        if subscriber.maxsize and subscriber.queue.qsize() >= subscriber.maxsize:
+            subscriber.overflowed = True
+            change = None
+        subscriber.queue.put_nowait(change)
+
+    def _since(self, position: str = None):
+        # changes published after `position`, None if it is unknown or too old
+        if position is None:
+            return []
+        changes = list(self.history)
+        if position == self._origin and not self._evicted:
+            return changes
+        for index, change in enumerate(changes):
+            if change.position == position:
+                return changes[index + 1:]
+        return None
+
+    def _reset(self):
+
+        return EventChange(position=self.history[-1].position if self.history else self._origin, op="reset", id=None)
+
+    async def subscribe(self, start: str = None, heartbeat: float = None, maxsize: int = None):
+        """
+        Yield the changes published after `start` (a position of a previous change, if still in the history, else
+        a reset first) and then every new one, until the subscriber falls more than `maxsize` changes behind (the
+        feed's by default, 0 for no limit). With `heartbeat`, None is yielded after every `heartbeat` seconds
+        without any change.
+        """
+        subscriber = _Subscriber(asyncio.get_running_loop(), self.maxsize if maxsize is None else maxsize)
+        with self._lock:
+            backlog = self._since(start)
+            if backlog is None:
+                backlog = [self._reset()]
+            self.subscribers.add(subscriber)
+        try:
+            for change in backlog:
+                yield change
+            while True:
+                try:
+                    change = await asyncio.wait_for(subscriber.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if change is None:
+                    return
+                yield change
+        finally:
+            with self._lock:
+                self.subscribers.discard(subscriber)
+
+
+class Broadcaster:
+
+    # Shares a single subscription to the engine between every local subscriber: the first one starts a task that
+    # reads store.subscribe() into a ChangeFeed, positions are the engine's own. The subscription to an in-process
+    # engine (one with a `changes` feed) has no queue limit, so that a burst isn't dropped before it is read.
+    # When the engine subscription fails or ends, it is reopened after `retry_delay` seconds from the last position,
+    # then from the current one if that fails too, after publishing a reset: the changes in between are lost.
+
+    def __init__(self, store, history=1000, maxsize=1000, retry_delay=1.0):
+
+        self.store = store
+        self.feed = ChangeFeed(history, maxsize)
+        self.retry_delay = retry_delay
+        self._task = None
+
+    def subscribe(self, start: str = None, heartbeat: float = None):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._forward())
+        return self.feed.subscribe(start, heartbeat)
+
+    def _subscribe_store(self, start: str = None):
+
+        if hasattr(self.store, "changes"):
+            return self.store.subscribe(start, maxsize=0)
+        return self.store.subscribe(start)
+
+    async def _forward(self):
+
+        position = None
+        failures = 0
+        while True:
+            if position is not None and failures >= 2:
+                self.feed.publish("reset", None)
+                position = None
+            try:
+                async for change in self._subscribe_store(position):
+                    position = change.position
+                    failures = 0
+                    self.feed.publish(change.op, change.id, change.event, change.position)
+            except Exception:
+                failures += 1
+            await asyncio.sleep(self.retry_delay)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+
+from .models import Event
+from .utils import adapt_async, convert_to_utc
+
+logger = logging.getLogger(__name__)
+
+
+class IngestBuffer:
+
+    # Write-behind stage in front of any engine. store_event takes an id reserved in advance (by blocks of
+    # `batch_size`, see reserve_ids), queues the event and returns it at once. A single task writes the queued
+    # events with store_events_many, `batch_size` at a time, or whatever arrived within `max_delay` seconds of the
+    # first one. When `maxsize` events are waiting, store_event waits for room. close() writes what is left.
+    # An event is only readable once written, and is lost if the process dies before. A batch that fails is
+    # retried `retries` times, `retry_delay` seconds apart, then dropped (and logged).
+
+    def __init__(self, store, batch_size=500, max_delay=0.005, maxsize=10000, retries=3, retry_delay=0.5):
+
+        self.store = store
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self._ids = deque()
+        self._ids_lock = asyncio.Lock()
+        self._batch_ready = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _reserve_id(self):
+
+        while not self._ids:
+            async with self._ids_lock:
+                if not self._ids:
+                    self._ids.extend(await adapt_async(self.store.reserve_ids, self.batch_size))
+        return self._ids.popleft()
+
+    async def store_event(self, at: datetime, data: str):
+
+        self.start()
+        event_id = await self._reserve_id()
+        at = convert_to_utc(at, truncate_ms=getattr(self.store, "truncate_microseconds", False))
+        await self.queue.put((event_id, at, data))
+        if self.queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+        return Event(id=event_id, at=at, data=data)
+
+    async def _run(self):
+
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.qsize() < self.batch_size - 1:
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self._write(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    async def _write(self, batch):
+
+        ids = [event_id for event_id, _, _ in batch]
+        events = [(at, data) for _, at, data in batch]
+        for attempt in range(self.retries + 1):
+            try:
+                await adapt_async(self.store.store_events_many, events, ids=ids)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception("dropped a batch of %d events", len(batch))
+                else:
+                    logger.warning("failed to write a batch of %d events, retrying", len(batch), exc_info=True)
+                    await asyncio.sleep(self.retry_delay)
+        self.dropped += len(batch)
+
+    async def flush(self):
+        """Wait until every queued event is written (or dropped)."""
+        if self._task is not None:
+            await self.queue.join()
+
+    async def close(self):
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,235 @@
+from datetime import datetime
+from itertools import count, islice
+
+from sortedcontainers import SortedDict, SortedList
+
+from .cursor import pack_cursor, unpack_cursor
+from .feed import ChangeFeed
+from .models import DatetimeEventScore, Event, EventRow
+from .utils import convert_to_utc, datetime_to_us, iter_events_by_cursor, time_buckets, tokenize, us_to_datetime
+from .versions import VersionCounters
+
+
+class DatetimeEventStore:
+
+    # With `search`, `tokens` is the inverted index of the payloads: the (at, id) keys of the events holding each
+    # token (see tokenize), in order, so that get_events(query=...) reads the keys of its rarest token only. It
+    # costs more memory than the events and slows writes down, so by default a query scans the payloads of the range.
+
+    def __init__(self, initial_id=1, search=False):
+
+        self._id_gen = count(start=initial_id)
+        self.sorted_store = SortedDict()
+        self.events_by_id = {}
+        self.search = search
+        self.tokens = {}
+        self.versions = VersionCounters()
+        # created by the first subscriber, writes don't publish anything before
+        self.changes = None
+
+    def clear(self):
+        self.sorted_store.clear()
+        self.events_by_id.clear()
+        self.tokens.clear()
+        self.versions.clear()
+        self._id_gen = count(start=1)  # reset IDs
+
+    def gen_new_id(self):
+
+        return next(self._id_gen)
+
+    def compute_event_score(self, event_id):
+
+        return self.events_by_id[event_id]["at"], event_id
+
+    def get_event(self, event_id: int, factory=Event):
+        event_id = int(event_id)  # the API passes ids as strings
+        event = self.events_by_id[event_id]
+        return factory(id=event_id, at=event["at"], data=event["data"])
+
+    def _put(self, event_id: int, at: datetime, data: str):
+        # the write isn't counted in the versions, see _count_writes
+        at = convert_to_utc(at)
+        score = DatetimeEventScore(at, event_id)
+        self.sorted_store[score] = event_id
+        self.events_by_id[event_id] = {"at": at, "data": data}
+        self._index_tokens(score, data)
+
+    def _index_tokens(self, score, data: str):
+
+        if not self.search:
+            return
+        for token in tokenize(data):
+            self.tokens.setdefault(token, SortedList()).add(score)
+
+    def _unindex_tokens(self, score, data: str):
+
+        if not self.search:
+            return
+        for token in tokenize(data):
+            keys = self.tokens[token]
+            keys.remove(score)
+            if not keys:
+                del self.tokens[token]
+
+    def _publish(self, op: str, event_id, event=None):
+
+        if self.changes is not None:
+            self.changes.publish(op, event_id, event)
+
+    def subscribe(self, start: str = None, maxsize: int = None):
+        if self.changes is None:
+            self.changes = ChangeFeed()
+        return self.changes.subscribe(start, maxsize=maxsize)
+
+    def reserve_ids(self, n: int):
+
+        return [self.gen_new_id() for _ in range(n)]
+
+    def _count_writes(self, *ats: datetime):
+
+        self.versions.bump(*ats)
+
+    def _store(self, event_id: int, at: datetime, data: str):
+        # counted in the versions by the caller, once per batch
+        self._put(event_id, at, data)
+        event = self.get_event(event_id)
+        self._publish("store", event_id, event)
+        return event
+
+    def store_event(self, at: datetime, data: str):
+
+        event = self._store(self.gen_new_id(), at, data)
+        self._count_writes(event.at)
+        return event
+
+    def store_events_many(self, events, ids=None):
+        # `ids` come from reserve_ids, one per event
+        if ids is None:
+            created = [self._store(self.gen_new_id(), at, data) for at, data in events]
+        else:
+            created = [self._store(event_id, at, data) for event_id, (at, data) in zip(ids, events)]
+        self._count_writes(*(event.at for event in created))
+        return created
+
+    def update_event(self, event_id: int, at: datetime = None, data: str = None):
+        event_id = int(event_id)
+        old_score = self.compute_event_score(event_id)
+        self._unindex_tokens(old_score, self.events_by_id[event_id]["data"])
+        self.events_by_id[event_id].update({
+            **({} if data is None else {"data": data}),
+            **({} if at is None else {"at": convert_to_utc(at)})
+        })
+        new_score = self.compute_event_score(event_id)
+        if old_score != new_score:
+            del self.sorted_store[old_score]
+            self.sorted_store[new_score] = event_id
+        self._index_tokens(new_score, self.events_by_id[event_id]["data"])
+        self.versions.bump(old_score[0], new_score[0])
+        event = self.get_event(event_id)
+        self._publish("update", event_id, event)
+        return event
+
+    def delete_event(self, event_id):
+
+        event_id = int(event_id)
+        score = self.compute_event_score(event_id)
+        del self.sorted_store[score]
+        self._unindex_tokens(score, self.events_by_id[event_id]["data"])
+        del self.events_by_id[event_id]
+        self.versions.bump(score[0])
+        self._publish("delete", event_id)
+
+    @staticmethod
+    def encode_cursor(score) -> str:
+        return pack_cursor(datetime_to_us(score[0]), score[1])
+
+    @staticmethod
+    def decode_cursor(cursor: str, desc=False):
+
+        timestamp, event_id = unpack_cursor(cursor)
+        if event_id is None:
+            # date cursor, the events at that instant are after it
+            event_id = float('inf') if desc else float('-inf')
+        return DatetimeEventScore(us_to_datetime(timestamp), event_id)
+
+    def iter_events(self, start_date: datetime = None, end_date: datetime = None, desc=False, batch_size=1000,
+                    raw=False):
+
+        return iter_events_by_cursor(self.get_events, start_date, end_date, desc, batch_size, raw)
+
+    def _bounds(self, start_date: datetime = None, end_date: datetime = None):
+        # positions of the first event of the range and after the last one
+        lo = self.sorted_store.bisect_left(DatetimeEventScore(convert_to_utc(start_date), 0)) if start_date else 0
+        hi = self.sorted_store.bisect_right(
+            DatetimeEventScore(convert_to_utc(end_date), float('inf'))) if end_date else len(self.sorted_store)
+        return lo, hi
+
+    def count_events(self, start_date: datetime = None, end_date: datetime = None):
+
+        lo, hi = self._bounds(start_date, end_date)
+        return hi - lo
+
+    def seek_cursor(self, start_date: datetime = None, end_date: datetime = None, offset=0, desc=False):
+        """
+        Cursor of the page starting `offset` events into the range (None for the first page), found by position
+        in O(log n).
+        """
+        lo, hi = self._bounds(start_date, end_date)
+        if offset <= 0 or lo >= hi:
+            return None
+        index = max(hi - offset, lo) if desc else min(lo + offset, hi) - 1
+        return self.encode_cursor(self.sorted_store.keys()[index])
+
+    def range_version(self, start_date: datetime = None, end_date: datetime = None):
+        """
+        Opaque version of the events between start_date and end_date, which changes whenever one of them is stored,
+        updated or deleted, read from per day counters.
+        """
+        return self.versions.version(start_date, end_date)
+
+    def histogram(self, start_date: datetime, end_date: datetime, bucket="hour"):
+        # two bisections per bucket, empty buckets are left out
+        return [
+            {"at": at, "count": count} for at, lower, upper in time_buckets(start_date, end_date, bucket)
+            if (count := self.count_events(lower, upper))
+        ]
+
+    def _scores(self, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None, desc=False,
+                query: str = None):
+        # (at, id) of the events of a page, in order. With a query, the keys of its rarest token are read and
+        # kept if every other token holds them too. Without the index, the payloads of the range are.
+        keys, others = self.sorted_store, []
+        tokens = tokenize(query) if query else None
+        if tokens and self.search:
+            keys, *others = sorted((self.tokens.get(token, ()) for token in tokens), key=len)
+            if not keys:
+                return []
+        start = DatetimeEventScore(convert_to_utc(start_date), 0) if start_date else None
+        end = DatetimeEventScore(convert_to_utc(end_date), float('inf')) if end_date else None
+
+        if cursor:
+            if desc:
+                end = self.decode_cursor(cursor, desc)
+            else:
+                start = self.decode_cursor(cursor, desc)
+
+        scores = keys.irange(start, end, inclusive=((not cursor) or desc, not (cursor and desc)), reverse=desc)
+        if others:
+            scores = (score for score in scores if all(score in other for other in others))
+        elif tokens and not self.search:
+            scores = (score for score in scores if tokens <= tokenize(self.events_by_id[score[1]]["data"]))
+        return list(islice(scores, limit))
+
+    def get_events(self, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None, desc=False,
+                   raw=False, query: str = None):
+
+        factory = EventRow if raw else Event
+        raw_events = self._scores(start_date, end_date, cursor, limit, desc, query)
+        if limit:
+            return {
+                "events": [self.get_event(store_event[1], factory) for store_event in raw_events],
+                "next_cursor": self.encode_cursor(raw_events[-1]) if len(raw_events) == limit else None
+            }
+
+        return [self.get_event(store_event[1], factory) for store_event in raw_events]
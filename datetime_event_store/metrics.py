@@ -0,0 +1,206 @@
+import contextvars
+import cProfile
+import io
+import logging
+import pstats
+import random
+import time
+from bisect import bisect_left
+from datetime import datetime
+from importlib import import_module
+
+from .utils import adapt_async
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# round trips of the operation running in the current context, see count_round_trip
+_round_trips = contextvars.ContextVar("round_trips", default=None)
+
+
+def count_round_trip():
+    counter = _round_trips.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+# the round trip counters of the drivers live with their engines, which import the drivers
+_DRIVER_COUNTERS = {
+    "CountingConnection": ".redis_store",
+    "AsyncCountingConnection": ".redis_store",
+    "RoundTripListener": ".mongodb_store",
+}
+
+
+def __getattr__(name):
+    if name in _DRIVER_COUNTERS:
+        return getattr(import_module(_DRIVER_COUNTERS[name], __package__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _payload_bytes(data: str):
+
+    return len(data) if data.isascii() else len(data.encode())
+
+
+class OperationStats:
+
+    __slots__ = ("buckets", "count", "seconds", "errors", "round_trips", "rows", "payload_bytes")
+
+    def __init__(self, size):
+
+        self.buckets = [0] * (size + 1)  # the last one is +Inf
+        self.count = 0
+        self.seconds = 0.0
+        self.errors = 0
+        self.round_trips = 0
+        self.rows = 0
+        self.payload_bytes = 0
+
+
+class Metrics:
+
+    # Per engine and operation: a latency histogram, errors, backend round trips, rows and payload bytes,
+    # rendered in the Prometheus text format.
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.bounds = buckets
+        self.operations = {}
+
+    def observe(self, engine: str, operation: str, seconds: float, rows=0, payload_bytes=0, round_trips=0,
+                error=False):
+
+        stats = self.operations.get((engine, operation))
+        if stats is None:
+            stats = self.operations[(engine, operation)] = OperationStats(len(self.bounds))
+        stats.buckets[bisect_left(self.bounds, seconds)] += 1
+        stats.count += 1
+        stats.seconds += seconds
+        stats.errors += error
+        stats.round_trips += round_trips
+        stats.rows += rows
+        stats.payload_bytes += payload_bytes
+
+    def render(self):
+        lines = [
+            "# HELP event_store_operation_seconds Latency of the event store operations.",
+            "# TYPE event_store_operation_seconds histogram",
+        ]
+        for (engine, operation), stats in sorted(self.operations.items()):
+            labels = f'engine="{engine}",operation="{operation}"'
+            cumulative = 0
+            for bound, count in zip((*self.bounds, "+Inf"), stats.buckets):
+                cumulative += count
+                lines.append(f'event_store_operation_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"event_store_operation_seconds_sum{{{labels}}} {stats.seconds}")
+            lines.append(f"event_store_operation_seconds_count{{{labels}}} {stats.count}")
+        for name, attribute, description in (
+            ("errors", "errors", "Operations that raised."),
+            ("round_trips", "round_trips", "Round trips to the backend."),
+            ("rows", "rows", "Events returned or written."),
+            ("payload_bytes", "payload_bytes", "Utf-8 bytes of the payloads returned or written."),
+        ):
+            lines += [f"# HELP event_store_{name}_total {description}", f"# TYPE event_store_{name}_total counter"]
+            lines += [
+                f'event_store_{name}_total{{engine="{engine}",operation="{operation}"}} {getattr(stats, attribute)}'
+                for (engine, operation), stats in sorted(self.operations.items())
+            ]
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedDatetimeEventStore:
+
+    # Records every store operation of the wrapped engine in `metrics`, under the `engine` label (its class name by
+    # default). Round trips are counted by the connections of the engine's client: CountingConnection or
+    # AsyncCountingConnection as connection_class of a Redis pool, RoundTripListener in the event_listeners of
+    # a MongoDB client (count_round_trips=True of RedisDatetimeEventStore.from_url and MongoDBDatetimeEventStore
+    # sets them up). Every method is async, whatever the wrapped engine; anything else is delegated to it.
+
+    def __init__(self, store, metrics: Metrics, engine: str = None):
+
+        self.store = store
+        self.metrics = metrics
+        self.engine = engine or type(store).__name__
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    async def _call(self, operation, rows_of, func, *args, **kwargs):
+
+        counter = [0]
+        token = _round_trips.set(counter)
+        started = time.perf_counter()
+        result = None
+        error = True
+        try:
+            result = await adapt_async(func, *args, **kwargs)
+            error = False
+            return result
+        finally:
+            seconds = time.perf_counter() - started
+            _round_trips.reset(token)
+            rows = [] if error else rows_of(result)
+            self.metrics.observe(self.engine, operation, seconds, len(rows),
+                                 sum(_payload_bytes(row.data) for row in rows), counter[0], error)
+
+    async def store_event(self, at: datetime, data: str):
+        return await self._call("store_event", lambda event: [event], self.store.store_event, at, data)
+
+    async def store_events_many(self, events, **kwargs):
+        return await self._call("store_events_many", list, self.store.store_events_many, events, **kwargs)
+
+    async def get_event(self, event_id):
+        return await self._call("get_event", lambda event: [event], self.store.get_event, event_id)
+
+    async def update_event(self, event_id, at: datetime = None, data: str = None):
+        return await self._call("update_event", lambda event: [event], self.store.update_event, event_id, at=at,
+                                data=data)
+
+    async def delete_event(self, event_id):
+        return await self._call("delete_event", lambda _: [], self.store.delete_event, event_id)
+
+    async def get_events(self, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None,
+                         desc=False, raw=False, query: str = None):
+
+        return await self._call("get_events", lambda page: page["events"] if limit else page, self.store.get_events,
+                                start_date, end_date, cursor, limit, desc, raw=raw, query=query)
+
+    async def range_version(self, start_date: datetime = None, end_date: datetime = None):
+        return await self._call("range_version", lambda _: [], self.store.range_version, start_date, end_date)
+
+
+class SlowRequestProfiler:
+
+    # HTTP middleware profiling a `sample_rate` share of the requests with cProfile, one at a time, and logging the
+    # `top` functions by cumulative time of those that took longer than `threshold` seconds.
+    # The profile covers whatever ran on the event loop meanwhile, not only the request itself.
+
+    def __init__(self, threshold: float, sample_rate: float = 0.01, top: int = 30):
+
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.top = top
+        self._profiling = False
+
+    async def __call__(self, request, call_next):
+        if self._profiling or random.random() >= self.sample_rate:
+            return await call_next(request)
+
+        self._profiling = True
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            return await call_next(request)
+        finally:
+            profile.disable()
+            self._profiling = False
+            seconds = time.perf_counter() - started
+            if seconds >= self.threshold:
+                output = io.StringIO()
+                pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(self.top)
+                logger.warning("slow request %s %s took %.3fs\n%s", request.method, request.url.path, seconds,
+                               output.getvalue())
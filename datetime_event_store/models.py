@@ -1,4 +1,5 @@
 from collections import namedtuple
+from dataclasses import dataclass
 from datetime import datetime
 from typing import List, Optional, Union
 
@@ -13,6 +14,34 @@ class Event(BaseModel):
     data: str
 
 
+@dataclass
+class EventRow:
+    # lightweight, unvalidated event returned by get_events(raw=True), orjson serializes it natively
+    __slots__ = ("id", "at", "data")
+    id: Union[str, int]
+    at: datetime
+    data: str
+
+
+class EventChange(BaseModel):
+    # op is "store", "update" or "delete", the event is left out of deletes; "reset" (without id nor event) when
+    # changes may have been missed, the subscriber reloads what it shows
+    position: str
+    op: str
+    id: Optional[Union[str, int]]
+    event: Optional[Event] = None
+
+
 class CursorPaginatedEvents(BaseModel):
     events: List[Event]
     next_cursor: Optional[str]
+
+
+class HistogramBucket(BaseModel):
+    at: datetime
+    count: int
+
+
+class EventStats(BaseModel):
+    count: int
+    buckets: Optional[List[HistogramBucket]] = None
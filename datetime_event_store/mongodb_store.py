@@ -0,0 +1,454 @@
+import asyncio
+import re
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne, monitoring
+
+from .cursor import pack_cursor, unpack_cursor
+from .metrics import count_round_trip
+from .models import Event, EventChange, EventRow
+from .utils import (
+    chunked,
+    convert_to_utc,
+    datetime_to_us,
+    iter_events_by_cursor,
+    time_buckets,
+    tokenize,
+    us_to_datetime,
+    utc_day,
+)
+
+
+class RoundTripListener(monitoring.CommandListener):
+    # motor runs pymongo in threads with a copy of the caller's context, so the commands are counted for it
+
+    def started(self, event):
+        count_round_trip()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# redundant with the (at, _id) index, dropped by setup()
+MONGO_LEGACY_INDEXES = ("at_-1__id_-1", "at_1", "at_-1")
+MONGO_TOKENS_INDEX = "tokens_1_at_1__id_1"
+# every field but the ones Event is built from is left on the server
+EVENT_PROJECTION = {"at": True, "data": True}
+
+
+class MongoDBDatetimeEventStore:
+
+    # Note: MongoDB only supports datetime precision up to milliseconds.
+    # Any microseconds in the datetime will be truncated or rounded when stored.
+    # It's recommended to normalize timestamps to milliseconds before saving,
+    # to avoid subtle inconsistencies.
+    # With partitioned=True events are stored in one collection per UTC month, "<collection_name>_YYYYMM",
+    # so that a query only reads the months it overlaps and old months can be dropped as a whole.
+    # Ids don't tell the month of an event, lookups by id query every partition in parallel.
+    # With search=True every document also holds the words of its payload in a "tokens" array (see tokenize),
+    # indexed with (tokens, at, _id), so that get_events(query=...) scans the (at, _id) range of one of its tokens.
+    # Without it (the default) writes only maintain the (at, _id) index, queries are refused, and the tokens of the
+    # documents updated since are unset so that turning it back on indexes them again.
+    # Writes are counted per UTC day in the "<collection_name>_versions" collection, {_id: day, count}, after the
+    # writes they count, for range_version; its "epoch" document is renewed by clear.
+    # Any other keyword argument is passed to the client (pool sizes, event_listeners...), count_round_trips adds
+    # a RoundTripListener for the metrics.
+    truncate_microseconds = True
+
+    def __init__(self, mongo_url: str, db_name: str, collection_name: str = "events", partitioned=False,
+                 count_round_trips=False, search=False, **client_kwargs):
+
+        if count_round_trips:
+            client_kwargs["event_listeners"] = [*client_kwargs.get("event_listeners", ()), RoundTripListener()]
+        self.client = AsyncIOMotorClient(mongo_url, **client_kwargs)
+        self.db = self.client[db_name]
+        self.collection_name = collection_name
+        self.collection = self.db[collection_name]
+        self.versions = self.db[f"{collection_name}_versions"]
+        self.partitioned = partitioned
+        self.search = search
+        # partitions whose indexes were created by this process
+        self._indexed = set()
+
+    async def clear(self):
+
+        if self.partitioned:
+            for collection in await self._collections():
+                await collection.drop()
+        await self.collection.drop()
+        await self.versions.drop()
+        self._indexed.clear()
+        await self.setup()
+
+    async def _create_indexes(self, collection):
+        # scanned forward or backward, they serve the range queries and the sort in both orders
+        await collection.create_index([("at", ASCENDING), ("_id", ASCENDING)])
+        if self.search:
+            await collection.create_index([("tokens", ASCENDING), ("at", ASCENDING), ("_id", ASCENDING)])
+
+    @staticmethod
+    async def _index_tokens(collection, batch_size=1000):
+        # tokens of the documents written before they were indexed
+        updates = []
+        async for doc in collection.find({"tokens": {"$exists": False}}, {"data": True}):
+            updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"tokens": sorted(tokenize(doc["data"]))}}))
+            if len(updates) == batch_size:
+                await collection.bulk_write(updates, ordered=False)
+                updates = []
+        if updates:
+            await collection.bulk_write(updates, ordered=False)
+
+    async def setup(self):
+
+        for collection in await self._collections():
+            await self._create_indexes(collection)
+            if self.search:
+                await self._index_tokens(collection)
+            indexes = await collection.index_information()
+            for name in MONGO_LEGACY_INDEXES + (() if self.search else (MONGO_TOKENS_INDEX,)):
+                if name in indexes:
+                    await collection.drop_index(name)
+            self._indexed.add(collection.name)
+
+    def _partitions_pattern(self):
+
+        return f"^{re.escape(self.collection_name)}_[0-9]{{6}}$"
+
+    def _partition_name(self, at: datetime):
+
+        return f"{self.collection_name}_{at.year:04d}{at.month:02d}" if self.partitioned else self.collection_name
+
+    async def _partition(self, at: datetime):
+        # collection of the month of `at`, indexed the first time this process writes to it
+        name = self._partition_name(at)
+        if name not in self._indexed:
+            await self._create_indexes(self.db[name])
+            self._indexed.add(name)
+        return self.db[name]
+
+    async def _collections(self, start_date: datetime = None, end_date: datetime = None, desc=False):
+        # collections a query reads, in the order it reads them
+        if not self.partitioned:
+            return [self.collection]
+        names = sorted(await self.db.list_collection_names(filter={"name": {"$regex": self._partitions_pattern()}}))
+        lower = self._partition_name(convert_to_utc(start_date)) if start_date else None
+        upper = self._partition_name(convert_to_utc(end_date)) if end_date else None
+        names = [name for name in names if (lower is None or name >= lower) and (upper is None or name <= upper)]
+        return [self.db[name] for name in (reversed(names) if desc else names)]
+
+    async def _find(self, event_id: str):
+        # (collection, document) of an event, or (None, None)
+        oid = ObjectId(event_id)
+        collections = await self._collections()
+        docs = await asyncio.gather(*(collection.find_one({"_id": oid}) for collection in collections))
+        return next(((collection, doc) for collection, doc in zip(collections, docs) if doc), (None, None))
+
+    async def _bump_versions(self, *ats: datetime):
+        by_day = {}
+        for at in ats:
+            by_day[utc_day(at)] = by_day.get(utc_day(at), 0) + 1
+        # mostly a single day, concurrently otherwise
+        await asyncio.gather(*(
+            self.versions.update_one({"_id": day}, {"$inc": {"count": writes}}, upsert=True)
+            for day, writes in by_day.items()
+        ))
+
+    def _tokens(self, data: str):
+        # the "tokens" field of a document
+        return {"tokens": sorted(tokenize(data))} if self.search else {}
+
+    async def store_event(self, at: datetime, data: str):
+        event = {"at": convert_to_utc(at, truncate_ms=True), "data": data}
+        doc = {**event, **self._tokens(data)}
+        result = await (await self._partition(event["at"])).insert_one(doc)
+        await self._bump_versions(event["at"])
+        return Event(**{**event, "id": str(result.inserted_id)})
+
+    @staticmethod
+    def reserve_ids(n: int):
+        # ObjectIds are made client side, no round trip
+        return [str(ObjectId()) for _ in range(n)]
+
+    async def store_events_many(self, events, batch_size=1000, ids=None):
+        created = []
+        ids = iter(ids) if ids is not None else None
+        for batch in chunked(events, batch_size):
+            docs = [{"at": convert_to_utc(at, truncate_ms=True), "data": data, **self._tokens(data)}
+                    for at, data in batch]
+            if ids is not None:
+                for doc, event_id in zip(docs, ids):
+                    doc["_id"] = ObjectId(event_id)
+            by_partition = {}
+            for doc in docs:
+                by_partition.setdefault(self._partition_name(doc["at"]), []).append(doc)
+            inserts = []
+            for partition_docs in by_partition.values():
+                collection = await self._partition(partition_docs[0]["at"])
+                inserts.append(collection.insert_many(partition_docs, ordered=False))  # _id is set client side
+            await asyncio.gather(*inserts)
+            await self._bump_versions(*(doc["at"] for doc in docs))
+            created.extend(self.doc_to_event(doc) for doc in docs)
+        return created
+
+    async def get_event(self, event_id: str):
+        _, doc = await self._find(event_id)
+        if doc is None:
+            raise KeyError(event_id)
+        return self.doc_to_event(doc)
+
+    async def update_event(self, event_id: str, at: Optional[datetime] = None, data: Optional[str] = None):
+        changes = {
+            **({} if data is None else {"data": data, **self._tokens(data)}),
+            **({} if at is None else {"at": convert_to_utc(at, truncate_ms=True)})
+        }
+        update = {"$set": changes}
+        if data is not None and not self.search:
+            update["$unset"] = {"tokens": True}
+        if self.partitioned and at is not None:
+            collection, doc = await self._find(event_id)
+            partition = await self._partition(changes["at"])
+            if doc is not None and collection.name != partition.name:
+                # moved to another month: written to its new partition before being removed from the old one
+                old_at = doc["at"]
+                doc.update(changes)
+                for field in update.get("$unset", ()):
+                    doc.pop(field, None)
+                await partition.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+                await collection.delete_one({"_id": doc["_id"]})
+                await self._bump_versions(old_at, doc["at"])
+                return self.doc_to_event(doc)
+        # the old documents tell the day the event leaves
+        old_docs = [doc for doc in await asyncio.gather(*(
+            collection.find_one_and_update({"_id": ObjectId(event_id)}, update, {"at": True})
+            for collection in await self._collections()
+        )) if doc]
+        if not old_docs:
+            raise KeyError(event_id)
+        event = await self.get_event(event_id)
+        await self._bump_versions(*(doc["at"] for doc in old_docs), event.at)
+        return event
+
+    async def delete_event(self, event_id: str):
+        old_docs = await asyncio.gather(*(
+            collection.find_one_and_delete({"_id": ObjectId(event_id)}, {"at": True})
+            for collection in await self._collections()
+        ))
+        await self._bump_versions(*(doc["at"] for doc in old_docs if doc))
+
+    async def drop_partitions(self, before: datetime):
+        """
+        Retention of a partitioned store: drop every monthly partition that ends before `before`.
+        Returns the number of dropped partitions.
+        """
+        first_kept = self._partition_name(convert_to_utc(before))
+        expired = [collection for collection in await self._collections() if collection.name < first_kept]
+        for collection in expired:
+            await collection.drop()
+            self._indexed.discard(collection.name)
+        if expired:
+            # every day before the first kept month, whether it had events or not
+            first_kept_day = utc_day(datetime.strptime(first_kept[-6:], "%Y%m").replace(tzinfo=timezone.utc))
+            await self.versions.update_many({"_id": {"$lt": first_kept_day}}, {"$inc": {"count": 1}})
+        return len(expired)
+
+    async def range_version(self, start_date: datetime = None, end_date: datetime = None):
+        """
+        Opaque version of the events between start_date and end_date, which changes whenever one of them is stored,
+        updated or deleted: the epoch and the sum of the per day counters of the range.
+        """
+        days = {"$type": "number"}
+        if start_date:
+            days["$gte"] = utc_day(start_date)
+        if end_date:
+            days["$lte"] = utc_day(end_date)
+        epoch, totals = await asyncio.gather(
+            self.versions.find_one({"_id": "epoch"}),
+            self.versions.aggregate([
+                {"$match": {"_id": days}}, {"$group": {"_id": None, "total": {"$sum": "$count"}}},
+            ]).to_list(None),
+        )
+        if epoch is None:
+            # only written by the first read after a clear, concurrent ones agree on the same document
+            epoch = await self.versions.find_one_and_update(
+                {"_id": "epoch"}, {"$setOnInsert": {"token": uuid.uuid4().hex[:16]}}, upsert=True,
+                return_document=ReturnDocument.AFTER)
+        return f"{epoch['token']}-{totals[0]['total'] if totals else 0}"
+
+    @staticmethod
+    def doc_to_event(doc, factory=Event):
+        return factory(id=str(doc["_id"]), at=doc["at"].replace(tzinfo=timezone.utc), data=doc["data"])
+
+    async def _to_change(self, change):
+        # None for the changes that don't concern a single event (drop, rename, invalidate...)
+        position = change["_id"]["_data"]
+        operation = change["operationType"]
+        if operation == "insert":
+            return EventChange(position=position, op="store", id=str(change["documentKey"]["_id"]),
+                               event=self.doc_to_event(change["fullDocument"]))
+        if operation in ("update", "replace") and change.get("fullDocument"):
+            return EventChange(position=position, op="update", id=str(change["documentKey"]["_id"]),
+                               event=self.doc_to_event(change["fullDocument"]))
+        if operation == "delete":
+            event_id = str(change["documentKey"]["_id"])
+            if self.partitioned:
+                # an event moved to another month is written to its new partition before being deleted
+                _, doc = await self._find(event_id)
+                if doc is not None:
+                    return EventChange(position=position, op="update", id=event_id, event=self.doc_to_event(doc))
+            return EventChange(position=position, op="delete", id=event_id)
+        return None
+
+    async def subscribe(self, start: str = None):
+        # a change stream on the collection, or on the database when partitioned, positions are its resume tokens
+        if self.partitioned:
+            watched = self.db
+            pipeline = [{"$match": {"ns.coll": {"$regex": self._partitions_pattern()}}}]
+        else:
+            watched, pipeline = self.collection, []
+        resume_after = {"_data": start} if start else None
+        async with watched.watch(pipeline, full_document="updateLookup", resume_after=resume_after) as stream:
+            async for change in stream:
+                if (event_change := await self._to_change(change)) is not None:
+                    yield event_change
+
+    @staticmethod
+    def encode_cursor(event) -> str:
+        return pack_cursor(datetime_to_us(event["at"].replace(tzinfo=timezone.utc)), event["_id"])
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        # (at, _id), _id being None for a date cursor
+        timestamp, oid = unpack_cursor(cursor)
+        return us_to_datetime(timestamp), oid
+
+    def iter_events(self, start_date: datetime = None, end_date: datetime = None, desc=False, batch_size=1000,
+                    raw=False):
+
+        return iter_events_by_cursor(self.get_events, start_date, end_date, desc, batch_size, raw)
+
+    @staticmethod
+    def _at_filter(start_date: datetime = None, end_date: datetime = None):
+
+        at_conditions = {}
+        if start_date:
+            at_conditions["$gte"] = convert_to_utc(start_date)
+        if end_date:
+            at_conditions["$lte"] = convert_to_utc(end_date)
+        return {"at": at_conditions} if at_conditions else {}
+
+    async def count_events(self, start_date: datetime = None, end_date: datetime = None):
+
+        at_filter = self._at_filter(start_date, end_date)
+        return sum(await asyncio.gather(*(
+            collection.count_documents(at_filter) for collection in await self._collections(start_date, end_date))))
+
+    async def histogram(self, start_date: datetime, end_date: datetime, bucket="hour"):
+        time_buckets(start_date, end_date, bucket)  # validates the bucket and the number of buckets
+        pipeline = [
+            {"$match": self._at_filter(start_date, end_date)},
+            {"$group": {"_id": {"$dateTrunc": {"date": "$at", "unit": bucket}}, "count": {"$sum": 1}}},
+            {"$sort": {"_id": ASCENDING}},
+        ]
+        # a bucket never spans two months, the partitions' histograms are simply concatenated
+        results = await asyncio.gather(*(
+            collection.aggregate(pipeline).to_list(None)
+            for collection in await self._collections(start_date, end_date)
+        ))
+        return [
+            {"at": doc["_id"].replace(tzinfo=timezone.utc), "count": doc["count"]} for docs in results for doc in docs
+        ]
+
+    def _events_filter(self, start_date: datetime = None, end_date: datetime = None, cursor: str = None,
+                       desc: bool = False, query: str = None):
+        # one range on "at", narrowed by the cursor, plus the _id tie breaker for the events at the cursor's "at":
+        # the planner turns it into a single bounded scan of the (at, _id) index, forward or backward, or of the
+        # (tokens, at, _id) one for the first token of a query, the others being checked on the documents
+        events_filter = self._at_filter(start_date, end_date)
+        if query and (tokens := tokenize(query)):
+            if not self.search:
+                raise ValueError("queries need a store created with search=True")
+            events_filter["tokens"] = {"$all": sorted(tokens)}
+        if cursor:
+            ts, oid = self.decode_cursor(cursor)
+            at_conditions = events_filter.setdefault("at", {})
+            if desc:
+                at_conditions["$lte"] = min(at_conditions.get("$lte", ts), ts)
+                if oid is not None:
+                    events_filter["$or"] = [{"at": {"$lt": ts}}, {"_id": {"$lt": oid}}]
+            else:
+                at_conditions["$gte"] = max(at_conditions.get("$gte", ts), ts)
+                if oid is not None:
+                    events_filter["$or"] = [{"at": {"$gt": ts}}, {"_id": {"$gt": oid}}]
+        return events_filter
+
+    @staticmethod
+    def _events_query(collection, events_filter: dict, limit: int = None, desc: bool = False):
+
+        sort = DESCENDING if desc else ASCENDING
+        query = collection.find(events_filter, EVENT_PROJECTION).sort([("at", sort), ("_id", sort)])
+        return query.limit(limit) if limit else query
+
+    async def seek_cursor(self, start_date: datetime = None, end_date: datetime = None, offset=0, desc=False):
+        """
+        Cursor of the page starting `offset` events into the range (None for the first page). MongoDB can't seek
+        by position: the server skips `offset` entries of the (at, _id) index, without reading the documents,
+        a date cursor is cheaper to jump far into a range.
+        """
+        if offset <= 0:
+            return None
+        at_filter = self._at_filter(start_date, end_date)
+        collections = await self._collections(start_date, end_date, desc)
+        if len(collections) > 1:
+            # the partition holding the event before the page, by counting the partitions' events
+            counts = await asyncio.gather(*(collection.count_documents(at_filter) for collection in collections))
+            offset = min(offset, sum(counts))
+            for collection, size in zip(collections, counts):
+                if offset <= size:
+                    collections = [collection]
+                    break
+                offset -= size
+        if not collections or offset <= 0:
+            # nothing in the range (pymongo refuses a negative skip)
+            return None
+        events = await self._events_query(collections[0], at_filter, desc=desc).skip(offset - 1).limit(1).to_list(1)
+        if not events:
+            # past the end, the cursor of the last event
+            events = await self._events_query(collections[0], at_filter, 1, not desc).to_list(1)
+        return self.encode_cursor(events[0]) if events else None
+
+    async def get_events(self,
+                         start_date: datetime = None,
+                         end_date: datetime = None,
+                         cursor: str = None,
+                         limit: int = None,
+                         desc: bool = False,
+                         raw: bool = False,
+                         query: str = None,
+                         ):
+
+        events_filter = self._events_filter(start_date, end_date, cursor, desc, query)
+        at_conditions = events_filter.get("at", {})
+        factory = EventRow if raw else Event
+        events = []
+        for collection in await self._collections(at_conditions.get("$gte"), at_conditions.get("$lte"), desc):
+            if limit:
+                query = self._events_query(collection, events_filter, limit - len(events), desc)
+                events += await query.to_list(length=limit - len(events))
+                if len(events) == limit:
+                    break
+            else:
+                events += await self._events_query(collection, events_filter, desc=desc).to_list()
+        if limit:
+            return {
+                "events": [self.doc_to_event(doc, factory) for doc in events],
+                "next_cursor": self.encode_cursor(events[-1]) if len(events) == limit else None
+            }
+
+        return [self.doc_to_event(doc, factory) for doc in events]
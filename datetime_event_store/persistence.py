@@ -0,0 +1,235 @@
+import gc
+import mmap
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime
+from itertools import count
+
+from sortedcontainers import SortedDict
+
+from .memory import DatetimeEventStore
+from .models import DatetimeEventScore
+from .utils import datetime_to_us, us_to_datetime
+
+SNAPSHOT_MAGIC = b"DTESNAP1"
+# magic, next id, number of events
+SNAPSHOT_HEADER = struct.Struct("<8sQQ")
+# id, at (microseconds since 0001-01-01), payload length, followed by the utf-8 payload
+SNAPSHOT_RECORD = struct.Struct("<qqI")
+# crc32 of everything after it, operation, id, at (or NO_AT), payload length (or NO_DATA), followed by the payload
+WAL_RECORD = struct.Struct("<IBqqi")
+WAL_STORE, WAL_UPDATE, WAL_DELETE = 1, 2, 3
+NO_AT = -1
+NO_DATA = -1
+
+
+class PersistentDatetimeEventStore(DatetimeEventStore):
+
+    # DatetimeEventStore backed by two files in `path`:
+    # - "snapshot": every event in (at, id) order, written by checkpoint() and read back through mmap
+    # - "wal": append-only log of the store/update/delete operations applied since the snapshot
+    # Log records are written as they happen but fsynced in groups, every `sync_every` records or `sync_interval`
+    # seconds, whichever comes first, so a crash loses at most the last group. A torn record at the end of the log
+    # is detected by its crc and dropped on replay. Replaying is idempotent (a store overwrites, update and delete of
+    # a missing event are skipped), so a crash between writing a snapshot and truncating the log is harmless.
+    # A checkpoint is taken once the log holds `checkpoint_every` records (0 never) and by close(), so that startup
+    # reads the snapshot rather than replaying every write. Writes apply and log their operation under the lock
+    # a checkpoint holds, so none lands between the snapshot and the truncation of the log.
+
+    def __init__(self, path, sync_every=1000, sync_interval=0.05, checkpoint_every=100000, search=False):
+
+        super().__init__(search=search)
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.checkpoint_every = checkpoint_every
+        self.snapshot_path = os.path.join(path, "snapshot")
+        self.wal_path = os.path.join(path, "wal")
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        # a checkpoint reads the next id without giving it away
+        self._id_lock = threading.Lock()
+        self._pending = 0
+        # records in the log, since the snapshot
+        self._logged = 0
+        self._closed = threading.Event()
+        self.load()
+        self._wal = open(self.wal_path, "ab")
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def load(self):
+        next_id = 1
+        # millions of small objects are allocated and none of them can be garbage, the cyclic collector would
+        # only rescan them over and over (about half of the load time)
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            if os.path.exists(self.snapshot_path) and os.path.getsize(self.snapshot_path):
+                next_id = self._load_snapshot()
+            if os.path.exists(self.wal_path):
+                next_id = max(next_id, self._replay_wal())
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self._id_gen = count(start=next_id)
+
+    def _load_snapshot(self):
+
+        with open(self.snapshot_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, next_id, total = SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError(f"{self.snapshot_path} is not a snapshot")
+            keys = []
+            offset = SNAPSHOT_HEADER.size
+            for _ in range(total):
+                event_id, at, length = SNAPSHOT_RECORD.unpack_from(data, offset)
+                offset += SNAPSHOT_RECORD.size
+                at = us_to_datetime(at)
+                self.events_by_id[event_id] = {"at": at, "data": data[offset:offset + length].decode()}
+                offset += length
+                keys.append(DatetimeEventScore(at, event_id))
+                if self.search:
+                    self._index_tokens(keys[-1], self.events_by_id[event_id]["data"])
+        # records are written in order, so building the SortedDict doesn't need to sort anything
+        self.sorted_store = SortedDict(zip(keys, (key.id for key in keys)))
+        return next_id
+
+    def _replay_wal(self):
+
+        next_id = 1
+        with open(self.wal_path, "rb") as file:
+            data = file.read()
+        offset = 0
+        self._logged = 0
+        while offset + WAL_RECORD.size <= len(data):
+            crc, operation, event_id, at, length = WAL_RECORD.unpack_from(data, offset)
+            end = offset + WAL_RECORD.size + max(length, 0)
+            if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+                break
+            payload = data[offset + WAL_RECORD.size:end].decode() if length != NO_DATA else None
+            self._apply(operation, event_id, None if at == NO_AT else us_to_datetime(at), payload)
+            next_id = max(next_id, event_id + 1)
+            self._logged += 1
+            offset = end
+        if offset != len(data):
+            # drop the torn tail so that new records are appended after the last valid one
+            with open(self.wal_path, "r+b") as file:
+                file.truncate(offset)
+        return next_id
+
+    def _apply(self, operation, event_id, at, data):
+
+        if operation == WAL_STORE:
+            if event_id in self.events_by_id:
+                super().delete_event(event_id)
+            self._put(event_id, at, data)
+        elif event_id in self.events_by_id:
+            if operation == WAL_UPDATE:
+                super().update_event(event_id, at, data)
+            else:
+                super().delete_event(event_id)
+
+    def _log(self, operation, event_id: int, at: datetime = None, data: str = None):
+        # called with the lock held, right after the operation is applied
+        payload = b"" if data is None else data.encode()
+        record = WAL_RECORD.pack(0, operation, int(event_id), NO_AT if at is None else datetime_to_us(at),
+                                 NO_DATA if data is None else len(payload)) + payload
+        record = struct.pack("<I", zlib.crc32(record[4:])) + record[4:]
+        self._wal.write(record)
+        self._pending += 1
+        self._logged += 1
+        if self.checkpoint_every and self._logged >= self.checkpoint_every:
+            self._checkpoint()
+        elif self._pending >= self.sync_every:
+            self._sync()
+
+    def _sync(self):
+
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+        self._pending = 0
+
+    def sync(self):
+        with self._lock:
+            if self._pending:
+                self._sync()
+
+    def _flush_periodically(self):
+
+        while not self._closed.wait(self.sync_interval):
+            self.sync()
+
+    def gen_new_id(self):
+
+        with self._id_lock:
+            return next(self._id_gen)
+
+    def _store(self, event_id: int, at: datetime, data: str):
+
+        with self._lock:
+            event = super()._store(event_id, at, data)
+            self._log(WAL_STORE, event.id, event.at, data)
+        return event
+
+    def _count_writes(self, *ats: datetime):
+
+        with self._lock:
+            super()._count_writes(*ats)
+
+    def update_event(self, event_id: int, at: datetime = None, data: str = None):
+        with self._lock:
+            event = super().update_event(event_id, at, data)
+            self._log(WAL_UPDATE, event_id, at, data)
+        return event
+
+    def delete_event(self, event_id):
+
+        with self._lock:
+            super().delete_event(event_id)
+            self._log(WAL_DELETE, event_id)
+
+    def checkpoint(self):
+        """Write a snapshot of every event and empty the log. Writes wait for it."""
+        with self._lock:
+            self._checkpoint()
+
+    def _checkpoint(self):
+
+        with self._id_lock:
+            next_id = next(self._id_gen)
+            self._id_gen = count(start=next_id)
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, next_id, len(self.sorted_store)))
+            for at, event_id in self.sorted_store:
+                payload = self.events_by_id[event_id]["data"].encode()
+                file.write(SNAPSHOT_RECORD.pack(event_id, datetime_to_us(at), len(payload)))
+                file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self._wal.truncate(0)
+        self._sync()
+        self._logged = 0
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            if os.path.exists(self.snapshot_path):
+                os.remove(self.snapshot_path)
+            self._wal.truncate(0)
+            self._sync()
+            self._logged = 0
+
+    def close(self, checkpoint=True):
+        # with a checkpoint, the next startup reads the snapshot only
+        self._closed.set()
+        self._flusher.join()
+        if checkpoint:
+            self.checkpoint()
+        else:
+            self.sync()
+        self._wal.close()
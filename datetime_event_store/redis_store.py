@@ -0,0 +1,1069 @@
+import asyncio
+import uuid
+from datetime import datetime
+from itertools import islice
+
+import redis
+import redis.asyncio
+from dateutil.parser import isoparse
+
+from .cursor import pack_cursor, unpack_cursor
+from .metrics import count_round_trip
+from .models import Event, EventChange, EventRow
+from .utils import (
+    chunked,
+    clear_async_redis_by_prefix,
+    clear_redis_by_prefix,
+    convert_to_utc,
+    datetime_to_us,
+    iter_events_by_cursor,
+    time_buckets,
+    tokenize,
+    us_to_datetime,
+)
+
+
+class CountingConnection(redis.Connection):
+    # a command or a whole pipeline is written with a single send_packed_command call
+    def send_packed_command(self, command, check_health=True):
+        count_round_trip()
+        return super().send_packed_command(command, check_health)
+
+
+class AsyncCountingConnection(redis.asyncio.Connection):
+    async def send_packed_command(self, command, check_health=True):
+        count_round_trip()
+        return await super().send_packed_command(command, check_health)
+
+
+SECONDS_PER_DAY = 86400
+# partitions read per round trip when filling a page from a partitioned Redis timeline
+PARTITIONS_PER_ROUND_TRIP = 8
+# changes read per XREAD, and how long an XREAD waits for new ones (short enough to notice a cancelled subscriber)
+CHANGES_PER_READ = 100
+CHANGES_BLOCK_MS = 5000
+
+# Returns the timeline ZSET of a timestamp: KEYS[2] itself, or the daily ZSET "<KEYS[2]>:<day>" when partitioned,
+# the day being the first 12 digits of the timestamp (the seconds) divided by 86400, as in _day.
+REDIS_TIMELINE_FUNCTION = """
+local function timeline(at, partitioned)
+    if partitioned ~= '1' then
+        return KEYS[2]
+    end
+    return KEYS[2] .. ':' .. string.format('%d', math.floor(tonumber(string.sub(at, 1, 12)) / 86400))
+end
+"""
+
+# Appends a change to the KEYS[4] stream, capped to about `maxlen` entries, unless maxlen is "0".
+REDIS_PUBLISH_FUNCTION = """
+local function publish(maxlen, ...)
+    if maxlen ~= '0' then
+        redis.call('XADD', KEYS[4], 'MAXLEN', '~', maxlen, '*', ...)
+    end
+end
+"""
+
+# Adds a member "<timestamp>:<id>" (never the payload of an embedded member) to, or removes it from, the token
+# ZSETs "<KEYS[5]><token>" of the words of `data`, split as tokenize does: runs of ASCII letters and digits and of
+# non-ASCII bytes, ASCII letters lowercased. Nothing is indexed when KEYS[5] is "" (search is off).
+REDIS_TOKENS_FUNCTION = """
+local function tokens(data)
+    local found = {}
+    for token in string.gmatch(string.lower(data), '[%w\\128-\\255]+') do
+        found[token] = true
+    end
+    return found
+end
+
+local function index(data, member)
+    if KEYS[5] == '' then
+        return
+    end
+    for token in pairs(tokens(data)) do
+        redis.call('ZADD', KEYS[5] .. token, 0, member)
+    end
+end
+
+local function unindex(data, member)
+    if KEYS[5] == '' then
+        return
+    end
+    for token in pairs(tokens(data)) do
+        redis.call('ZREM', KEYS[5] .. token, member)
+    end
+end
+"""
+# Counts a write of the events of the day of `at` in the KEYS[6] hash of the versions (see range_version).
+REDIS_BUMP_FUNCTION = """
+local function bump(at)
+    redis.call('HINCRBY', KEYS[6], string.format('%d', math.floor(tonumber(string.sub(at, 1, 12)) / 86400)), 1)
+end
+"""
+# the functions of every script that writes
+REDIS_WRITE_FUNCTIONS = REDIS_TIMELINE_FUNCTION + REDIS_PUBLISH_FUNCTION + REDIS_TOKENS_FUNCTION + REDIS_BUMP_FUNCTION
+
+# KEYS: event hash, timeline ZSET, partitions ZSET, changes stream, token ZSETs prefix, versions hash.
+# ARGV: padded id, new timestamp ("" to keep it), "1" if data is set, data, "1" if the timeline is partitioned,
+# changes stream max length.
+# Reads the old timestamp, rewrites the hash and moves the ZSET members in one atomic round trip.
+REDIS_UPDATE_SCRIPT = REDIS_WRITE_FUNCTIONS + """
+local old = redis.call('HGET', KEYS[1], 'at')
+if not old then
+    return false
+end
+local old_data = redis.call('HGET', KEYS[1], 'data')
+local new = ARGV[2] ~= '' and ARGV[2] or old
+if ARGV[3] == '1' then
+    redis.call('HSET', KEYS[1], 'at', new, 'data', ARGV[4])
+else
+    redis.call('HSET', KEYS[1], 'at', new)
+end
+if new ~= old then
+    redis.call('ZREM', timeline(old, ARGV[5]), old .. ':' .. ARGV[1])
+    local key = timeline(new, ARGV[5])
+    redis.call('ZADD', key, 0, new .. ':' .. ARGV[1])
+    if ARGV[5] == '1' then
+        local day = string.sub(key, string.len(KEYS[2]) + 2)
+        redis.call('ZADD', KEYS[3], day, day)
+    end
+end
+local data = redis.call('HGET', KEYS[1], 'data')
+if new ~= old or data ~= old_data then
+    unindex(old_data, old .. ':' .. ARGV[1])
+    index(data, new .. ':' .. ARGV[1])
+end
+bump(old)
+bump(new)
+publish(ARGV[6], 'op', 'update', 'id', ARGV[1], 'at', new, 'data', data)
+return {new, data}
+"""
+
+# KEYS: event hash, timeline ZSET, partitions ZSET (unused), changes stream, token ZSETs prefix, versions hash.
+# ARGV: padded id, "1" if the timeline is partitioned, changes stream max length.
+REDIS_DELETE_SCRIPT = REDIS_WRITE_FUNCTIONS + """
+local at = redis.call('HGET', KEYS[1], 'at')
+if not at then
+    return 0
+end
+redis.call('ZREM', timeline(at, ARGV[2]), at .. ':' .. ARGV[1])
+unindex(redis.call('HGET', KEYS[1], 'data'), at .. ':' .. ARGV[1])
+redis.call('DEL', KEYS[1])
+bump(at)
+publish(ARGV[3], 'op', 'delete', 'id', ARGV[1])
+return 1
+"""
+
+# Embedded mode: the member of an event also holds its payload, "<timestamp>:<id>:<data>", and the timestamp of
+# every id is kept in the index hashes. Returns the member of the event ARGV[1] (padded id) at `at`.
+REDIS_FIND_FUNCTION = """
+local function find(at, partitioned)
+    local prefix = at .. ':' .. ARGV[1]
+    return redis.call('ZRANGEBYLEX', timeline(at, partitioned), '[' .. prefix .. ':', '(' .. prefix .. ';')[1]
+end
+"""
+
+# KEYS: index hash, timeline ZSET. ARGV: padded id, index field, "1" if the timeline is partitioned.
+REDIS_EMBEDDED_GET_SCRIPT = REDIS_TIMELINE_FUNCTION + REDIS_FIND_FUNCTION + """
+local at = redis.call('HGET', KEYS[1], ARGV[2])
+if not at then
+    return false
+end
+return find(at, ARGV[3])
+"""
+
+# Same KEYS and ARGV as REDIS_UPDATE_SCRIPT, the index hash replacing the event hash, plus the index field.
+REDIS_EMBEDDED_UPDATE_SCRIPT = REDIS_WRITE_FUNCTIONS + REDIS_FIND_FUNCTION + """
+local old = redis.call('HGET', KEYS[1], ARGV[7])
+local member = old and find(old, ARGV[5])
+if not member then
+    return false
+end
+local new = ARGV[2] ~= '' and ARGV[2] or old
+local data = ARGV[3] == '1' and ARGV[4] or string.sub(member, 41)
+redis.call('ZREM', timeline(old, ARGV[5]), member)
+unindex(string.sub(member, 41), old .. ':' .. ARGV[1])
+local key = timeline(new, ARGV[5])
+redis.call('ZADD', key, 0, new .. ':' .. ARGV[1] .. ':' .. data)
+index(data, new .. ':' .. ARGV[1])
+if new ~= old then
+    redis.call('HSET', KEYS[1], ARGV[7], new)
+    if ARGV[5] == '1' then
+        local day = string.sub(key, string.len(KEYS[2]) + 2)
+        redis.call('ZADD', KEYS[3], day, day)
+    end
+end
+bump(old)
+bump(new)
+publish(ARGV[6], 'op', 'update', 'id', ARGV[1], 'at', new, 'data', data)
+return {new, data}
+"""
+
+# Same KEYS and ARGV as REDIS_DELETE_SCRIPT, the index hash replacing the event hash, plus the index field.
+REDIS_EMBEDDED_DELETE_SCRIPT = REDIS_WRITE_FUNCTIONS + REDIS_FIND_FUNCTION + """
+local at = redis.call('HGET', KEYS[1], ARGV[4])
+if not at then
+    return 0
+end
+local member = find(at, ARGV[2])
+if member then
+    redis.call('ZREM', timeline(at, ARGV[2]), member)
+    unindex(string.sub(member, 41), at .. ':' .. ARGV[1])
+end
+redis.call('HDEL', KEYS[1], ARGV[4])
+bump(at)
+publish(ARGV[3], 'op', 'delete', 'id', ARGV[1])
+return 1
+"""
+# KEYS: partitions ZSET (unused), timeline ZSET. ARGV: "1" if the timeline is partitioned, "<timestamp>:<id>"
+# members of the token ZSETs. Their embedded members, "" for the events deleted since, in a single round trip.
+REDIS_EMBEDDED_RESOLVE_SCRIPT = REDIS_TIMELINE_FUNCTION + """
+local members = {}
+for i = 2, #ARGV do
+    local prefix = ARGV[i]
+    local found = redis.call('ZRANGEBYLEX', timeline(prefix, ARGV[1]), '[' .. prefix .. ':', '(' .. prefix .. ';',
+                             'LIMIT', 0, 1)
+    members[i - 1] = found[1] or ''
+end
+return members
+"""
+# KEYS: versions hash. ARGV: first and last day of the range ("" when unbounded).
+# The epoch (the "epoch" field set by clear, "" before any) and the number of writes of the days of the range, read
+# only: the fields of the days of a bounded range shorter than the hash, the whole hash otherwise.
+REDIS_VERSION_SCRIPT = """
+local epoch = redis.call('HGET', KEYS[1], 'epoch') or ''
+local first, last = tonumber(ARGV[1]), tonumber(ARGV[2])
+local total = 0
+if first and last and last - first < math.min(redis.call('HLEN', KEYS[1]), 1000) then
+    local days = {}
+    for day = first, last do
+        days[#days + 1] = string.format('%d', day)
+    end
+    if #days > 0 then
+        for _, count in ipairs(redis.call('HMGET', KEYS[1], unpack(days))) do
+            if count then
+                total = total + tonumber(count)
+            end
+        end
+    end
+else
+    local fields = redis.call('HGETALL', KEYS[1])
+    for i = 1, #fields, 2 do
+        local day = tonumber(fields[i])
+        if day and (not first or day >= first) and (not last or day <= last) then
+            total = total + tonumber(fields[i + 1])
+        end
+    end
+end
+return {epoch, total}
+"""
+# ids per index hash, few enough for Redis to keep every one of them in its compact listpack encoding
+INDEX_BUCKET_SIZE = 100
+
+
+class RedisDatetimeEventStore:
+
+    # Events are ordered in a single ZSET where every member has a score of 0 and is named
+    # "<timestamp>:<id>", both parts zero padded to a fixed width, so that the lexicographic order of
+    # the members is the (at, id) order and ranges can be read with ZRANGEBYLEX.
+    # The timestamp is the number of microseconds since 0001-01-01T00:00:00Z on 18 digits
+    # (its first 12 digits are the seconds), so every datetime is stored with its full precision,
+    # and the id is padded to 20 digits, so there is no practical limit on the number of events.
+    # The same timestamp is kept in the "at" field of the event hash.
+    # With partitioned=True the timeline is split into one ZSET per UTC day, "<sorted_key>:<day>" with day the
+    # number of days since 0001-01-01, and the days that have one are kept in the "<prefix>:partitions" ZSET
+    # (scored by day), so that a query only reads the days it overlaps and old days can be dropped as a whole.
+    # Every write also appends a change to the "<prefix>:changes" stream, in the same round trip, capped to about
+    # `changes_maxlen` entries (0 to publish nothing), read by subscribe().
+    # With embedded=True there is no hash per event: the member carries the payload, "<timestamp>:<id>:<data>",
+    # so a range is read in a single command, and the timestamp of each id is kept in "<prefix>:index:<bucket>"
+    # hashes of INDEX_BUCKET_SIZE ids, which lookups by id, updates and deletes go through. Best for small payloads,
+    # which every range read returns whole. The two modes don't read each other's data.
+    # With search=True, the "<timestamp>:<id>" member of every event is also added to the "<prefix>:token:<token>"
+    # ZSET of each of its words (see tokenize), never partitioned, maintained by the same round trips:
+    # get_events(query=...) reads the ZSET of its token, or of its rarest token, checking the others with ZMSCORE,
+    # instead of the timeline. The payloads of the embedded mode aren't copied there, the embedded members of a page
+    # are looked up by prefix in a single script. Without it (the default), a write costs one command per word less
+    # and queries are refused.
+    # Writes are counted per day in the "<prefix>:versions" hash, last in their round trip, for range_version.
+    truncate_microseconds = False
+
+    def __init__(self, redis_client, sorted_key="timeline", hash_prefix="event:", prefix="events", partitioned=False,
+                 changes_maxlen=10000, embedded=False, search=False):
+
+        self.redis = redis_client
+        self.prefix = prefix
+        self.partitioned = partitioned
+        self.changes_maxlen = changes_maxlen
+        self.sorted_key = f"{prefix}:{sorted_key}"
+        self.partitions_key = f"{prefix}:partitions"
+        self.changes_key = f"{prefix}:changes"
+        self.hash_prefix = f"{prefix}:{hash_prefix}"
+        self.id_key = f"{prefix}:next_id"
+        self.index_prefix = f"{prefix}:index:"
+        self.token_prefix = f"{prefix}:token:"
+        self.versions_key = f"{prefix}:versions"
+        self.embedded = embedded
+        self.search = search
+        if embedded:
+            self._get_script = redis_client.register_script(REDIS_EMBEDDED_GET_SCRIPT)
+            self._update_script = redis_client.register_script(REDIS_EMBEDDED_UPDATE_SCRIPT)
+            self._delete_script = redis_client.register_script(REDIS_EMBEDDED_DELETE_SCRIPT)
+            self._resolve_script = redis_client.register_script(REDIS_EMBEDDED_RESOLVE_SCRIPT)
+        else:
+            self._update_script = redis_client.register_script(REDIS_UPDATE_SCRIPT)
+            self._delete_script = redis_client.register_script(REDIS_DELETE_SCRIPT)
+        self._version_script = redis_client.register_script(REDIS_VERSION_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url="redis://localhost:6379/0", max_connections=50, pool_timeout=5.0, count_round_trips=False,
+                 **kwargs):
+        """
+        Store on a client of its own, whose pool blocks for a free connection (up to `pool_timeout` seconds) instead
+        of failing once `max_connections` are in use. The other keyword arguments are the constructor's.
+        """
+        pool = redis.BlockingConnectionPool.from_url(
+            url, decode_responses=True, max_connections=max_connections, timeout=pool_timeout,
+            connection_class=CountingConnection if count_round_trips else redis.Connection)
+        return cls(redis.Redis(connection_pool=pool), **kwargs)
+
+    def clear(self):
+        clear_redis_by_prefix(self.redis, self.prefix)
+        # a new epoch, so that the versions of the emptied store differ from the ones before
+        self.redis.hset(self.versions_key, "epoch", uuid.uuid4().hex[:16])
+
+    def gen_new_id(self):
+
+        return self.redis.incr(self.id_key)
+
+    def _hash_key(self, event_id: int):
+
+        return f"{self.hash_prefix}{event_id}"
+
+    def _index_key(self, event_id: int):
+
+        return f"{self.index_prefix}{int(event_id) // INDEX_BUCKET_SIZE}"
+
+    @staticmethod
+    def _index_field(event_id: int):
+
+        return str(int(event_id) % INDEX_BUCKET_SIZE)
+
+    def _token_key(self, token: str):
+
+        return f"{self.token_prefix}{token}"
+
+    def _event_key(self, event_id: int):
+        # the key the update and delete scripts get the timestamp of an event from
+        return self._index_key(event_id) if self.embedded else self._hash_key(event_id)
+
+    @staticmethod
+    def _timestamp(dt: datetime):
+
+        return f"{datetime_to_us(dt):018d}"
+
+    @staticmethod
+    def _timestamp_to_datetime(timestamp: str):
+
+        return us_to_datetime(int(timestamp))
+
+    @staticmethod
+    def _member(timestamp: str, event_id: int, data: str = None):
+        # the data only goes in the members of the embedded mode
+        member = f"{timestamp}:{int(event_id):020d}"
+        return member if data is None else f"{member}:{data}"
+
+    def _lower_bound(self, start_date: datetime = None):
+
+        return f"[{self._member(self._timestamp(start_date), 0)}" if start_date else "-"
+
+    def _upper_bound(self, end_date: datetime = None):
+
+        return f"[{self._member(self._timestamp(end_date), 10 ** 20 - 1)}" if end_date else "+"
+
+    @staticmethod
+    def _day(timestamp: str):
+        # day of a timestamp or a member, both start with the 12 digits of the seconds
+        return int(timestamp[:12]) // SECONDS_PER_DAY
+
+    def _timeline_key(self, timestamp: str):
+
+        return f"{self.sorted_key}:{self._day(timestamp)}" if self.partitioned else self.sorted_key
+
+    def _partition_bounds(self, start_date: datetime = None, end_date: datetime = None, cursor=None, desc=False):
+        # first and last day a query reads, the cursor replacing the bound it moves
+        lower = self._day(self._timestamp(start_date)) if start_date else "-inf"
+        upper = self._day(self._timestamp(end_date)) if end_date else "+inf"
+        if cursor:
+            if desc:
+                upper = self._day(cursor)
+            else:
+                lower = self._day(cursor)
+        return lower, upper
+
+    def _partition_keys(self, days, desc=False):
+
+        return [f"{self.sorted_key}:{day}" for day in (reversed(days) if desc else days)]
+
+    # The _*_pipeline and _run_*_script helpers only build or send the commands of a round trip, and the operations
+    # that need several round trips are generators (the _*_steps methods) that yield the pipeline of each round
+    # trip and are sent its results. Both are shared with AsyncRedisDatetimeEventStore, which awaits what _run
+    # executes here, so that the two classes only differ by their I/O.
+
+    def _run(self, steps):
+        # the result of a _*_steps generator, once its round trips are executed
+        results = None
+        while True:
+            try:
+                pipe = steps.send(results)
+            except StopIteration as stop:
+                return stop.value
+            results = pipe.execute()
+
+    def _command(self, name: str, *args):
+        # a round trip of a single command
+        pipe = self.redis.pipeline(transaction=False)
+        getattr(pipe, name)(*args)
+        return pipe
+
+    def _timelines_steps(self, start_date: datetime = None, end_date: datetime = None, cursor=None, desc=False):
+        # ZSETs a query reads, in the order it reads them
+        if not self.partitioned:
+            return [self.sorted_key]
+        days = (yield self._command("zrangebyscore", self.partitions_key,
+                                    *self._partition_bounds(start_date, end_date, cursor, desc)))[0]
+        return self._partition_keys(days, desc)
+
+    def _to_event(self, event_id: int, raw_event: dict):
+
+        return Event(id=event_id, at=self._timestamp_to_datetime(raw_event["at"]), data=raw_event["data"])
+
+    def _fetch_event(self, event_id: int):
+        # the hash of an event, or its member in embedded mode
+        if self.embedded:
+            return self._get_script(keys=[self._index_key(event_id), self.sorted_key], args=[
+                f"{int(event_id):020d}", self._index_field(event_id), "1" if self.partitioned else "0"])
+        return self.redis.hgetall(self._hash_key(event_id))
+
+    def _fetched_event(self, event_id: int, result):
+
+        if not self.embedded:
+            return self._to_event(event_id, result)
+        if result is None:
+            raise KeyError(event_id)
+        return self._members_to_events([result])[0]
+
+    def get_event(self, event_id: int):
+        return self._fetched_event(event_id, self._fetch_event(event_id))
+
+    def _payloads_pipeline(self, members):
+        # the member already holds the timestamp and the id, only the payloads are fetched, in a single round trip
+        pipe = self.redis.pipeline(transaction=False)
+        for member in members:
+            pipe.hget(self._hash_key(int(member[19:39])), "data")
+        return pipe
+
+    def _members_to_events(self, members, payloads=None, factory=Event):
+        # without payloads, they are read from the members of the embedded mode
+        if payloads is None:
+            return [
+                factory(id=int(member[19:39]), at=self._timestamp_to_datetime(member[:18]), data=member[40:])
+                for member in members
+            ]
+        return [
+            factory(id=int(member[19:39]), at=self._timestamp_to_datetime(member[:18]), data=data)
+            for member, data in zip(members, payloads)
+            if data is not None  # deleted after the range was read
+        ]
+
+    def _add_members(self, pipe, members):
+
+        if not self.partitioned:
+            pipe.zadd(self.sorted_key, dict.fromkeys(members, 0))
+            return
+        by_day = {}
+        for member in members:
+            by_day.setdefault(self._day(member), {})[member] = 0
+        for day, day_members in by_day.items():
+            pipe.zadd(f"{self.sorted_key}:{day}", day_members)
+        pipe.zadd(self.partitions_key, {str(day): day for day in by_day})
+
+    def _add_tokens(self, pipe, members, payloads):
+        # one ZADD per token, of the "<timestamp>:<id>" part of the members
+        if not self.search:
+            return
+        by_token = {}
+        for member, data in zip(members, payloads):
+            for token in tokenize(data):
+                by_token.setdefault(token, {})[member[:39]] = 0
+        for token, token_members in by_token.items():
+            pipe.zadd(self._token_key(token), token_members)
+
+    def _remove_tokens(self, pipe, members, payloads):
+
+        if not self.search:
+            return
+        by_token = {}
+        for member, data in zip(members, payloads):
+            if data is not None:
+                for token in tokenize(data):
+                    by_token.setdefault(token, []).append(member[:39])
+        for token, token_members in by_token.items():
+            pipe.zrem(self._token_key(token), *token_members)
+
+    def _bump_versions(self, pipe, timestamps):
+        # after the writes they count, in the same pipeline
+        by_day = {}
+        for timestamp in timestamps:
+            by_day[self._day(timestamp)] = by_day.get(self._day(timestamp), 0) + 1
+        for day, writes in by_day.items():
+            pipe.hincrby(self.versions_key, day, writes)
+
+    def _publish(self, pipe, op: str, event_id: int, timestamp: str = None, data: str = None):
+
+        if self.changes_maxlen:
+            fields = {"op": op, "id": f"{int(event_id):020d}"}
+            if timestamp is not None:
+                fields.update(at=timestamp, data=data)
+            pipe.xadd(self.changes_key, fields, maxlen=self.changes_maxlen, approximate=True)
+
+    def _add_event(self, pipe, event_id: int, timestamp: str, data: str):
+
+        member = self._member(timestamp, event_id, data if self.embedded else None)
+        self._add_members(pipe, [member])
+        self._add_tokens(pipe, [member], [data])
+        if self.embedded:
+            pipe.hset(self._index_key(event_id), self._index_field(event_id), timestamp)
+        else:
+            pipe.hset(self._hash_key(event_id), mapping={"at": timestamp, "data": data})
+        self._bump_versions(pipe, [timestamp])
+        self._publish(pipe, "store", event_id, timestamp, data)
+
+    def _store_event_steps(self, at: datetime, data: str):
+
+        event_id = (yield self._command("incr", self.id_key))[0]
+        at = convert_to_utc(at)
+        pipe = self.redis.pipeline()
+        self._add_event(pipe, event_id, self._timestamp(at), data)
+        yield pipe
+        return Event(id=event_id, at=at, data=data)
+
+    def store_event(self, at: datetime, data: str):
+
+        return self._run(self._store_event_steps(at, data))
+
+    @staticmethod
+    def _reserved_ids(n: int, last_id: int):
+
+        return list(range(last_id - n + 1, last_id + 1))
+
+    def reserve_ids(self, n: int):
+
+        return self._reserved_ids(n, self.redis.incrby(self.id_key, n))
+
+    def _store_batch_pipeline(self, batch, ids):
+
+        created = []
+        members = []
+        index = {}
+        pipe = self.redis.pipeline(transaction=False)
+        for event_id, (at, data) in zip(ids, batch):
+            at = convert_to_utc(at)
+            timestamp = self._timestamp(at)
+            if self.embedded:
+                members.append(self._member(timestamp, event_id, data))
+                index.setdefault(self._index_key(event_id), {})[self._index_field(event_id)] = timestamp
+            else:
+                members.append(self._member(timestamp, event_id))
+                pipe.hset(self._hash_key(event_id), mapping={"at": timestamp, "data": data})
+            self._publish(pipe, "store", event_id, timestamp, data)
+            created.append(Event(id=event_id, at=at, data=data))
+        for key, mapping in index.items():
+            pipe.hset(key, mapping=mapping)
+        self._add_members(pipe, members)
+        self._add_tokens(pipe, members, [event.data for event in created])
+        self._bump_versions(pipe, members)
+        return pipe, created
+
+    def _store_events_many_steps(self, events, batch_size=1000, ids=None):
+        # ids are reserved per batch with a single INCRBY, unless given (from reserve_ids), events are returned
+        # without any read-back
+        created = []
+        ids = iter(ids) if ids is not None else None
+        for batch in chunked(events, batch_size):
+            if ids is not None:
+                batch_ids = list(islice(ids, len(batch)))
+            else:
+                batch_ids = self._reserved_ids(len(batch), (yield self._command("incrby", self.id_key, len(batch)))[0])
+            pipe, batch_created = self._store_batch_pipeline(batch, batch_ids)
+            yield pipe
+            created.extend(batch_created)
+        return created
+
+    def store_events_many(self, events, batch_size=1000, ids=None):
+
+        return self._run(self._store_events_many_steps(events, batch_size, ids))
+
+    def _script_keys(self, event_id: int):
+        # KEYS of the update and delete scripts
+        return [self._event_key(event_id), self.sorted_key, self.partitions_key, self.changes_key,
+                self.token_prefix if self.search else "", self.versions_key]
+
+    def _run_delete_script(self, event_id: int):
+
+        return self._delete_script(
+            keys=self._script_keys(event_id),
+            args=[f"{int(event_id):020d}", "1" if self.partitioned else "0", self.changes_maxlen,
+                  self._index_field(event_id)])
+
+    def delete_event(self, event_id: int):
+        self._run_delete_script(event_id)
+
+    def _run_update_script(self, event_id: int, at: datetime = None, data: str = None):
+
+        return self._update_script(keys=self._script_keys(event_id), args=[
+            f"{int(event_id):020d}",
+            "" if at is None else self._timestamp(at),
+            "0" if data is None else "1",
+            data or "",
+            "1" if self.partitioned else "0",
+            self.changes_maxlen,
+            self._index_field(event_id),
+        ])
+
+    def _updated_event(self, event_id: int, result):
+
+        if result is None:
+            raise KeyError(event_id)
+        return self._to_event(event_id, {"at": result[0], "data": result[1]})
+
+    def update_event(self, event_id: int, at: datetime = None, data: str = None):
+
+        return self._updated_event(event_id, self._run_update_script(event_id, at, data))
+
+    def iter_events(self, start_date: datetime = None, end_date: datetime = None, desc=False, batch_size=1000,
+                    raw=False):
+
+        return iter_events_by_cursor(self.get_events, start_date, end_date, desc, batch_size, raw)
+
+    def _query_pipeline(self, keys, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None,
+                        desc=False):
+
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            if desc:
+                max_member = f"({cursor}" if cursor else self._upper_bound(end_date)
+                pipe.zrevrangebylex(key, max_member, self._lower_bound(start_date), 0 if limit else None, limit or None)
+            else:
+                min_member = f"({cursor}" if cursor else self._lower_bound(start_date)
+                pipe.zrangebylex(key, min_member, self._upper_bound(end_date), 0 if limit else None, limit or None)
+        return pipe
+
+    @staticmethod
+    def _query_batches(keys, limit=None):
+        # a page usually fits in its first partition, so the partitions are read a few at a time
+        return chunked(keys, PARTITIONS_PER_ROUND_TRIP if limit else max(len(keys), 1))
+
+    def _query_members_steps(self, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None,
+                             desc=False):
+
+        members = []
+        timelines = yield from self._timelines_steps(start_date, end_date, cursor, desc)
+        for keys in self._query_batches(timelines, limit):
+            for result in (yield self._query_pipeline(keys, start_date, end_date, cursor, limit, desc)):
+                members.extend(result)
+            if limit and len(members) >= limit:
+                return members[:limit]
+        return members
+
+    def _sizes_pipeline(self, keys):
+
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.zcard(key)
+        return pipe
+
+    def _contains_pipeline(self, keys, members):
+
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.zmscore(key, members)
+        return pipe
+
+    @staticmethod
+    def _contained(members, scores):
+        # the members every other token ZSET holds too
+        return [member for member, *member_scores in zip(members, *scores) if None not in member_scores]
+
+    def _token_members_steps(self, tokens, start_date: datetime = None, end_date: datetime = None, cursor=None,
+                             limit=None, desc=False):
+        # a single token ZSET is read as a timeline; with several tokens, the smallest ZSET is read `limit` members
+        # at a time, until the page is full, and every other ZSET is asked which of them it holds
+        keys = [self._token_key(token) for token in tokens]
+        if len(keys) > 1:
+            sizes = yield self._sizes_pipeline(keys)
+            keys = [key for _, key in sorted(zip(sizes, keys))]
+            if not min(sizes):
+                return []
+        members = []
+        while True:
+            read = (yield self._query_pipeline(keys[:1], start_date, end_date, cursor, limit, desc))[0]
+            if keys[1:] and read:
+                members.extend(self._contained(read, (yield self._contains_pipeline(keys[1:], read))))
+            else:
+                members.extend(read)
+            if not limit or len(read) < limit or len(members) >= limit:
+                return members[:limit]
+            cursor = read[-1]
+
+    def _resolve_pipeline(self, members):
+
+        # as the sync Script does in a pipeline (the async one can't be queued): loaded by execute if missing
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.scripts.add(self._resolve_script)
+        pipe.evalsha(self._resolve_script.sha, 2, self.partitions_key, self.sorted_key,
+                     "1" if self.partitioned else "0", *members)
+        return pipe
+
+    @staticmethod
+    def _resolved(members):
+        # the events deleted after the token ZSET was read are left out
+        return [member for member in members if member]
+
+    def _count_pipeline(self, keys, start_date: datetime = None, end_date: datetime = None):
+
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.zlexcount(key, self._lower_bound(start_date), self._upper_bound(end_date))
+        return pipe
+
+    def _histogram_pipeline(self, buckets):
+        # a bucket never spans two days, so it is counted in a single partition
+        pipe = self.redis.pipeline(transaction=False)
+        for _, lower, upper in buckets:
+            pipe.zlexcount(self._timeline_key(self._timestamp(lower)), self._lower_bound(lower),
+                           self._upper_bound(upper))
+        return pipe
+
+    def _run_version_script(self, start_date: datetime = None, end_date: datetime = None):
+
+        return self._version_script(keys=[self.versions_key], args=[
+            self._day(self._timestamp(start_date)) if start_date else "",
+            self._day(self._timestamp(end_date)) if end_date else "",
+        ])
+
+    def range_version(self, start_date: datetime = None, end_date: datetime = None):
+        """
+        Opaque version of the events between start_date and end_date, which changes whenever one of them is stored,
+        updated or deleted: one script summing the per day counters, in a single round trip.
+        """
+        epoch, total = self._run_version_script(start_date, end_date)
+        return f"{epoch}-{total}"
+
+    @staticmethod
+    def _histogram(buckets, counts):
+
+        return [{"at": at, "count": count} for (at, _, _), count in zip(buckets, counts) if count]
+
+    def _count_events_steps(self, start_date: datetime = None, end_date: datetime = None):
+
+        keys = yield from self._timelines_steps(start_date, end_date)
+        return sum((yield self._count_pipeline(keys, start_date, end_date)))
+
+    def count_events(self, start_date: datetime = None, end_date: datetime = None):
+
+        return self._run(self._count_events_steps(start_date, end_date))
+
+    def histogram(self, start_date: datetime, end_date: datetime, bucket="hour"):
+        # one ZLEXCOUNT per bucket, all in a single pipeline
+        buckets = time_buckets(start_date, end_date, bucket)
+        return self._histogram(buckets, self._histogram_pipeline(buckets).execute())
+
+    def _cursor_member(self, cursor: str = None, desc=False):
+        # member a cursor points at; a date cursor points between the members of the instant before it ("<ts>:")
+        # and those after it ("<ts>;"), so that the exclusive range bound leaves them all in the page.
+        # Going up, the embedded members of the cursor's event ("<ts>:<id>:<data>") are before "<ts>:<id>;".
+        if not cursor:
+            return None
+        timestamp, event_id = unpack_cursor(cursor)
+        if event_id is None:
+            return f"{timestamp:018d}{';' if desc else ':'}"
+        return f"{timestamp:018d}:{event_id:020d}{';' if self.embedded and not desc else ''}"
+
+    @staticmethod
+    def _member_cursor(member: str):
+
+        return pack_cursor(int(member[:18]), int(member[19:39]))
+
+    def _seek_pipeline(self, keys, start_date: datetime = None, end_date: datetime = None):
+        # the members of every timeline in the range, then the rank of the first of them
+        pipe = self._count_pipeline(keys, start_date, end_date)
+        if start_date:
+            for key in keys:
+                pipe.zlexcount(key, "-", f"({self._lower_bound(start_date)[1:]}")
+        return pipe
+
+    @staticmethod
+    def _seek_position(keys, results, offset, desc=False):
+        # timeline and rank of the last event before the page starting `offset` events into the range
+        counts, ranks = results[:len(keys)], results[len(keys):] or [0] * len(keys)
+        offset = min(offset, sum(counts))
+        if offset <= 0:
+            return None
+        for key, size, rank in zip(keys, counts, ranks):
+            if offset <= size:
+                return key, rank + (size - offset if desc else offset - 1)
+            offset -= size
+
+    def _seek_cursor_steps(self, start_date: datetime = None, end_date: datetime = None, offset=0, desc=False):
+
+        keys = yield from self._timelines_steps(start_date, end_date, desc=desc)
+        position = self._seek_position(keys, (yield self._seek_pipeline(keys, start_date, end_date)), offset, desc)
+        if not position:
+            return None
+        members = (yield self._command("zrange", position[0], position[1], position[1]))[0]
+        return self._member_cursor(members[0]) if members else None
+
+    def seek_cursor(self, start_date: datetime = None, end_date: datetime = None, offset=0, desc=False):
+        """
+        Cursor of the page starting `offset` events into the range (None for the first page): the events are
+        counted per timeline, then the one before the page is read by rank, O(log n) in 2 round trips (3 when
+        partitioned).
+        """
+        return self._run(self._seek_cursor_steps(start_date, end_date, offset, desc))
+
+    @staticmethod
+    def _page(members, events, limit=None):
+
+        if limit:
+            return {
+                "events": events,
+                "next_cursor": RedisDatetimeEventStore._member_cursor(members[-1]) if len(members) == limit else None
+            }
+
+        return events
+
+    def _query_tokens(self, query: str):
+        # the tokens of a query, which reads the token ZSETs
+        tokens = tokenize(query) if query else None
+        if tokens and not self.search:
+            raise ValueError("queries need a store created with search=True")
+        return tokens
+
+    def _get_events_steps(self, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None,
+                          desc=False, raw=False, query: str = None):
+
+        cursor = self._cursor_member(cursor, desc)
+        if tokens := self._query_tokens(query):
+            members = rows = yield from self._token_members_steps(sorted(tokens), start_date, end_date, cursor, limit,
+                                                                  desc)
+            if self.embedded and members:
+                rows = self._resolved((yield self._resolve_pipeline(members))[0])
+        else:
+            members = rows = yield from self._query_members_steps(start_date, end_date, cursor, limit, desc)
+        payloads = None if self.embedded else (yield self._payloads_pipeline(rows))
+        return self._page(members, self._members_to_events(rows, payloads, EventRow if raw else Event), limit)
+
+    def get_events(self, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None,
+                   desc=False, raw=False, query: str = None):
+
+        return self._run(self._get_events_steps(start_date, end_date, cursor, limit, desc, raw, query))
+
+    def _migrate_score_layout_steps(self, legacy_sorted_key="sorted_events", batch_size=1000):
+
+        legacy_key = f"{self.prefix}:{legacy_sorted_key}"
+        migrated = 0
+        while ids := (yield self._command("zrange", legacy_key, 0, batch_size - 1))[0]:
+            pipe = self.redis.pipeline(transaction=False)
+            for event_id in ids:
+                pipe.hmget(self._hash_key(event_id), "at", "data")
+            fields = yield pipe
+            members = []
+            payloads = []
+            index = {}
+            pipe = self.redis.pipeline()
+            for event_id, (at, data) in zip(ids, fields):
+                if at is not None:
+                    timestamp = self._timestamp(isoparse(at))
+                    payloads.append(data)
+                    if self.embedded:
+                        # the payload moves to the member, the hash is replaced by the index field
+                        members.append(self._member(timestamp, event_id, data))
+                        index.setdefault(self._index_key(event_id), {})[self._index_field(event_id)] = timestamp
+                        pipe.unlink(self._hash_key(event_id))
+                    else:
+                        members.append(self._member(timestamp, event_id))
+                        pipe.hset(self._hash_key(event_id), "at", timestamp)
+            for key, mapping in index.items():
+                pipe.hset(key, mapping=mapping)
+            if members:
+                self._add_members(pipe, members)
+                self._add_tokens(pipe, members, payloads)
+                self._bump_versions(pipe, members)
+            pipe.zrem(legacy_key, *ids)
+            yield pipe
+            migrated += len(members)
+        return migrated
+
+    def migrate_score_layout(self, legacy_sorted_key="sorted_events", batch_size=1000):
+        """
+        Move the events indexed in the legacy float score ZSET (`<prefix>:sorted_events`, scored with
+        `int(timestamp) + id * 1e-6`) to the lexicographic layout, rewriting the "at" field of their hashes (or, in
+        embedded mode, moving their payloads to the members and replacing them with index fields). Each batch is
+        moved in a single transaction, so the migration can be interrupted and run again. Writers using the legacy
+        layout must be stopped first. Returns the number of migrated events.
+        """
+        return self._run(self._migrate_score_layout_steps(legacy_sorted_key, batch_size))
+
+    def _drop_partition_pipeline(self, day, members, payloads):
+        # with search, the payloads are needed to find the token ZSETs of the members, they are read from the
+        # embedded members
+        pipe = self.redis.pipeline(transaction=False)
+        self._remove_tokens(pipe, members, [member[40:] for member in members] if self.embedded else payloads)
+        if self.embedded:
+            index = {}
+            for member in members:
+                index.setdefault(self._index_key(member[19:39]), []).append(self._index_field(member[19:39]))
+            for key, fields in index.items():
+                pipe.hdel(key, *fields)
+        else:
+            for batch in chunked(members, 1000):
+                pipe.unlink(*(self._hash_key(int(member[19:39])) for member in batch))
+        pipe.unlink(f"{self.sorted_key}:{day}")
+        pipe.zrem(self.partitions_key, day)
+        pipe.hincrby(self.versions_key, day, 1)
+        return pipe
+
+    def _drop_partitions_steps(self, before: datetime):
+        # the days that end before `before`, one at a time
+        days = (yield self._command("zrangebyscore", self.partitions_key, "-inf",
+                                    f"({self._day(self._timestamp(before))}"))[0]
+        for day in days:
+            members = (yield self._command("zrange", f"{self.sorted_key}:{day}", 0, -1))[0]
+            payloads = None if self.embedded or not self.search else (yield self._payloads_pipeline(members))
+            yield self._drop_partition_pipeline(day, members, payloads)
+        return len(days)
+
+    def drop_partitions(self, before: datetime):
+        """
+        Retention of a partitioned store: delete every daily partition that ends before `before`, along with the
+        hashes of its events and their token ZSET members. Returns the number of dropped partitions.
+        """
+        return self._run(self._drop_partitions_steps(before))
+
+    def _to_change(self, position: str, fields: dict):
+
+        event_id = int(fields["id"])
+        event = None if fields["op"] == "delete" else self._to_event(event_id, fields)
+        return EventChange(position=position, op=fields["op"], id=event_id, event=event)
+
+    def _last_change(self):
+        # the blocking reads of the sync client run in a thread, so that subscribe() doesn't block the event loop
+        return asyncio.to_thread(self.redis.xrevrange, self.changes_key, count=1)
+
+    def _read_changes(self, position: str):
+
+        return asyncio.to_thread(self.redis.xread, {self.changes_key: position}, count=CHANGES_PER_READ,
+                                 block=CHANGES_BLOCK_MS)
+
+    async def subscribe(self, start: str = None):
+        # positions are the ids of the stream entries
+        if start is None:
+            last = await self._last_change()
+            start = last[0][0] if last else "0-0"
+        while True:
+            for _, entries in await self._read_changes(start):
+                for position, fields in entries:
+                    start = position
+                    yield self._to_change(position, fields)
+
+
+class AsyncRedisDatetimeEventStore(RedisDatetimeEventStore):
+
+    # Same layout, API and cursors as RedisDatetimeEventStore, on top of a redis.asyncio client
+    # (built with a bounded ConnectionPool), so that Redis round trips no longer block the event loop.
+
+    @classmethod
+    def from_url(cls, url="redis://localhost:6379/0", max_connections=50, pool_timeout=5.0, count_round_trips=False,
+                 **kwargs):
+
+        pool = redis.asyncio.BlockingConnectionPool.from_url(
+            url, decode_responses=True, max_connections=max_connections, timeout=pool_timeout,
+            connection_class=AsyncCountingConnection if count_round_trips else redis.asyncio.Connection)
+        return cls(redis.asyncio.Redis(connection_pool=pool), **kwargs)
+
+    async def clear(self):
+        await clear_async_redis_by_prefix(self.redis, self.prefix)
+        await self.redis.hset(self.versions_key, "epoch", uuid.uuid4().hex[:16])
+
+    async def gen_new_id(self):
+
+        return await self.redis.incr(self.id_key)
+
+    async def get_event(self, event_id: int):
+        return self._fetched_event(event_id, await self._fetch_event(event_id))
+
+    async def _run(self, steps):
+
+        results = None
+        while True:
+            try:
+                pipe = steps.send(results)
+            except StopIteration as stop:
+                return stop.value
+            results = await pipe.execute()
+
+    async def store_event(self, at: datetime, data: str):
+
+        return await self._run(self._store_event_steps(at, data))
+
+    async def reserve_ids(self, n: int):
+
+        return self._reserved_ids(n, await self.redis.incrby(self.id_key, n))
+
+    async def store_events_many(self, events, batch_size=1000, ids=None):
+
+        return await self._run(self._store_events_many_steps(events, batch_size, ids))
+
+    async def delete_event(self, event_id: int):
+        await self._run_delete_script(event_id)
+
+    async def update_event(self, event_id: int, at: datetime = None, data: str = None):
+
+        return self._updated_event(event_id, await self._run_update_script(event_id, at, data))
+
+    async def seek_cursor(self, start_date: datetime = None, end_date: datetime = None, offset=0, desc=False):
+
+        return await self._run(self._seek_cursor_steps(start_date, end_date, offset, desc))
+
+    async def get_events(self, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None,
+                         desc=False, raw=False, query: str = None):
+
+        return await self._run(self._get_events_steps(start_date, end_date, cursor, limit, desc, raw, query))
+
+    async def count_events(self, start_date: datetime = None, end_date: datetime = None):
+
+        return await self._run(self._count_events_steps(start_date, end_date))
+
+    async def range_version(self, start_date: datetime = None, end_date: datetime = None):
+
+        epoch, total = await self._run_version_script(start_date, end_date)
+        return f"{epoch}-{total}"
+
+    async def histogram(self, start_date: datetime, end_date: datetime, bucket="hour"):
+        buckets = time_buckets(start_date, end_date, bucket)
+        return self._histogram(buckets, await self._histogram_pipeline(buckets).execute())
+
+    async def migrate_score_layout(self, legacy_sorted_key="sorted_events", batch_size=1000):
+
+        return await self._run(self._migrate_score_layout_steps(legacy_sorted_key, batch_size))
+
+    def _last_change(self):
+        return self.redis.xrevrange(self.changes_key, count=1)
+
+    def _read_changes(self, position: str):
+
+        return self.redis.xread({self.changes_key: position}, count=CHANGES_PER_READ, block=CHANGES_BLOCK_MS)
+
+    async def drop_partitions(self, before: datetime):
+
+        return await self._run(self._drop_partitions_steps(before))
@@ -0,0 +1,46 @@
+from importlib.metadata import EntryPoint, entry_points
+
+# Engines by name, as "module:factory" entry points: the module of an engine, and the driver it imports, are only
+# imported when the engine is loaded. Other packages add engines to the ENTRY_POINT_GROUP group of their metadata,
+# e.g. in pyproject.toml:
+#     [project.entry-points."datetime_event_store.engines"]
+#     cassandra = "my_package.engine:CassandraDatetimeEventStore"
+# A factory is called with the engine's options as keyword arguments and returns the store.
+ENTRY_POINT_GROUP = "datetime_event_store.engines"
+
+BUILTIN_ENGINES = {
+    "memory": "datetime_event_store.memory:DatetimeEventStore",
+    "persistent": "datetime_event_store.persistence:PersistentDatetimeEventStore",
+    "columnar": "datetime_event_store.columnar:ColumnarDatetimeEventStore",
+    "sharded": "datetime_event_store.sharded:ShardedDatetimeEventStore",
+    "redis": "datetime_event_store.redis_store:AsyncRedisDatetimeEventStore.from_url",
+    "redis_sync": "datetime_event_store.redis_store:RedisDatetimeEventStore.from_url",
+    "mongo": "datetime_event_store.mongodb_store:MongoDBDatetimeEventStore",
+}
+
+
+def _entry_points():
+    # the built-in engines can't be replaced
+    engines = {name: EntryPoint(name, value, ENTRY_POINT_GROUP) for name, value in BUILTIN_ENGINES.items()}
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        engines.setdefault(entry_point.name, entry_point)
+    return engines
+
+
+def engine_names():
+    return sorted(_entry_points())
+
+
+def load_engine(name: str):
+    """
+    Factory of the engine `name`, importing its module. Raise ValueError if there is no such engine.
+    """
+    engines = _entry_points()
+    if name not in engines:
+        raise ValueError(f"unknown engine {name!r}, one of {', '.join(sorted(engines))}")
+    return engines[name].load()
+
+
+def create_engine(name: str, **options):
+
+    return load_engine(name)(**options)
@@ -0,0 +1,209 @@
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+from heapq import merge
+from itertools import count, islice
+
+from .feed import ChangeFeed
+from .memory import DatetimeEventStore
+from .models import Event, EventRow
+from .utils import iter_events_by_cursor, time_buckets
+
+# threads only scan shards in parallel on free-threaded builds, with the GIL they would just take turns
+FREE_THREADED = not getattr(sys, "_is_gil_enabled", lambda: True)()
+
+
+class ShardedDatetimeEventStore:
+
+    # Same API and cursors as DatetimeEventStore, safe to use from any number of threads: events are spread by id
+    # over `shards` DatetimeEventStore, each guarded by its own lock, so writes to different shards don't wait for
+    # each other. get_events reads at most `limit` (at, id) keys from every shard, merges them with a heap and only
+    # builds the events of the page.
+    # With `workers` threads (by default one per shard on free-threaded builds, none otherwise) the shards of a
+    # query are read in parallel. `search` builds the token index of every shard (see DatetimeEventStore).
+
+    def __init__(self, shards=8, initial_id=1, workers=None, search=False):
+
+        self.shards = [DatetimeEventStore(search=search) for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._id_gen = count(start=initial_id)
+        self._id_lock = threading.Lock()
+        workers = (shards if FREE_THREADED else 0) if workers is None else workers
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="shard") if workers else None
+        # created by the first subscriber, writes don't publish anything before
+        self.changes = None
+        self._epoch = uuid.uuid4().hex[:16]
+
+    def clear(self):
+        with ExitStack() as locks:
+            for lock in self._locks:
+                locks.enter_context(lock)
+            for shard in self.shards:
+                shard.clear()
+            self._epoch = uuid.uuid4().hex[:16]
+        with self._id_lock:
+            self._id_gen = count(start=1)  # reset IDs
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def gen_new_id(self):
+
+        with self._id_lock:
+            return next(self._id_gen)
+
+    def reserve_ids(self, n: int):
+
+        with self._id_lock:
+            return list(islice(self._id_gen, n))
+
+    def _shard(self, event_id: int):
+
+        return int(event_id) % len(self.shards)
+
+    def _on_shards(self, func):
+        # func(shard) for every shard, under its lock
+        def locked(index):
+            with self._locks[index]:
+                return func(self.shards[index])
+
+        if self._executor is None:
+            return [locked(index) for index in range(len(self.shards))]
+        return list(self._executor.map(locked, range(len(self.shards))))
+
+    def _publish(self, op: str, event_id, event=None):
+
+        if self.changes is not None:
+            self.changes.publish(op, event_id, event)
+
+    def subscribe(self, start: str = None, maxsize: int = None):
+        if self.changes is None:
+            self.changes = ChangeFeed()
+        return self.changes.subscribe(start, maxsize=maxsize)
+
+    def get_event(self, event_id: int, factory=Event):
+
+        event_id = int(event_id)  # the API passes ids as strings
+        index = self._shard(event_id)
+        with self._locks[index]:
+            return self.shards[index].get_event(event_id, factory)
+
+    def store_event(self, at: datetime, data: str):
+
+        return self.store_events_many([(at, data)])[0]
+
+    def store_events_many(self, events, ids=None):
+        # `ids` come from reserve_ids, one per event
+        events = list(events)
+        ids = self.reserve_ids(len(events)) if ids is None else [int(event_id) for event_id in ids]
+        by_shard = {}
+        for event_id, (at, data) in zip(ids, events):
+            by_shard.setdefault(self._shard(event_id), []).append((event_id, at, data))
+        created = {}
+        for index, shard_events in by_shard.items():
+            shard = self.shards[index]
+            with self._locks[index]:
+                for event_id, at, data in shard_events:
+                    shard._put(event_id, at, data)
+                    created[event_id] = shard.get_event(event_id)
+                shard.versions.bump(*(created[event_id].at for event_id, _, _ in shard_events))
+        for event_id in ids:
+            self._publish("store", event_id, created[event_id])
+        return [created[event_id] for event_id in ids]
+
+    def update_event(self, event_id: int, at: datetime = None, data: str = None):
+
+        event_id = int(event_id)
+        index = self._shard(event_id)
+        with self._locks[index]:
+            event = self.shards[index].update_event(event_id, at, data)
+        self._publish("update", event_id, event)
+        return event
+
+    def delete_event(self, event_id):
+
+        event_id = int(event_id)
+        index = self._shard(event_id)
+        with self._locks[index]:
+            self.shards[index].delete_event(event_id)
+        self._publish("delete", event_id)
+
+    encode_cursor = staticmethod(DatetimeEventStore.encode_cursor)
+    decode_cursor = staticmethod(DatetimeEventStore.decode_cursor)
+
+    def iter_events(self, start_date: datetime = None, end_date: datetime = None, desc=False, batch_size=1000,
+                    raw=False):
+
+        return iter_events_by_cursor(self.get_events, start_date, end_date, desc, batch_size, raw)
+
+    def count_events(self, start_date: datetime = None, end_date: datetime = None):
+
+        return sum(self._on_shards(lambda shard: shard.count_events(start_date, end_date)))
+
+    def seek_cursor(self, start_date: datetime = None, end_date: datetime = None, offset=0, desc=False):
+        """
+        Cursor of the page starting `offset` events into the range (None for the first page): the event before the
+        page is the one with a known number of events of the range before it, in every shard, found by bisecting
+        the shards one after the other.
+        """
+        with ExitStack() as locks:
+            for lock in self._locks:
+                locks.enter_context(lock)
+            bounds = [shard._bounds(start_date, end_date) for shard in self.shards]
+            total = sum(hi - lo for lo, hi in bounds)
+            offset = min(offset, total)
+            if offset <= 0:
+                return None
+            rank = total - offset if desc else offset - 1
+
+            def rank_of(score):
+                return sum(shard.sorted_store.bisect_left(score) - lo for shard, (lo, _) in zip(self.shards, bounds))
+
+            for shard, (lo, hi) in zip(self.shards, bounds):
+                scores = shard.sorted_store.keys()
+                while lo < hi:
+                    middle = (lo + hi) // 2
+                    if rank_of(scores[middle]) < rank:
+                        lo = middle + 1
+                    else:
+                        hi = middle
+                if lo < len(scores) and rank_of(scores[lo]) == rank:
+                    return self.encode_cursor(scores[lo])
+
+    def range_version(self, start_date: datetime = None, end_date: datetime = None):
+        # the shards count the writes of their events
+        with ExitStack() as locks:
+            for lock in self._locks:
+                locks.enter_context(lock)
+            return f"{self._epoch}-{sum(shard.versions.total(start_date, end_date) for shard in self.shards)}"
+
+    def histogram(self, start_date: datetime, end_date: datetime, bucket="hour"):
+
+        return [
+            {"at": at, "count": count} for at, lower, upper in time_buckets(start_date, end_date, bucket)
+            if (count := self.count_events(lower, upper))
+        ]
+
+    def get_events(self, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None, desc=False,
+                   raw=False, query: str = None):
+
+        factory = EventRow if raw else Event
+
+        def scan(shard):
+            # every shard decodes the cursor itself, they share its format, and filters with its own token index;
+            # the payloads are read under the lock but the events are only built for the merged page
+            return [(score, shard.events_by_id[score[1]]["data"])
+                    for score in shard._scores(start_date, end_date, cursor, limit, desc, query)]
+
+        rows = list(islice(merge(*self._on_shards(scan), reverse=desc), limit))
+        events = [factory(id=event_id, at=at, data=data) for (at, event_id), data in rows]
+        if limit:
+            return {
+                "events": events,
+                "next_cursor": self.encode_cursor(rows[-1][0]) if len(events) == limit else None
+            }
+        return events
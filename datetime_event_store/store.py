@@ -1,308 +1,37 @@
-import base64
-import json
-from datetime import datetime, timezone
-from itertools import count, islice
-from typing import Optional
-
-from bson import ObjectId
-from dateutil.parser import isoparse
-from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ASCENDING, DESCENDING
-from sortedcontainers import SortedDict
-
-from .models import DatetimeEventScore, Event
-from .utils import clear_redis_by_prefix, convert_to_utc
-
-
-class DatetimeEventStore:
-
-    def __init__(self, initial_id=1):
-
-        self._id_gen = count(start=initial_id)
-        self.sorted_store = SortedDict()
-        self.events_by_id = {}
-
-    def clear(self):
-        self.sorted_store.clear()
-        self.events_by_id.clear()
-        self._id_gen = count(start=1)  # reset IDs
-
-    def gen_new_id(self):
-
-        return next(self._id_gen)
-
-    def compute_event_score(self, event_id):
-
-        return self.events_by_id[event_id]["at"], event_id
-
-    def get_event(self, event_id: int):
-        return Event(**{**self.events_by_id[event_id], "id": event_id})
-
-    def store_event(self, at: datetime, data: str):
-
-        event_id = self.gen_new_id()
-        self.sorted_store[DatetimeEventScore(convert_to_utc(at), event_id)] = event_id
-        self.events_by_id[event_id] = {"at": convert_to_utc(at), "data": data}
-        return self.get_event(event_id)
-
-    def update_event(self, event_id: int, at: datetime = None, data: str = None):
-        old_score = self.compute_event_score(event_id)
-        self.events_by_id[event_id].update({
-            **({} if data is None else {"data": data}),
-            **({} if at is None else {"at": convert_to_utc(at)})
-        })
-        new_score = self.compute_event_score(event_id)
-        if old_score != new_score:
-            del self.sorted_store[old_score]
-            self.sorted_store[new_score] = event_id
-        return self.get_event(event_id)
-
-    def delete_event(self, event_id):
-
-        del self.sorted_store[self.compute_event_score(event_id)]
-        del self.events_by_id[event_id]
-
-    def encode_cursor(self, cursor: tuple):
-        return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
-
-    def decode_cursor(self, encoded: str):
-
-        cursor_date, cursor_id = tuple(json.loads(base64.urlsafe_b64decode(encoded).decode()))
-        return isoparse(cursor_date), cursor_id
-
-    def get_events(self, start_date: datetime = None, end_date: datetime = None, cursor=None, limit=None, desc=False):
-
-        start = DatetimeEventScore(convert_to_utc(start_date), 0) if start_date else None
-        end = DatetimeEventScore(convert_to_utc(end_date), float('inf')) if end_date else None
-
-        if cursor:
-            if desc:
-                end = self.decode_cursor(cursor)
-            else:
-                start = self.decode_cursor(cursor)
-
-        raw_events = list(islice(
-            self.sorted_store.irange(start, end, inclusive=((not cursor) or desc, not (cursor and desc)), reverse=desc),
-            limit))
-        if limit:
-            return {
-                "events": [self.get_event(store_event[1]) for store_event in raw_events],
-                "next_cursor": self.encode_cursor(
-                    (raw_events[-1][0].isoformat(), raw_events[-1][1])
-                ) if len(raw_events) == limit else None
-            }
-
-        return [self.get_event(store_event[1]) for store_event in raw_events]
-
-
-class RedisDatetimeEventStore:
-
-    # We intentionally discard microseconds from the datetime to reserve the
-    # decimal part of the float score in the Redis ZSET.
-    # This allows us to encode a unique event identifier (e.g., event_id * 1e-6)
-    # into the score, ensuring total ordering even for events with the same second.
-    # As a trade-off, microsecond precision is lost.
-    truncate_microseconds = True
-
-    # In this implementation, we encode the event ID as a fractional part of the Redis ZSET score
-    # using `score = int(dt.timestamp()) + event_id * 1e-6`.
-    # This limits the number of events we can generate to 999,999,
-    # since only 6 decimal digits are available in the fractional part.
-    # Note: this limit applies to the total number of events created (not concurrently),
-    # and assumes event_id is an increasing integer less than 1,000,000.
-
-    def __init__(self, redis_client, sorted_key="sorted_events", hash_prefix="event:", prefix="events"):
-
-        self.redis = redis_client
-        self.prefix = prefix
-        self.sorted_key = f"{prefix}:{sorted_key}"
-        self.hash_prefix = f"{prefix}:{hash_prefix}"
-        self.id_key = f"{prefix}:next_id"
-
-    def clear(self):
-        clear_redis_by_prefix(self.redis, self.prefix)
-
-    def gen_new_id(self):
-
-        return self.redis.incr(self.id_key)
-
-    def _hash_key(self, event_id: int):
-
-        return f"{self.hash_prefix}{event_id}"
-
-    def get_event(self, event_id: int):
-        raw_event = self.redis.hgetall(self._hash_key(event_id))
-        raw_event["at"] = isoparse(raw_event["at"])
-        return Event(**{**raw_event, "id": event_id})
-
-    def compute_event_score(self, event_id):
-
-        return self._timestamp_to_score(datetime.fromisoformat(self.redis.hgetall(self._hash_key(event_id))["at"]),
-                                        event_id)
-
-    @staticmethod
-    def _timestamp_to_score(dt: datetime, event_id: int):
-        # we can only filter by seconds and we are limited to 999999 items
-        return int(dt.timestamp()) + event_id * 1e-6
-
-    def store_event(self, at: datetime, data: str):
-
-        event_id = self.gen_new_id()
-        pipe = self.redis.pipeline()
-        pipe.zadd(self.sorted_key, {event_id: self._timestamp_to_score(convert_to_utc(at, truncate_ms=True), event_id)})
-        pipe.hset(
-            self._hash_key(event_id),
-            mapping={
-                "at": convert_to_utc(
-                    at,
-                    truncate_ms=True).isoformat(),
-                "data": data})
-        pipe.execute()
-        return self.get_event(event_id)
-
-    def delete_event(self, event_id: int):
-        pipe = self.redis.pipeline()
-        pipe.zrem(self.sorted_key, event_id)
-        pipe.delete(self._hash_key(event_id))
-        pipe.execute()
-
-    def update_event(self, event_id: int, at: datetime = None, data: str = None):
-
-        pipe = self.redis.pipeline()
-        old_score = self.compute_event_score(event_id)
-        pipe.hset(self._hash_key(event_id), mapping={
-            **({} if data is None else {"data": data}),
-            **({} if at is None else {"at": convert_to_utc(at, truncate_ms=True).isoformat()})
-        })
-        new_score = self.compute_event_score(event_id)
-        if old_score != new_score:
-            pipe.zrem(self.sorted_key, event_id)
-            pipe.zadd(self.sorted_key, {event_id: new_score})
-
-        pipe.execute()
-        return self.get_event(event_id)
-
-    def get_events(self, start_date: datetime = None, end_date: datetime = None, cursor_score=None, limit=None,
-                   desc=False):
-
-        if desc:
-            max_score = cursor_score or (int(end_date.timestamp()) + 999999 * 1e-6 if end_date else "+inf")
-            min_score = int(start_date.timestamp()) if start_date else "-inf"
-            ids = self.redis.zrevrangebyscore(self.sorted_key, max_score, min_score, 0 if limit else None,
-                                              limit or None)
-        else:
-            min_score = cursor_score or (int(start_date.timestamp()) if start_date else "-inf")
-            max_score = int(end_date.timestamp()) + 999999 * 1e-6 if end_date else "+inf"
-            ids = self.redis.zrangebyscore(self.sorted_key, min_score, max_score, 0 if limit else None, limit or None)
-
-        if limit:
-            return {
-                "events": [self.get_event(int(event_id)) for event_id in ids],
-                "next_cursor": f"({self.redis.zscore(self.sorted_key, int(ids[-1]))}" if len(ids) == limit else None
-            }
-
-        return [self.get_event(int(event_id)) for event_id in ids]
-
-
-class MongoDBDatetimeEventStore:
-
-    # Note: MongoDB only supports datetime precision up to milliseconds.
-    # Any microseconds in the datetime will be truncated or rounded when stored.
-    # It's recommended to normalize timestamps to milliseconds before saving,
-    # to avoid subtle inconsistencies.
-    truncate_microseconds = True
-
-    def __init__(self, mongo_url: str, db_name: str, collection_name: str = "events"):
-
-        self.client = AsyncIOMotorClient(mongo_url)
-        self.collection = self.client[db_name][collection_name]
-
-    async def clear(self):
-
-        await self.collection.drop()
-        await self.setup()
-
-    async def setup(self):
-
-        await self.collection.create_index([("at", DESCENDING), ("_id", DESCENDING)])
-        await self.collection.create_index([("at", ASCENDING), ("_id", ASCENDING)])
-        await self.collection.create_index([("at", ASCENDING)])
-        await self.collection.create_index([("at", DESCENDING)])
-
-    async def store_event(self, at: datetime, data: str):
-        event = {"at": convert_to_utc(at, truncate_ms=True), "data": data}
-        result = await self.collection.insert_one(event)
-        return Event(**{**event, "id": str(result.inserted_id)})
-
-    async def get_event(self, event_id: str):
-        doc = await self.collection.find_one({"_id": ObjectId(event_id)})
-        return self.doc_to_event(doc)
-
-    async def update_event(self, event_id: str, at: Optional[datetime] = None, data: Optional[str] = None):
-        await self.collection.update_one(
-            {"_id": ObjectId(event_id)},
-            {
-                "$set": {
-                    **({} if data is None else {"data": data}),
-                    **({} if at is None else {"at": convert_to_utc(at, truncate_ms=True)})
-                }
-            })
-        return await self.get_event(event_id)
-
-    async def delete_event(self, event_id: str):
-        await self.collection.delete_one({"_id": ObjectId(event_id)})
-
-    @staticmethod
-    def doc_to_event(doc):
-        return Event(**{"id": str(doc["_id"]), "at": doc["at"].replace(tzinfo=timezone.utc), "data": doc["data"]})
-
-    @staticmethod
-    def encode_cursor(event) -> str:
-        return base64.urlsafe_b64encode(
-            json.dumps({"at": event["at"].isoformat(), "id": str(event["_id"])}).encode()).decode()
-
-    @staticmethod
-    def decode_cursor(cursor: str):
-        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
-        return datetime.fromisoformat(payload["at"]), ObjectId(payload["id"])
-
-    async def get_events(self,
-                         start_date: datetime = None,
-                         end_date: datetime = None,
-                         cursor: str = None,
-                         limit: int = None,
-                         desc: bool = False,
-                         ):
-
-        conditions = []
-        if start_date or end_date:
-            at_conditions = {}
-            if start_date:
-                at_conditions["$gte"] = start_date
-            if end_date:
-                at_conditions["$lte"] = end_date
-            conditions.append({"at": at_conditions})
-
-        if cursor:
-            ts, oid = self.decode_cursor(cursor)
-            conditions.append({"$or": [
-                {"at": {"$lt": ts} if desc else {"$gt": ts}},
-                {
-                    "at": ts,
-                    "_id": {"$gt": oid}
-                }
-            ]})
-
-        sort = DESCENDING if desc else ASCENDING
-        query = self.collection.find(
-            {"$and": conditions} if conditions else None
-        ).sort([("at", sort), ("_id", sort)])
-        if limit:
-            events = await query.limit(limit).to_list(length=limit)
-            return {
-                "events": [self.doc_to_event(doc) for doc in events],
-                "next_cursor": self.encode_cursor(events[-1]) if len(events) == limit else None
-            }
-
-        events = await query.to_list()
-        return [self.doc_to_event(doc) for doc in events]
+from importlib import import_module
+
+# The engines live in one module per backend, so that importing one doesn't import the drivers of the others:
+# memory (DatetimeEventStore), redis_store and mongodb_store. The names this module used to define are still
+# importable from here, the module of a name being imported the first time it is looked up.
+_MODULES = {
+    "DatetimeEventStore": ".memory",
+    **dict.fromkeys([
+        "RedisDatetimeEventStore",
+        "AsyncRedisDatetimeEventStore",
+        "SECONDS_PER_DAY",
+        "PARTITIONS_PER_ROUND_TRIP",
+        "CHANGES_PER_READ",
+        "CHANGES_BLOCK_MS",
+        "REDIS_TIMELINE_FUNCTION",
+        "REDIS_PUBLISH_FUNCTION",
+        "REDIS_TOKENS_FUNCTION",
+        "REDIS_WRITE_FUNCTIONS",
+        "REDIS_UPDATE_SCRIPT",
+        "REDIS_DELETE_SCRIPT",
+        "REDIS_FIND_FUNCTION",
+        "REDIS_EMBEDDED_GET_SCRIPT",
+        "REDIS_EMBEDDED_UPDATE_SCRIPT",
+        "REDIS_EMBEDDED_DELETE_SCRIPT",
+        "INDEX_BUCKET_SIZE",
+    ], ".redis_store"),
+    "MongoDBDatetimeEventStore": ".mongodb_store",
+    "MONGO_LEGACY_INDEXES": ".mongodb_store",
+    "EVENT_PROJECTION": ".mongodb_store",
+}
+
+
+def __getattr__(name):
+
+    if name in _MODULES:
+        return getattr(import_module(_MODULES[name], __package__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
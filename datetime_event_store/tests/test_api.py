@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+import main
+from datetime_event_store import CachedDatetimeEventStore, DatetimeEventStore
+from datetime_event_store.cursor import pack_cursor
+
+
+@pytest.mark.asyncio
+async def test_conditional_get(monkeypatch):
+    store = DatetimeEventStore()
+    monkeypatch.setattr(main, "event_store", store)
+    day = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    first = store.store_event(day, "first")
+    store.store_events_many([(day + timedelta(hours=i), str(i)) for i in range(1, 4)])
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        page = await client.get("/events/", params={"pageSize": 2})
+        etag = page.headers["ETag"]
+        assert page.headers["Cache-Control"] == "no-cache"
+        cached = await client.get("/events/", params={"pageSize": 2}, headers={"If-None-Match": f'"x", W/{etag}'})
+        assert cached.status_code == 304 and cached.content == b"" and cached.headers["ETag"] == etag
+
+        # every page has its own tag, the next one isn't changed by writes before its cursor's day
+        next_page = {"pageSize": 2, "cursor": page.json()["next_cursor"]}
+        next_etag = (await client.get("/events/", params=next_page)).headers["ETag"]
+        assert next_etag != etag
+        store.store_event(day - timedelta(days=1), "before")
+        first_page = await client.get("/events/", params={"pageSize": 2}, headers={"If-None-Match": etag})
+        assert first_page.status_code == 200
+        assert (await client.get("/events/", params=next_page, headers={"If-None-Match": next_etag})).status_code == 304
+
+        # a cursor out of the range of datetime is a bad request, whatever the order
+        for order in ("asc", "desc"):
+            for timestamp in (-1, 2 ** 63 - 1):
+                response = await client.get("/events/", params={"cursor": pack_cursor(timestamp, 1), "order": order})
+                assert response.status_code == 400, (order, timestamp)
+
+        # an event has the version of the whole store
+        event_etag = (await client.get(f"/events/{first.id}")).headers["ETag"]
+        assert (await client.get(f"/events/{first.id}", headers={"If-None-Match": "*"})).status_code == 304
+        store.update_event(first.id, data="updated")
+        event = await client.get(f"/events/{first.id}", headers={"If-None-Match": event_etag})
+        assert event.status_code == 200 and event.json()["data"] == "updated"
+
+
+@pytest.mark.asyncio
+async def test_conditional_get_cached(monkeypatch):
+    # another process writes to the backend of the cache: the new tag comes with the new page, never a stale one
+    backend = DatetimeEventStore()
+    monkeypatch.setattr(main, "event_store", CachedDatetimeEventStore(backend))
+    day = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    backend.store_event(day, "first")
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        page = await client.get("/events/", params={"pageSize": 10})
+        assert [event["data"] for event in page.json()["events"]] == ["first"]
+        backend.store_event(day + timedelta(hours=1), "second")
+        fresh = await client.get("/events/", params={"pageSize": 10}, headers={"If-None-Match": page.headers["ETag"]})
+        assert fresh.status_code == 200 and fresh.headers["ETag"] != page.headers["ETag"]
+        assert [event["data"] for event in fresh.json()["events"]] == ["first", "second"]
+        cached = await client.get("/events/", params={"pageSize": 10}, headers={"If-None-Match": fresh.headers["ETag"]})
+        assert cached.status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_bad_requests(monkeypatch):
+    # the client gets the parameter it got wrong, not the message of whatever failed on it
+    monkeypatch.setattr(main, "event_store", DatetimeEventStore())
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        assert (await client.get("/events/", params={"pageSize": -1})).status_code == 422
+        for params, detail in (({"cursor": "not a cursor"}, "invalid cursor"),
+                               ({"start": "yesterday"}, "invalid date for start"),
+                               ({"at": "2025-13-01"}, "invalid date for at")):
+            response = await client.get("/events/", params=params)
+            assert response.status_code == 400 and response.json() == {"detail": detail}, params
+        stats = await client.get("/events/stats", params={"end": "tomorrow"})
+        assert stats.status_code == 400 and stats.json() == {"detail": "invalid date for end"}
+        update = {"at": "2025-01-01T00:00:00Z", "data": "updated"}
+        for response in (await client.get("/events/1"), await client.put("/events/1", json=update)):
+            assert response.status_code == 404 and response.json() == {"detail": "event not found"}
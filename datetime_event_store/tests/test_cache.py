@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from datetime_event_store import CachedDatetimeEventStore, DatetimeEventStore
+
+
+@pytest.fixture
+def cached_store():
+    return CachedDatetimeEventStore(DatetimeEventStore())
+
+
+@pytest.fixture
+def day():
+    return datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.mark.asyncio
+async def test_cache_hits(cached_store, day):
+    event = await cached_store.store_event(day, "1")
+    assert await cached_store.get_event(event.id) == event
+    assert await cached_store.get_event(event.id) == event
+    assert cached_store.stats()["events"]["hits"] == 1
+
+    page = await cached_store.get_events(day, day + timedelta(hours=1), None, 10)
+    assert await cached_store.get_events(day, day + timedelta(hours=1), None, 10) is page
+    assert cached_store.stats()["pages"] == {"hits": 1, "misses": 1, "size": 1}
+
+
+@pytest.mark.asyncio
+async def test_cache_invalidation(cached_store, day):
+    first = await cached_store.store_event(day, "first")
+    await cached_store.store_event(day + timedelta(hours=1), "second")
+    first_hour = await cached_store.get_events(day, day + timedelta(minutes=59))
+    next_day = await cached_store.get_events(day + timedelta(days=1), day + timedelta(days=2))
+    first_page = await cached_store.get_events(None, None, None, 1)
+
+    # outside of every cached range but the open ended page, which is full and ends with `first`
+    await cached_store.store_event(day + timedelta(days=3), "later")
+    assert await cached_store.get_events(day, day + timedelta(minutes=59)) is first_hour
+    assert await cached_store.get_events(day + timedelta(days=1), day + timedelta(days=2)) is next_day
+    assert await cached_store.get_events(None, None, None, 1) is first_page
+
+    await cached_store.update_event(first.id, day + timedelta(days=1, hours=1), "moved")
+    assert [event.data for event in await cached_store.get_events(day, day + timedelta(minutes=59))] == []
+    assert [event.data for event in await cached_store.get_events(day + timedelta(days=1), day + timedelta(days=2))
+            ] == ["moved"]
+    assert (await cached_store.get_event(first.id)).data == "moved"
+
+    await cached_store.delete_event(first.id)
+    assert await cached_store.get_events(day + timedelta(days=1), day + timedelta(days=2)) == []
+
+
+@pytest.mark.asyncio
+async def test_cache_backend_writes(cached_store, day):
+    # written by another process, straight to the backend: the versions tell the cached results are stale
+    first = await cached_store.store_event(day, "first")
+    page = await cached_store.get_events(day, day + timedelta(hours=1))
+    assert await cached_store.get_event(first.id) == first
+    cached_store.store.store_event(day + timedelta(minutes=1), "second")
+    cached_store.store.update_event(first.id, data="updated")
+    assert [event.data for event in await cached_store.get_events(day, day + timedelta(hours=1))] == \
+        ["updated", "second"]
+    assert (await cached_store.get_event(first.id)).data == "updated"
+    assert page[0].data == "first"
@@ -1,9 +1,22 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
 import pytest
 import redis
+import redis.asyncio
+from bson import ObjectId
 
-from datetime_event_store import DatetimeEventStore, MongoDBDatetimeEventStore, RedisDatetimeEventStore
+from datetime_event_store import (
+    AsyncRedisDatetimeEventStore,
+    ColumnarDatetimeEventStore,
+    DatetimeEventStore,
+    EventRow,
+    MongoDBDatetimeEventStore,
+    RedisDatetimeEventStore,
+    ShardedDatetimeEventStore,
+)
+from datetime_event_store.cursor import MAX_TIMESTAMP, date_cursor, pack_cursor, unpack_cursor
 from datetime_event_store.utils import adapt_async, convert_to_utc
 
 
@@ -12,14 +25,76 @@ def datetime_event_store():
     return DatetimeEventStore()
 
 
+@pytest.fixture
+def columnar_datetime_event_store():
+    return ColumnarDatetimeEventStore(merge_threshold=2)
+
+
+@pytest.fixture
+def sharded_datetime_event_store():
+    return ShardedDatetimeEventStore(shards=3, workers=2)
+
+
 @pytest.fixture
 def redis_datetime_event_store():
-    return RedisDatetimeEventStore(redis.Redis(host='localhost', port=6379, db=0, decode_responses=True), prefix="test")
+    return RedisDatetimeEventStore(redis.Redis(host='localhost', port=6379, db=0, decode_responses=True), prefix="test",
+                                   search=True)
+
+
+@pytest.fixture
+def async_redis_datetime_event_store():
+    return AsyncRedisDatetimeEventStore(
+        redis.asyncio.Redis(host='localhost', port=6379, db=0, decode_responses=True), prefix="test_async", search=True)
+
+
+@pytest.fixture
+def partitioned_redis_datetime_event_store():
+    return RedisDatetimeEventStore(redis.Redis(host='localhost', port=6379, db=0, decode_responses=True),
+                                   prefix="test_partitioned", partitioned=True, search=True)
+
+
+@pytest.fixture
+def embedded_redis_datetime_event_store():
+    return RedisDatetimeEventStore(redis.Redis(host='localhost', port=6379, db=0, decode_responses=True),
+                                   prefix="test_embedded", embedded=True, search=True)
+
+
+@pytest.fixture
+def partitioned_embedded_redis_datetime_event_store():
+    return AsyncRedisDatetimeEventStore(redis.asyncio.Redis(host='localhost', port=6379, db=0, decode_responses=True),
+                                        prefix="test_partitioned_embedded", partitioned=True, embedded=True,
+                                        search=True)
 
 
 @pytest.fixture
 def mongodb_datetime_event_store():
-    return MongoDBDatetimeEventStore("mongodb://localhost:27017/", "test", "events")
+    return MongoDBDatetimeEventStore("mongodb://localhost:27017/", "test", "events", search=True)
+
+
+@pytest.fixture
+def partitioned_mongodb_datetime_event_store():
+    return MongoDBDatetimeEventStore("mongodb://localhost:27017/", "test", "partitioned_events", partitioned=True,
+                                     search=True)
+
+
+@pytest.fixture
+def event_stores(datetime_event_store, columnar_datetime_event_store, sharded_datetime_event_store,
+                 redis_datetime_event_store, async_redis_datetime_event_store, partitioned_redis_datetime_event_store,
+                 embedded_redis_datetime_event_store, partitioned_embedded_redis_datetime_event_store,
+                 mongodb_datetime_event_store, partitioned_mongodb_datetime_event_store):
+    return [datetime_event_store, columnar_datetime_event_store, sharded_datetime_event_store,
+            redis_datetime_event_store, async_redis_datetime_event_store, partitioned_redis_datetime_event_store,
+            embedded_redis_datetime_event_store, partitioned_embedded_redis_datetime_event_store,
+            mongodb_datetime_event_store, partitioned_mongodb_datetime_event_store]
+
+
+def plan_stages(plan):
+    # every stage of an explain() plan, whatever its nesting
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in plan_stages(item)]
+    if isinstance(plan, dict):
+        return ([plan["stage"]] if isinstance(plan.get("stage"), str) else []) + plan_stages(list(plan.values()))
+    return []
 
 
 @pytest.fixture
@@ -48,8 +123,8 @@ def utc_past_far(utc_now):
 
 
 @pytest.mark.asyncio
-async def test_store_event(datetime_event_store, redis_datetime_event_store, mongodb_datetime_event_store, utc_now):
-    for store in [datetime_event_store, redis_datetime_event_store, mongodb_datetime_event_store]:
+async def test_store_event(event_stores, utc_now):
+    for store in event_stores:
         event = await adapt_async(store.store_event, utc_now, "1")
         assert event.data == "1", store
         assert event.at == utc_now, store
@@ -61,25 +136,441 @@ async def test_store_event(datetime_event_store, redis_datetime_event_store, mon
 
 
 @pytest.mark.asyncio
-async def test_update_event(datetime_event_store, redis_datetime_event_store, mongodb_datetime_event_store, utc_now,
-                            utc_past):
-    for store in [datetime_event_store, redis_datetime_event_store, mongodb_datetime_event_store]:
+async def test_store_events_many(event_stores, utc_now, utc_past):
+    for store in event_stores:
+        await adapt_async(store.clear)
+        events = await adapt_async(store.store_events_many, ((utc_now, "now"), (utc_past, "past")))
+        assert [event.data for event in events] == ["now", "past"], store
+        assert [event.at for event in events] == [utc_now, utc_past], store
+        assert len({event.id for event in events}) == 2, store
+        stored = await adapt_async(store.get_event, events[1].id)
+        assert stored == events[1], store
+        assert [event.data for event in await adapt_async(store.get_events)] == ["past", "now"], store
+
+
+@pytest.mark.asyncio
+async def test_store_events_many_reserved_ids(event_stores, utc_now, utc_past):
+    for store in event_stores:
+        await adapt_async(store.clear)
+        ids = await adapt_async(store.reserve_ids, 3)
+        other = await adapt_async(store.store_event, utc_now, "other")
+        assert other.id not in ids, store
+        created = await adapt_async(store.store_events_many, [(utc_past, "a"), (utc_now, "b")], ids=ids[1:])
+        assert [event.id for event in created] == ids[1:], store
+        assert await adapt_async(store.get_event, ids[2]) == created[1], store
+        assert [event.data for event in await adapt_async(store.get_events)] == ["a", "b", "other"], store
+
+
+def test_redis_keeps_microseconds(redis_datetime_event_store, utc_now):
+    store = redis_datetime_event_store
+    store.clear()
+    later = store.store_event(utc_now + timedelta(microseconds=1), "later")
+    earlier = store.store_event(utc_now, "earlier")
+    assert store.get_event(later.id).at == utc_now + timedelta(microseconds=1)
+    assert store.get_events(utc_now, utc_now) == [earlier]
+    assert store.get_events() == [earlier, later]
+
+
+@pytest.mark.asyncio
+async def test_async_redis_concurrency(async_redis_datetime_event_store, utc_now):
+    store = async_redis_datetime_event_store
+    await store.clear()
+    events = await asyncio.gather(*(store.store_event(utc_now, str(i)) for i in range(50)))
+    assert len({event.id for event in events}) == 50
+    pages = await asyncio.gather(*(store.get_events(limit=10) for _ in range(10)))
+    assert all([event.id for event in page["events"]] == sorted(event.id for event in events)[:10] for page in pages)
+
+
+def test_redis_concurrent_updates(redis_datetime_event_store, utc_now):
+    store = redis_datetime_event_store
+    store.clear()
+    events = store.store_events_many((utc_now, "0") for _ in range(5))
+    ats = [utc_now + timedelta(seconds=seconds) for seconds in range(20)]
+
+    def update(i):
+        event = events[i % len(events)]
+        return store.update_event(event.id, ats[i % len(ats)], str(i))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert all(executor.map(update, range(400)))
+
+    # every event is still indexed exactly once, at the `at` of its hash
+    indexed = store.get_events()
+    assert sorted(event.id for event in indexed) == [event.id for event in events]
+    assert all(store.get_event(event.id) == event for event in indexed)
+    with pytest.raises(KeyError):
+        store.update_event(10 ** 6, utc_now)
+
+
+def test_sharded_threads(sharded_datetime_event_store, utc_now):
+    store = sharded_datetime_event_store
+
+    def write(i):
+        events = store.store_events_many((utc_now + timedelta(seconds=(i * 7 + j) % 50), str(i)) for j in range(20))
+        store.update_event(events[0].id, utc_now - timedelta(seconds=i))
+        store.delete_event(events[1].id)
+        return events
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        created = [event for events in executor.map(write, range(40)) for event in events]
+
+    ids = {event.id for event in created}
+    assert len(ids) == 800
+    expected = sorted(((event.at, event.id) for event in store.get_events()), reverse=True)
+    assert len(expected) == 760
+    pages, cursor = [], None
+    while True:
+        page = store.get_events(cursor=cursor, limit=33, desc=True)
+        pages += [(event.at, event.id) for event in page["events"]]
+        if not (cursor := page["next_cursor"]):
+            break
+    assert pages == expected
+    assert store.count_events() == 760
+    store.close()
+
+
+def test_redis_embedded(embedded_redis_datetime_event_store, utc_now):
+    store = embedded_redis_datetime_event_store
+    store.clear()
+    events = store.store_events_many([(utc_now, "a:b;c"), (utc_now, ""), (utc_now + timedelta(seconds=1), "é")])
+    assert [key for key in store.redis.scan_iter(f"{store.prefix}:*") if key.startswith(store.hash_prefix)] == []
+    assert store.get_event(events[0].id) == events[0]
+    page = store.get_events(limit=1)
+    assert store.get_events(cursor=page["next_cursor"], limit=5)["events"] == events[1:]
+    assert store.update_event(events[1].id, data="updated").data == "updated"
+    store.delete_event(events[0].id)
+    assert [event.data for event in store.get_events()] == ["updated", "é"]
+    # the token ZSETs hold "<timestamp>:<id>", the payloads are only in the timeline
+    member = store._member(store._timestamp(utc_now), events[1].id)
+    assert store.redis.zrange(store._token_key("updated"), 0, -1) == [member]
+    assert [event.data for event in store.get_events(query="updated é", limit=2)["events"]] == []
+    assert [event.data for event in store.get_events(query="updated", limit=2)["events"]] == ["updated"]
+    with pytest.raises(KeyError):
+        store.get_event(events[0].id)
+    with pytest.raises(KeyError):
+        store.update_event(events[0].id, utc_now)
+
+
+@pytest.mark.asyncio
+async def test_redis_migrate_score_layout(redis_datetime_event_store, async_redis_datetime_event_store,
+                                          partitioned_embedded_redis_datetime_event_store, utc_now, utc_past):
+    for store in (redis_datetime_event_store, async_redis_datetime_event_store,
+                  partitioned_embedded_redis_datetime_event_store):
+        await adapt_async(store.clear)
+        legacy = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+        for event_id, (at, data) in enumerate([(utc_now, "now"), (utc_past, "past")], start=1):
+            legacy.zadd(f"{store.prefix}:sorted_events", {event_id: int(at.timestamp()) + event_id * 1e-6})
+            legacy.hset(f"{store.hash_prefix}{event_id}", mapping={"at": at.isoformat(), "data": data})
+        legacy.set(store.id_key, 2)
+        assert await adapt_async(store.migrate_score_layout, batch_size=1) == 2, store
+        assert [(event.data, event.at) for event in await adapt_async(store.get_events)] == \
+            [("past", utc_past), ("now", utc_now)], store
+        assert (await adapt_async(store.store_event, utc_now, "new")).id == 3, store
+        assert await adapt_async(store.migrate_score_layout) == 0, store
+        if store.embedded:
+            assert not legacy.exists(f"{store.hash_prefix}1", f"{store.hash_prefix}2")
+            assert [event.data for event in await adapt_async(store.get_events, query="past")] == ["past"]
+
+
+@pytest.mark.asyncio
+async def test_partitions(partitioned_redis_datetime_event_store, partitioned_embedded_redis_datetime_event_store,
+                          partitioned_mongodb_datetime_event_store):
+    month = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    ats = [month - timedelta(days=1), month, month + timedelta(days=1, hours=12), month + timedelta(days=40)]
+    for store in (partitioned_redis_datetime_event_store, partitioned_embedded_redis_datetime_event_store,
+                  partitioned_mongodb_datetime_event_store):
+        await adapt_async(store.clear)
+        events = await adapt_async(store.store_events_many, ((at, str(i)) for i, at in enumerate(ats)))
+
+        # pages and cursors carry over from one partition to the next
+        page = await adapt_async(store.get_events, None, None, None, 3)
+        assert [event.data for event in page["events"]] == ["0", "1", "2"], store
+        page = await adapt_async(store.get_events, None, None, page["next_cursor"], 3)
+        assert [event.data for event in page["events"]] == ["3"], store
+        page = await adapt_async(store.get_events, month, None, None, 1, True)
+        page = await adapt_async(store.get_events, month, None, page["next_cursor"], 2, True)
+        assert [event.data for event in page["events"]] == ["2", "1"], store
+        assert await adapt_async(store.count_events, month, month + timedelta(days=2)) == 2, store
+        # a range without events over two partitions
+        assert await adapt_async(store.seek_cursor, month + timedelta(days=2), month + timedelta(days=39), 5) is None, \
+            store
+
+        # moved to another partition, a write of the day it leaves
+        left = await adapt_async(store.range_version, ats[0], ats[0])
+        moved = await adapt_async(store.update_event, events[0].id, month + timedelta(days=41), "moved")
+        assert await adapt_async(store.range_version, ats[0], ats[0]) != left, store
+        assert moved.at == month + timedelta(days=41), store
+        assert await adapt_async(store.get_event, events[0].id) == moved, store
+        assert [event.data for event in await adapt_async(store.get_events)] == ["1", "2", "3", "moved"], store
+
+        # the partitions of the first month (mongo) or of the first days (redis) are dropped as a whole
+        dropped = await adapt_async(store.range_version, None, month)
+        kept = await adapt_async(store.range_version, month + timedelta(days=40))
+        assert await adapt_async(store.drop_partitions, month + timedelta(days=35)) >= 1, store
+        assert [event.data for event in await adapt_async(store.get_events)] == ["3", "moved"], store
+        assert await adapt_async(store.get_events, query="2") == [], store
+        # dropped days count as writes of their range, the days kept don't
+        assert await adapt_async(store.range_version, None, month) != dropped, store
+        assert await adapt_async(store.range_version, month + timedelta(days=40)) == kept, store
+
+
+@pytest.mark.asyncio
+async def test_mongodb_get_events_uses_index(mongodb_datetime_event_store, utc_past, utc_now, utc_future):
+    store = mongodb_datetime_event_store
+    await store.clear()
+    await store.store_events_many((at, "") for at in (utc_past, utc_now, utc_now, utc_future))
+    cursor = (await store.get_events(limit=2))["next_cursor"]
+    assert list(await store.collection.index_information()) == ["_id_", "at_1__id_1", "tokens_1_at_1__id_1"]
+    for desc in (False, True):
+        for page_cursor in (None, cursor):
+            events_filter = store._events_filter(utc_past, utc_future, page_cursor, desc)
+            plan = await store._events_query(store.collection, events_filter, 10, desc).explain()
+            stages = plan_stages(plan["queryPlanner"]["winningPlan"])
+            assert "IXSCAN" in stages and "SORT" not in stages and "COLLSCAN" not in stages, (desc, stages)
+
+
+@pytest.mark.asyncio
+async def test_get_events_ties(event_stores, utc_now):
+    for store in event_stores:
+        await adapt_async(store.clear)
+        await adapt_async(store.store_events_many, ((utc_now, str(i)) for i in range(5)))
+        ascending = [event.id for event in await adapt_async(store.get_events)]
+        for desc, expected in ((False, ascending), (True, ascending[::-1])):
+            ids, cursor = [], None
+            while True:
+                page = await adapt_async(store.get_events, None, None, cursor, 2, desc)
+                ids += [event.id for event in page["events"]]
+                if not (cursor := page["next_cursor"]):
+                    break
+            assert ids == expected, (store, desc)
+
+
+@pytest.mark.asyncio
+async def test_get_events_query(event_stores, utc_past_far, utc_now):
+    payloads = ["Alpha beta", "beta", "alpha, gamma", "ALPHA beta gamma", "béta alpha", "alphabet"]
+    # the memory engines scan their payloads unless they have the token index
+    for store in [*event_stores, DatetimeEventStore(search=True), ShardedDatetimeEventStore(shards=3, search=True)]:
+        await adapt_async(store.clear)
+        created = await adapt_async(store.store_events_many,
+                                    [(utc_past_far + timedelta(hours=i % 3), data) for i, data in enumerate(payloads)])
+        for query, expected in (("alpha", {0, 2, 3, 4}), ("BETA  alpha", {0, 3}), ("gamma,alpha", {2, 3}),
+                                ("béta", {4}), ("delta", set()), ("alpha delta", set())):
+            for desc in (False, True):
+                events = await adapt_async(store.get_events, desc=desc)
+                expected_ids = [event.id for event in events if created.index(event) in expected]
+                ids, cursor = [], None
+                while True:
+                    page = await adapt_async(store.get_events, None, None, cursor, 2, desc, query=query)
+                    ids += [event.id for event in page["events"]]
+                    if not (cursor := page["next_cursor"]):
+                        break
+                assert ids == expected_ids, (store, query, desc)
+        ranged = await adapt_async(store.get_events, utc_past_far + timedelta(hours=1), utc_now, query="alpha")
+        assert {event.data for event in ranged} == {"alpha, gamma", "béta alpha"}, store
+
+        # updates and deletes are indexed too
+        await adapt_async(store.update_event, created[1].id, data="beta delta")
+        await adapt_async(store.update_event, created[0].id, at=utc_now)
+        await adapt_async(store.delete_event, created[2].id)
+        assert [event.data for event in await adapt_async(store.get_events, query="delta")] == ["beta delta"], store
+        assert [event.data for event in await adapt_async(store.get_events, query="alpha gamma")] == \
+            ["ALPHA beta gamma"], store
+        assert [event.id for event in await adapt_async(store.get_events, query="alpha", desc=True)][0] == \
+            created[0].id, store
+
+
+@pytest.mark.asyncio
+async def test_search_off(utc_now):
+    # without the token index, nothing is written for it and queries are refused
+    client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+    for store in (RedisDatetimeEventStore(client, prefix="test_no_search"),
+                  RedisDatetimeEventStore(client, prefix="test_no_search_embedded", partitioned=True, embedded=True),
+                  MongoDBDatetimeEventStore("mongodb://localhost:27017/", "test", "unsearched_events")):
+        await adapt_async(store.clear)
+        events = await adapt_async(store.store_events_many, [(utc_now, "alpha beta"), (utc_now, "gamma")])
+        await adapt_async(store.store_event, utc_now, "delta")
+        await adapt_async(store.update_event, events[0].id, utc_now + timedelta(seconds=1), "epsilon")
+        await adapt_async(store.delete_event, events[1].id)
+        assert [event.data for event in await adapt_async(store.get_events)] == ["delta", "epsilon"], store
+        with pytest.raises(ValueError):
+            await adapt_async(store.get_events, query="delta")
+        if isinstance(store, MongoDBDatetimeEventStore):
+            assert list(await store.collection.index_information()) == ["_id_", "at_1__id_1"]
+            assert not await store.collection.count_documents({"tokens": {"$exists": True}})
+        else:
+            assert not list(store.redis.scan_iter(f"{store.token_prefix}*")), store
+            assert store.drop_partitions(utc_now + timedelta(days=1)) == int(store.partitioned), store
+
+
+@pytest.mark.asyncio
+async def test_range_version(event_stores, utc_past_far, utc_now, utc_future_far):
+    for store in event_stores:
+        await adapt_async(store.clear)
+        old = await adapt_async(store.store_event, utc_past_far, "old")
+        version = await adapt_async(store.range_version, utc_now, utc_now)
+        assert await adapt_async(store.range_version, utc_now, utc_now) == version, store
+
+        # writes of other days leave a range alone, not the whole store
+        whole = await adapt_async(store.range_version)
+        await adapt_async(store.store_event, utc_past_far, "older")
+        assert await adapt_async(store.range_version, utc_now, utc_now) == version, store
+        assert await adapt_async(store.range_version) != whole, store
+
+        # stores, updates (from or to the range) and deletes within it change it
+        versions = {version}
+        new = await adapt_async(store.store_event, utc_now, "new")
+        for write, *args in ((store.update_event, old.id, utc_now), (store.update_event, new.id, None, "newer"),
+                             (store.update_event, old.id, utc_past_far), (store.delete_event, new.id),
+                             (store.store_events_many, [(utc_now, "many")])):
+            versions.add(await adapt_async(store.range_version, utc_now, utc_now))
+            await adapt_async(write, *args)
+        versions.add(await adapt_async(store.range_version, utc_now, utc_now))
+        assert len(versions) == 7, store
+
+        # a cleared store doesn't repeat the versions it had, even with the same writes
+        empty = await adapt_async(store.range_version, utc_future_far, utc_future_far)
+        await adapt_async(store.clear)
+        assert await adapt_async(store.range_version, utc_future_far, utc_future_far) != empty, store
+
+    # Redis reads a version without writing anything, even with no epoch yet
+    store = RedisDatetimeEventStore(redis.Redis(host='localhost', port=6379, db=0, decode_responses=True),
+                                    prefix="test_versions")
+    store.clear()
+    store.redis.delete(store.versions_key)
+    assert store.range_version() == store.range_version(utc_past_far, utc_now)
+    assert not store.redis.exists(store.versions_key)
+
+
+@pytest.mark.asyncio
+async def test_seek_cursor(event_stores, utc_past_far, utc_now):
+    for store in event_stores:
+        await adapt_async(store.clear)
+        # the last event is at the end of the range, the events before it may span two months
+        await adapt_async(store.store_events_many,
+                          [(utc_past_far + timedelta(days=i), str(i)) for i in range(10)] + [(utc_now, "last")])
+        start, end = utc_past_far + timedelta(days=1), utc_now
+        for desc in (False, True):
+            expected = [event.id for event in await adapt_async(store.get_events, start, end, desc=desc)]
+            for offset in (0, 1, 3, len(expected) - 1, len(expected), 50):
+                cursor = await adapt_async(store.seek_cursor, start, end, offset, desc)
+                page = await adapt_async(store.get_events, start, end, cursor, 3, desc)
+                assert [event.id for event in page["events"]] == expected[offset:offset + 3], (store, desc, offset)
+            # no event in the range
+            assert await adapt_async(store.seek_cursor, end + timedelta(seconds=1), None, 5, desc) is None, store
+
+            # a date cursor starts with the events of its instant
+            page = await adapt_async(store.get_events, None, None, date_cursor(utc_past_far + timedelta(days=3)), 20,
+                                     desc)
+            expected = ["3", "2", "1", "0"] if desc else ["3", "4", "5", "6", "7", "8", "9", "last"]
+            assert [event.data for event in page["events"]] == expected, store
+
+
+def test_cursor_format():
+    assert unpack_cursor(pack_cursor(63_000_000_000_000_000, 42)) == (63_000_000_000_000_000, 42)
+    assert len(pack_cursor(63_000_000_000_000_000, 42)) == 22
+    oid = ObjectId("65f000000000000000000001")
+    assert unpack_cursor(pack_cursor(1, oid)) == (1, oid)
+    assert unpack_cursor(date_cursor(datetime(1, 1, 1, tzinfo=timezone.utc))) == (0, None)
+    with pytest.raises(ValueError):
+        unpack_cursor("eyJhdCI6IDF9")
+    # well formed, but no datetime has these timestamps
+    for timestamp in (-1, MAX_TIMESTAMP + 1, 2 ** 63 - 1):
+        with pytest.raises(ValueError, match="out of range"):
+            unpack_cursor(pack_cursor(timestamp, 42))
+    assert unpack_cursor(pack_cursor(MAX_TIMESTAMP)) == (MAX_TIMESTAMP, None)
+
+
+@pytest.mark.asyncio
+async def test_subscribe(event_stores, utc_now, utc_past):
+    for store in event_stores:
+        if isinstance(store, MongoDBDatetimeEventStore):
+            continue  # change streams need a replica set
+        await adapt_async(store.clear)
+        subscription = store.subscribe()
+        first_change = asyncio.ensure_future(anext(subscription))
+        await asyncio.sleep(0.1)  # lets the subscription start before the writes
+        event = await adapt_async(store.store_event, utc_now, "stored")
+        await adapt_async(store.update_event, event.id, utc_past, "updated")
+        await adapt_async(store.delete_event, event.id)
+        changes = [await first_change, await anext(subscription), await anext(subscription)]
+        await subscription.aclose()
+        assert [(change.op, change.id) for change in changes] == [
+            ("store", event.id), ("update", event.id), ("delete", event.id)], store
+        assert changes[0].event == event, store
+        assert (changes[1].event.at, changes[1].event.data) == (utc_past, "updated"), store
+        assert changes[2].event is None, store
+
+
+@pytest.mark.asyncio
+async def test_get_events_raw(event_stores, utc_now, utc_past, utc_future):
+    for store in event_stores:
+        await adapt_async(store.clear)
+        stored = await adapt_async(store.store_events_many,
+                                   ((utc_now, "now"), (utc_past, "past"), (utc_future, "future")))
+        rows = await adapt_async(store.get_events, raw=True)
+        assert [(row.id, row.at, row.data) for row in rows] == [
+            (event.id, event.at, event.data) for event in (stored[1], stored[0], stored[2])], store
+        assert isinstance(rows[0], EventRow), store
+        response = await adapt_async(store.get_events, None, None, None, 2, True, raw=True)
+        assert [row.data for row in response["events"]] == ["future", "now"], store
+        response = await adapt_async(store.get_events, None, None, response["next_cursor"], 2, True, raw=True)
+        assert [row.data for row in response["events"]] == ["past"], store
+
+
+@pytest.mark.asyncio
+async def test_iter_events(event_stores, utc_past_far, utc_past, utc_now, utc_future):
+    for store in event_stores:
+        await adapt_async(store.clear)
+        await adapt_async(store.store_events_many, ((utc_now, "now"), (utc_past, "past"), (utc_future, "future"),
+                                                    (utc_past_far, "past_far")))
+        assert [event.data async for event in store.iter_events(batch_size=3)] == [
+            "past_far", "past", "now", "future"], store
+        assert [row.data async for row in store.iter_events(utc_past, utc_now, True, 1, raw=True)] == [
+            "now", "past"], store
+
+
+@pytest.mark.asyncio
+async def test_count_events_and_histogram(event_stores):
+    hour = datetime(2025, 1, 1, 10, tzinfo=timezone.utc)
+    for store in event_stores:
+        await adapt_async(store.clear)
+        await adapt_async(store.store_events_many, (
+            (hour + timedelta(minutes=minutes), str(minutes)) for minutes in (0, 5, 59, 60, 61, 185)))
+        assert await adapt_async(store.count_events) == 6, store
+        assert await adapt_async(store.count_events, hour + timedelta(minutes=5), hour + timedelta(hours=1)) == 3, store
+        histogram = await adapt_async(store.histogram, hour + timedelta(minutes=5), hour + timedelta(hours=4), "hour")
+        assert histogram == [
+            {"at": hour, "count": 2},
+            {"at": hour + timedelta(hours=1), "count": 2},
+            {"at": hour + timedelta(hours=3), "count": 1},
+        ], store
+        with pytest.raises(ValueError):
+            await adapt_async(store.histogram, hour, hour + timedelta(days=1), "fortnight")
+
+
+@pytest.mark.asyncio
+async def test_update_event(event_stores, utc_now, utc_past):
+    for store in event_stores:
         event = await adapt_async(store.store_event, utc_now, "1")
         updated_event = await adapt_async(store.update_event, event.id, utc_past, "1")
         assert updated_event.at == utc_past, store
 
 
 @pytest.mark.asyncio
-async def test_delete_event(datetime_event_store, redis_datetime_event_store, mongodb_datetime_event_store, utc_now):
-    for store in [datetime_event_store, redis_datetime_event_store, mongodb_datetime_event_store]:
+async def test_delete_event(event_stores, utc_now):
+    for store in event_stores:
         event = await adapt_async(store.store_event, utc_now, "1")
         await adapt_async(store.delete_event, event.id), store
+        # gone, for the API to answer 404
+        with pytest.raises(KeyError):
+            await adapt_async(store.get_event, event.id)
+        with pytest.raises(KeyError):
+            await adapt_async(store.update_event, event.id, utc_now)
 
 
 @pytest.mark.asyncio
-async def test_get_events(datetime_event_store, redis_datetime_event_store, mongodb_datetime_event_store, utc_past_far,
-                          utc_past, utc_now, utc_future, utc_future_far):
-    for store in [datetime_event_store, redis_datetime_event_store, mongodb_datetime_event_store]:
+async def test_get_events(event_stores, utc_past_far, utc_past, utc_now, utc_future, utc_future_far):
+    for store in event_stores:
         await adapt_async(store.clear)
         await adapt_async(store.store_event, utc_past, "past")
         await adapt_async(store.store_event, utc_past_far, "past_far")
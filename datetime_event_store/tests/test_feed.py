@@ -0,0 +1,98 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from datetime_event_store import Broadcaster, ChangeFeed, DatetimeEventStore, EventChange
+
+
+@pytest.mark.asyncio
+async def test_change_feed_resume():
+    feed = ChangeFeed(history=2)
+    first = feed.publish("store", 1)
+    second = feed.publish("update", 1)
+    third = feed.publish("delete", 1)
+
+    # replayed after a position still in the history, a reset at the last change after an unknown or forgotten one
+    subscription = feed.subscribe(second.position)
+    assert await anext(subscription) == third
+    await subscription.aclose()
+    for position in (first.position, "unknown"):
+        subscription = feed.subscribe(position, heartbeat=0.01)
+        assert await anext(subscription) == EventChange(position=third.position, op="reset", id=None)
+        assert await anext(subscription) is None
+        await subscription.aclose()
+    assert not feed.subscribers
+
+    # a reset before anything was published resumes from the start
+    feed = ChangeFeed()
+    subscription = feed.subscribe("unknown")
+    reset = await anext(subscription)
+    await subscription.aclose()
+    change = feed.publish("store", 1)
+    subscription = feed.subscribe(reset.position)
+    assert await anext(subscription) == change
+    await subscription.aclose()
+
+
+@pytest.mark.asyncio
+async def test_change_feed_overflow():
+    feed = ChangeFeed(maxsize=2)
+    subscription = feed.subscribe()
+    pending = asyncio.ensure_future(anext(subscription))
+    await asyncio.sleep(0)
+    changes = [feed.publish("store", event_id) for event_id in range(3)]
+    # the third change doesn't fit in the queue, the subscription ends after the first two
+    assert [await pending, await anext(subscription)] == changes[:2]
+    with pytest.raises(StopAsyncIteration):
+        await anext(subscription)
+    assert not feed.subscribers
+
+
+@pytest.mark.asyncio
+async def test_broadcaster_shares_one_subscription():
+    store = DatetimeEventStore()
+    broadcaster = Broadcaster(store)
+    subscriptions = [broadcaster.subscribe() for _ in range(3)]
+    pending = [asyncio.ensure_future(anext(subscription)) for subscription in subscriptions]
+    await asyncio.sleep(0.01)
+    assert len(store.changes.subscribers) == 1
+
+    event = store.store_event(datetime.now(timezone.utc), "1")
+    assert [(change.op, change.id) for change in await asyncio.gather(*pending)] == [("store", event.id)] * 3
+    for subscription in subscriptions:
+        await subscription.aclose()
+    await broadcaster.close()
+    assert not store.changes.subscribers
+
+
+@pytest.mark.asyncio
+async def test_broadcaster_burst():
+    store = DatetimeEventStore()
+    broadcaster = Broadcaster(store, history=3000, maxsize=3000)
+    subscription = broadcaster.subscribe()
+    pending = asyncio.ensure_future(anext(subscription))
+    await asyncio.sleep(0.01)
+
+    # more changes than the engine feed's queue holds, none of them is dropped before the broadcaster reads it
+    events = store.store_events_many((datetime.now(timezone.utc), str(i)) for i in range(2500))
+
+    async def rest():
+        return [await anext(subscription) for _ in range(2499)]
+
+    changes = [await pending] + await asyncio.wait_for(rest(), 5)
+    assert [change.id for change in changes] == [event.id for event in events]
+    await subscription.aclose()
+
+    # a local subscriber that falls behind is disconnected, and told to reload when it resumes from a lost position
+    broadcaster.feed = ChangeFeed(history=10, maxsize=10)
+    subscription = broadcaster.subscribe()
+    pending = asyncio.ensure_future(anext(subscription))
+    await asyncio.sleep(0)
+    store.store_events_many((datetime.now(timezone.utc), str(i)) for i in range(50))
+    last = [await pending] + [change async for change in subscription]
+    assert len(last) == 10
+    subscription = broadcaster.subscribe(last[-1].position)
+    assert (await anext(subscription)).op == "reset"
+    await subscription.aclose()
+    await broadcaster.close()
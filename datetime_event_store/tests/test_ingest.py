@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from datetime_event_store import DatetimeEventStore, IngestBuffer
+
+
+class BatchesStore(DatetimeEventStore):
+    # records the size of every write, which can be held back and made to fail
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+        self.released = asyncio.Event()
+        self.released.set()
+        self.failures = 0
+
+    async def store_events_many(self, events, ids=None):
+        await self.released.wait()
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("down")
+        self.batches.append(len(ids))
+        return super().store_events_many(events, ids)
+
+
+@pytest.fixture
+def day():
+    return datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.mark.asyncio
+async def test_ingest_batches(day):
+    store = BatchesStore()
+    ingest = IngestBuffer(store, batch_size=100, max_delay=0.01)
+    created = await asyncio.gather(*(ingest.store_event(day + timedelta(seconds=i), str(i)) for i in range(250)))
+    assert len({event.id for event in created}) == 250
+    await ingest.flush()
+    assert sum(store.batches) == 250 and max(store.batches) == 100 and len(store.batches) <= 4
+    assert [store.get_event(event.id) for event in created] == created
+
+    # a lone event waits max_delay at most
+    event = await ingest.store_event(day, "alone")
+    await asyncio.sleep(0.05)
+    assert store.get_event(event.id) == event
+    await ingest.close()
+
+
+@pytest.mark.asyncio
+async def test_ingest_backpressure_and_retries(day):
+    store = BatchesStore()
+    ingest = IngestBuffer(store, batch_size=2, max_delay=0, maxsize=2, retries=1, retry_delay=0)
+    store.released.clear()
+    await ingest.store_event(day, "0")
+    await asyncio.sleep(0.01)  # the first event is being written
+    await ingest.store_event(day, "1")
+    await ingest.store_event(day, "2")
+    blocked = asyncio.ensure_future(ingest.store_event(day, "3"))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+    store.failures = 2  # the first batch is dropped, the second one written on its retry
+    store.released.set()
+    await blocked
+    await ingest.close()
+    assert ingest.dropped == 1
+    assert [event.data for event in store.get_events()] == ["1", "2", "3"]
@@ -0,0 +1,65 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from datetime_event_store import DatetimeEventStore
+from datetime_event_store.metrics import InstrumentedDatetimeEventStore, Metrics, SlowRequestProfiler, count_round_trip
+
+
+class RoundTripsStore(DatetimeEventStore):
+    # two backend round trips per lookup, get_events looks every event up too
+
+    def get_event(self, event_id, *args):
+        count_round_trip()
+        count_round_trip()
+        return super().get_event(event_id, *args)
+
+
+@pytest.mark.asyncio
+async def test_instrumented_store():
+    metrics = Metrics()
+    store = InstrumentedDatetimeEventStore(RoundTripsStore(), metrics, "memory")
+    day = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    first = await store.store_event(day, "first")
+    await store.store_events_many([(day + timedelta(hours=1), "second"), (day + timedelta(hours=2), "thé")])
+    assert (await store.get_event(first.id)).data == "first"
+    assert len((await store.get_events(limit=2, desc=True))["events"]) == 2
+    assert len(await store.get_events(raw=True)) == 3
+    with pytest.raises(KeyError):
+        await store.delete_event(42)
+    count_round_trip()  # outside of any operation
+
+    operations = metrics.operations
+    assert operations[("memory", "store_events_many")].rows == 2
+    assert operations[("memory", "store_events_many")].payload_bytes == len("second") + len("thé".encode())
+    assert operations[("memory", "get_event")].round_trips == 2
+    assert operations[("memory", "get_events")].count == 2
+    assert operations[("memory", "get_events")].rows == 5
+    assert operations[("memory", "delete_event")].errors == 1
+    assert store.gen_new_id() == first.id + 3  # delegated
+
+    text = metrics.render()
+    assert 'event_store_operation_seconds_bucket{engine="memory",operation="get_events",le="+Inf"} 2' in text
+    assert 'event_store_operation_seconds_count{engine="memory",operation="store_event"} 1' in text
+    assert 'event_store_round_trips_total{engine="memory",operation="get_event"} 2' in text
+    assert 'event_store_errors_total{engine="memory",operation="delete_event"} 1' in text
+
+
+@pytest.mark.asyncio
+async def test_slow_request_profiler(caplog):
+    app = FastAPI()
+
+    @app.get("/")
+    async def root():
+        return {}
+
+    app.middleware("http")(SlowRequestProfiler(threshold=0, sample_rate=1))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        with caplog.at_level(logging.WARNING, logger="datetime_event_store.metrics"):
+            assert (await client.get("/")).status_code == 200
+    assert "slow request GET /" in caplog.text
+    assert "cumulative" in caplog.text
@@ -0,0 +1,98 @@
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from datetime_event_store import PersistentDatetimeEventStore, genDatetimeEventStoreFromJson
+
+
+@pytest.fixture
+def day():
+    return datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def test_persistence_reload(tmp_path, day):
+    store = PersistentDatetimeEventStore(str(tmp_path))
+    first = store.store_event(day, "first")
+    second = store.store_event(day + timedelta(hours=1), "second")
+    third = store.store_event(day + timedelta(hours=2), "third")
+    store.update_event(first.id, at=day + timedelta(hours=3), data="first updated")
+    store.delete_event(second.id)
+    store.close(checkpoint=False)
+
+    # replayed from the log only
+    store = PersistentDatetimeEventStore(str(tmp_path))
+    assert [(event.id, event.data) for event in store.get_events()] == [
+        (third.id, "third"), (first.id, "first updated")
+    ]
+    assert store.store_event(day, "fourth").id == third.id + 1
+
+    # snapshot plus the records written after it
+    store.checkpoint()
+    assert os.path.getsize(store.wal_path) == 0
+    store.delete_event(third.id)
+    store.close(checkpoint=False)
+    store = PersistentDatetimeEventStore(str(tmp_path))
+    assert [event.data for event in store.get_events()] == ["fourth", "first updated"]
+    assert store.gen_new_id() == third.id + 2
+    store.close()
+
+
+def test_persistence_torn_tail(tmp_path, day):
+    store = PersistentDatetimeEventStore(str(tmp_path))
+    store.store_event(day, "kept")
+    store.store_event(day, "torn")
+    store.close(checkpoint=False)
+    with open(store.wal_path, "r+b") as file:
+        file.truncate(os.path.getsize(store.wal_path) - 2)
+
+    store = PersistentDatetimeEventStore(str(tmp_path))
+    assert [event.data for event in store.get_events()] == ["kept"]
+    store.store_event(day, "after")
+    store.close()
+    store = PersistentDatetimeEventStore(str(tmp_path))
+    assert [event.data for event in store.get_events()] == ["kept", "after"]
+    store.close()
+
+
+def test_persistence_checkpoints(tmp_path, day):
+    store = PersistentDatetimeEventStore(str(tmp_path), checkpoint_every=3)
+    for i in range(4):
+        store.store_event(day + timedelta(minutes=i), str(i))
+    # the third record made a snapshot of every event, the fourth is in the log
+    store.sync()
+    assert os.path.getsize(store.snapshot_path) and os.path.getsize(store.wal_path) > 0
+    store.close()
+    assert os.path.getsize(store.wal_path) == 0
+
+    # none of the writes of other threads is lost by the checkpoints running meanwhile
+    store = PersistentDatetimeEventStore(str(tmp_path), checkpoint_every=50)
+    assert [event.data for event in store.get_events()] == ["0", "1", "2", "3"]
+
+    def write(thread):
+        for i in range(300):
+            event = store.store_event(day + timedelta(hours=thread, seconds=i), f"{thread}-{i}")
+            if i % 3 == 0:
+                store.update_event(event.id, data=f"{thread}-{i} updated")
+
+    threads = [threading.Thread(target=write, args=(thread,)) for thread in range(1, 5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    expected = [(event.id, event.data) for event in store.get_events()]
+    assert len(expected) == 4 + 4 * 300 and len({event_id for event_id, _ in expected}) == len(expected)
+    store.close(checkpoint=False)
+    store = PersistentDatetimeEventStore(str(tmp_path))
+    assert [(event.id, event.data) for event in store.get_events()] == expected
+    store.close()
+
+
+def test_gen_store_from_json(day):
+    store = genDatetimeEventStoreFromJson({
+        "id": 3,
+        "events_by_id": {"1": {"at": "2025-01-01T01:00:00Z", "data": "b"}, "2": {"at": day, "data": "a"}},
+    })
+    assert [(event.id, event.data) for event in store.get_events()] == [(2, "a"), (1, "b")]
+    assert store.gen_new_id() == 3
@@ -0,0 +1,83 @@
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime, timezone
+from importlib.metadata import EntryPoint
+from pathlib import Path
+
+import pytest
+
+from datetime_event_store import registry
+from datetime_event_store.utils import adapt_async
+
+ROOT = Path(__file__).resolve().parents[2]
+
+# imports the app (and builds its engine) in a fresh interpreter, prints the time it took, the resident memory and
+# the drivers it imported
+MEASURE = """
+import asyncio, json, os, sys, time
+started = time.perf_counter()
+import main
+asyncio.run(main.startup())
+{extra}
+print(json.dumps({{
+    "seconds": time.perf_counter() - started,
+    "rss_kb": int(open("/proc/self/statm").read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024,
+    "drivers": sorted({{name.split(".")[0] for name in sys.modules}} & {{"redis", "motor", "pymongo", "bson"}}),
+}}))
+"""
+
+
+def measure(extra=""):
+    env = {**os.environ, "ENGINE": "memory", "PYTHONPATH": str(ROOT)}
+    env.pop("DATA_DIR", None)
+    output = subprocess.run([sys.executable, "-c", MEASURE.format(extra=extra)], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+@pytest.mark.asyncio
+async def test_create_engine(monkeypatch):
+    at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    for name, options in (("memory", {}), ("columnar", {}), ("sharded", {"shards": 2}),
+                          ("redis", {"prefix": "test_registry", "max_connections": 2})):
+        store = registry.create_engine(name, **options)
+        await adapt_async(store.clear)
+        event = await adapt_async(store.store_event, at, "registered")
+        assert await adapt_async(store.get_event, event.id) == event, name
+
+    with pytest.raises(ValueError, match="unknown engine"):
+        registry.create_engine("nope")
+
+    # engines of other packages, from their entry points
+    monkeypatch.setattr(registry, "entry_points", lambda group: [
+        EntryPoint("plugged", "datetime_event_store.sharded:ShardedDatetimeEventStore", group),
+        EntryPoint("memory", "datetime_event_store.columnar:ColumnarDatetimeEventStore", group),
+    ])
+    assert "plugged" in registry.engine_names()
+    assert len(registry.create_engine("plugged", shards=3).shards) == 3
+    assert type(registry.create_engine("memory")).__name__ == "DatetimeEventStore"
+
+
+def test_store_module_names():
+    # the names datetime_event_store.store used to define, and only those
+    from datetime_event_store import redis_store, store
+
+    assert store.DatetimeEventStore.__module__ == "datetime_event_store.memory"
+    assert store.REDIS_UPDATE_SCRIPT is redis_store.REDIS_UPDATE_SCRIPT
+    for name in ("REDIS_VERSION_SCRIPT", "CHANGES", "FREE_THREADED"):
+        with pytest.raises(AttributeError):
+            getattr(store, name)
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="resident memory read from /proc")
+def test_import_cost():
+    # with ENGINE=memory, no driver is imported, neither by the app nor by its engine
+    memory = measure()
+    assert memory["drivers"] == [], memory
+    drivers = measure("import datetime_event_store.redis_store, datetime_event_store.mongodb_store")
+    assert drivers["drivers"] == ["bson", "motor", "pymongo", "redis"], drivers
+    assert memory["rss_kb"] < drivers["rss_kb"], (memory, drivers)
+    print(f"ENGINE=memory: {memory['seconds']:.3f}s {memory['rss_kb'] / 1024:.1f} MiB, "
+          f"with the drivers: {drivers['seconds']:.3f}s {drivers['rss_kb'] / 1024:.1f} MiB")
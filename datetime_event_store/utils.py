@@ -1,15 +1,70 @@
 import asyncio
 import random
+import re
 from datetime import datetime, timedelta, timezone
+from itertools import islice
 
 from tzlocal import get_localzone
 
+MIN_DATETIME = datetime.min.replace(tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+BUCKET_SIZES = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
+MAX_BUCKETS = 10000
+# words of a payload: runs of ASCII letters and digits and of non-ASCII characters, split on the UTF-8 bytes so that
+# the Redis scripts split them the same way ("[%w\128-\255]+" in Lua)
+TOKEN_PATTERN = re.compile(rb"[0-9a-z\x80-\xff]+")
+
 
 def convert_to_utc(dt: datetime, truncate_ms=False) -> datetime:
     dt = (dt if dt.tzinfo else dt.replace(tzinfo=get_localzone())).astimezone(timezone.utc)
     return dt.replace(microsecond=0) if truncate_ms else dt
 
 
+async def clear_async_redis_by_prefix(redis_client, prefix):
+    cursor = 0
+    while True:
+        cursor, keys = await redis_client.scan(cursor, match=f"{prefix}*", count=100)
+        if keys:
+            await redis_client.delete(*keys)
+        if cursor == 0:
+            break
+
+
+def tokenize(text: str) -> set:
+    # ASCII letters are lowercased, other characters are kept as they are
+    return {token.decode() for token in TOKEN_PATTERN.findall(text.encode().lower())}
+
+
+def datetime_to_us(dt: datetime) -> int:
+    # microseconds since 0001-01-01T00:00:00Z, fits in an int64 for every datetime
+    return (convert_to_utc(dt) - MIN_DATETIME) // MICROSECOND
+
+
+def us_to_datetime(us: int) -> datetime:
+    return MIN_DATETIME + us * MICROSECOND
+
+
+def utc_day(dt: datetime) -> int:
+    # days since 0001-01-01, in UTC
+    return (convert_to_utc(dt) - MIN_DATETIME).days
+
+
+def time_buckets(start_date: datetime, end_date: datetime, bucket: str):
+    # (bucket start, lower, upper) of the UTC aligned buckets covering [start_date, end_date], bounds included
+    if bucket not in BUCKET_SIZES:
+        raise ValueError(f"bucket must be one of {', '.join(BUCKET_SIZES)}")
+    size = BUCKET_SIZES[bucket]
+    start, end = convert_to_utc(start_date), convert_to_utc(end_date)
+    at = MIN_DATETIME + (start - MIN_DATETIME) // size * size
+    if (end - at) // size >= MAX_BUCKETS:
+        raise ValueError(f"more than {MAX_BUCKETS} buckets between {start_date} and {end_date}")
+    buckets = []
+    while at <= end:
+        buckets.append((at, max(at, start), min(at + size - MICROSECOND, end)))
+        at += size
+    return buckets
+
+
 def clear_redis_by_prefix(redis_client, prefix):
     cursor = 0
     while True:
@@ -20,13 +75,29 @@ def clear_redis_by_prefix(redis_client, prefix):
             break
 
 
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
 async def gen_test_data(store):
 
     start_ts = int((datetime.now() - timedelta(days=365)).timestamp())
     end_ts = int((datetime.now() + timedelta(days=30)).timestamp())
-    for i in range(10000):
-        dt = datetime.fromtimestamp(random.randint(start_ts, end_ts))
-        await adapt_async(store.store_event, at=dt, data="Event number %d." % i)
+    await adapt_async(store.store_events_many, (
+        (datetime.fromtimestamp(random.randint(start_ts, end_ts)), "Event number %d." % i) for i in range(10000)))
+
+
+async def iter_events_by_cursor(get_events, start_date=None, end_date=None, desc=False, batch_size=1000, raw=False):
+    # walks the range page by page with the keyset cursor, so at most one page is held in memory
+    cursor = None
+    while True:
+        page = await adapt_async(get_events, start_date, end_date, cursor, batch_size, desc, raw=raw)
+        for event in page["events"]:
+            yield event
+        if not (cursor := page["next_cursor"]):
+            break
 
 
 async def adapt_async(func, *args, **kwargs):
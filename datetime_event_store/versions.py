@@ -0,0 +1,43 @@
+import uuid
+from datetime import datetime
+
+from sortedcontainers import SortedList
+
+from .utils import utc_day
+
+
+class VersionCounters:
+
+    # Number of writes per UTC day (each store, update or delete counts once for every day whose events it changes).
+    # The version of a range is the epoch, new on every clear, and the sum of the counters of its days, which only
+    # grows, so it changes as soon as any event of the range does, without reading the events.
+    # The counters are a plain dict, the sorted list of their days only changes on the first write of a day.
+
+    def __init__(self):
+
+        self.clear()
+
+    def clear(self):
+        self.epoch = uuid.uuid4().hex[:16]
+        self.counts = {}
+        self.days = SortedList()
+
+    def bump(self, *ats: datetime):
+
+        counts = self.counts
+        for at in ats:
+            day = utc_day(at)
+            if day in counts:
+                counts[day] += 1
+            else:
+                counts[day] = 1
+                self.days.add(day)
+
+    def total(self, start_date: datetime = None, end_date: datetime = None):
+
+        days = self.days.irange(utc_day(start_date) if start_date else None, utc_day(end_date) if end_date else None)
+        return sum(self.counts[day] for day in days)
+
+    def version(self, start_date: datetime = None, end_date: datetime = None):
+
+        return f"{self.epoch}-{self.total(start_date, end_date)}"
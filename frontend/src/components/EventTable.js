@@ -17,7 +17,7 @@ function formatDate(date) {
 }
 export default function EventTable({onEdit}) {
 
-  const { fetchEvents } = useEventApi();
+  const { fetchEvents, subscribeChanges } = useEventApi();
   const parentRef = useRef();
   const [selectedRange, setSelectedRange] = useState({ from: null, to: null });
   const [order, setOrder] = useState("desc");
@@ -58,6 +58,31 @@ export default function EventTable({onEdit}) {
     fetchData(selectedRange, order, null);
   }, [selectedRange, order]);  // TODO race condition in fetch data
 
+  useEffect(() => subscribeChanges((change) => {
+    if (change.op === "reset") {
+      // changes were missed, the loaded pages are reloaded
+      setEvents([]);
+      setCursor(null);
+      setHasNextPage(true);
+      fetchData(selectedRange, order, null);
+      return;
+    }
+    setEvents(prev => {
+      if (change.op === "delete") {
+        return prev.filter(event => event.id !== change.id);
+      }
+      if (prev.some(event => event.id === change.id)) {
+        return prev.map(event => event.id === change.id ? change.event : event);
+      }
+      // live tail: the newest events first, without an end date
+      if (change.op === "store" && order === "desc" && !selectedRange.to
+          && (!prev.length || change.event.at >= prev[0].at)) {
+        return [change.event, ...prev];
+      }
+      return prev;
+    });
+  }), [selectedRange, order]);
+
   const loadMoreData = () => {if (!isLoading && hasNextPage) {fetchData(cursor, order, cursor);}};
   const columns = [
     {
@@ -24,5 +24,12 @@ export const useEventApi = () => {
     return response.data;
   };
 
-  return { fetchEvents, createEvent, deleteEvent, updateEvent };
+  const subscribeChanges = (onChange) => {
+    // changes pushed by the server (Server-Sent Events), EventSource reconnects and resumes by itself
+    const source = new EventSource(`${EVENTS_API_URL}changes`);
+    source.onmessage = (message) => onChange(JSON.parse(message.data));
+    return () => source.close();
+  };
+
+  return { fetchEvents, createEvent, deleteEvent, updateEvent, subscribeChanges };
 };
\ No newline at end of file
@@ -1,21 +1,29 @@
+import asyncio
+import hashlib
 import os
+from datetime import datetime, timedelta, timezone
 from typing import List, Optional, Union
 
-import redis
+import orjson
 from dateutil.parser import isoparse
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 from datetime_event_store import (
+    Broadcaster,
+    CachedDatetimeEventStore,
     CursorPaginatedEvents,
-    DatetimeEventStore,
     Event,
-    MongoDBDatetimeEventStore,
-    RedisDatetimeEventStore,
+    EventStats,
+    IngestBuffer,
     adapt_async,
+    create_engine,
 )
-from datetime_event_store.utils import gen_test_data
+from datetime_event_store.cursor import date_cursor, unpack_cursor
+from datetime_event_store.metrics import InstrumentedDatetimeEventStore, Metrics, SlowRequestProfiler
+from datetime_event_store.utils import convert_to_utc, gen_test_data, us_to_datetime
 
 app = FastAPI()
 
@@ -28,6 +36,19 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(KeyError)
+async def event_not_found(request: Request, error: KeyError):
+    # every engine raises KeyError for an id it doesn't hold
+    return ORJSONResponse({"detail": "event not found"}, status_code=404)
+
+
+class EventsResponse(ORJSONResponse):
+    # serializes the raw EventRow pages straight to bytes, without a second validation against response_model
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z)
+
+
 class EventInput(BaseModel):
 
     at: str  #
@@ -39,51 +60,280 @@ class EventInput(BaseModel):
         return isoparse(self.at)
         
         
+# any engine of the registry (datetime_event_store.registry), only its module and driver are imported
 ENGINE = os.getenv("ENGINE", "mongo")
-if ENGINE == "mongo":
-    event_store = MongoDBDatetimeEventStore("mongodb://localhost:27017/", "test", "events")
-elif ENGINE == "redis":
-    event_store = RedisDatetimeEventStore(redis.Redis(host='localhost', port=6379, db=0, decode_responses=True))
-else:
-    event_store = DatetimeEventStore()
+if ENGINE == "memory" and os.getenv("DATA_DIR"):
+    ENGINE = "persistent"
+PARTITIONED = os.getenv("PARTITIONED", "false") == "true"
+SEARCH = os.getenv("SEARCH", "false") == "true"
+METRICS = os.getenv("METRICS", "false") == "true"
+metrics = Metrics()
+# built by startup()
+event_store = None
+# a single engine subscription, shared by every /events/changes client
+changes = None
+# write-behind: POST /events/ answers once the event is queued, the events are written in batches
+ingest = None
+# the enforce_retention task, kept so that shutdown() can cancel it
+retention_task = None
+if os.getenv("PROFILE_SLOW_MS"):
+    # profiles PROFILE_SAMPLE_RATE of the requests and logs the profile of those slower than PROFILE_SLOW_MS
+    app.middleware("http")(SlowRequestProfiler(float(os.getenv("PROFILE_SLOW_MS")) / 1000,
+                                               float(os.getenv("PROFILE_SAMPLE_RATE", "0.01"))))
+
+
+def engine_options(engine: str):
+    # constructor options of the built-in engines, from the environment, plus the ENGINE_OPTIONS JSON object
+    options = {}
+    if engine == "mongo":
+        options = {"mongo_url": os.getenv("MONGO_URL", "mongodb://localhost:27017/"), "db_name": "test",
+                   "collection_name": "events", "partitioned": PARTITIONED, "count_round_trips": METRICS,
+                   "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+                   "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))}
+    elif engine in ("redis", "redis_sync"):
+        # blocks for a free connection (up to REDIS_POOL_TIMEOUT seconds) instead of failing when the pool is exhausted
+        options = {"url": os.getenv("REDIS_URL", "redis://localhost:6379/0"), "partitioned": PARTITIONED,
+                   "max_connections": int(os.getenv("REDIS_MAX_CONNECTIONS", "50")),
+                   "pool_timeout": float(os.getenv("REDIS_POOL_TIMEOUT", "5")), "count_round_trips": METRICS,
+                   "embedded": os.getenv("REDIS_EMBEDDED", "false") == "true"}
+    elif engine == "sharded":
+        options = {"shards": int(os.getenv("SHARDS", "8"))}
+    elif engine == "persistent":
+        options = {"path": os.getenv("DATA_DIR"), "checkpoint_every": int(os.getenv("CHECKPOINT_EVERY", "100000"))}
+    if engine in ("memory", "persistent", "sharded", "redis", "redis_sync", "mongo"):
+        # the token index of the query parameter, columnar always scans its payloads
+        options["search"] = SEARCH
+    return {**options, **orjson.loads(os.getenv("ENGINE_OPTIONS", "{}"))}
 
 
 @app.on_event("startup")
 async def startup():
+    # the engine is built by each worker once it runs, not when the app is imported
+    global event_store, changes, ingest, retention_task
+    event_store = create_engine(ENGINE, **engine_options(ENGINE))
+    if METRICS:
+        # under the cache, so that the metrics are the engine's
+        event_store = InstrumentedDatetimeEventStore(event_store, metrics, ENGINE)
+    if os.getenv("CACHE", "false") == "true":
+        event_store = CachedDatetimeEventStore(event_store, ttl=float(os.getenv("CACHE_TTL", "60")))
+    changes = Broadcaster(event_store)
+    if os.getenv("INGEST_BUFFER", "false") == "true":
+        ingest = IngestBuffer(event_store, batch_size=int(os.getenv("INGEST_BATCH_SIZE", "500")),
+                              max_delay=float(os.getenv("INGEST_MAX_DELAY_MS", "5")) / 1000,
+                              maxsize=int(os.getenv("INGEST_MAX_QUEUE", "10000")))
     if os.getenv("CLEAR_STORE", "false") == "true":
         await adapt_async(event_store.clear)
     if hasattr(event_store, "setup"):
         await adapt_async(event_store.setup)
     if os.getenv("GEN_TEST_DATA", "false") == "true":
         await gen_test_data(event_store)
+    if os.getenv("RETENTION_DAYS") and PARTITIONED:
+        retention_task = asyncio.create_task(enforce_retention(timedelta(days=float(os.getenv("RETENTION_DAYS")))))
+
+
+async def enforce_retention(retention: timedelta):
+    # drops the partitions older than `retention`, once an hour
+    while True:
+        await adapt_async(event_store.drop_partitions, datetime.now(timezone.utc) - retention)
+        await asyncio.sleep(3600)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if retention_task is not None:
+        retention_task.cancel()
+        try:
+            await retention_task
+        except asyncio.CancelledError:
+            pass
+    await changes.close()
+    if ingest is not None:
+        await ingest.close()
+    if hasattr(event_store, "close"):
+        await adapt_async(event_store.close)
+
 
 @app.post("/events/", response_model=Event)
 async def create_event(event_input: EventInput):
+    if ingest is not None:
+        return await ingest.store_event(event_input.at_datetime, event_input.data)
     return await adapt_async(event_store.store_event, at=event_input.at_datetime, data=event_input.data)
 
 
+@app.post("/events/bulk", response_model=List[Event])
+async def create_events(events_input: List[EventInput]):
+    return await adapt_async(event_store.store_events_many,
+                             [(event_input.at_datetime, event_input.data) for event_input in events_input])
+
+
+def parse_date(value: Optional[str], name: str):
+    # the text of a parse error isn't worth showing, the parameter it comes from is
+    try:
+        return isoparse(value) if value else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"invalid date for {name}")
+
+
+@app.get("/events/export")
+async def export_events(
+    start_date: Optional[str] = Query(None, alias="start"),
+    end_date: Optional[str] = Query(None, alias="end"),
+    order: Optional[str] = Query("asc", description="at order (asc, desc)"),
+    batch_size: int = Query(1000, alias="batchSize", description="events read per backend query")
+):
+
+    start_dt = parse_date(start_date, "start")
+    end_dt = parse_date(end_date, "end")
+
+    async def ndjson():
+        chunk = bytearray()
+        async for row in event_store.iter_events(start_dt, end_dt, order == "desc", batch_size, raw=True):
+            chunk += orjson.dumps(row, option=orjson.OPT_UTC_Z | orjson.OPT_APPEND_NEWLINE)
+            if len(chunk) >= 64 * 1024:
+                yield bytes(chunk)
+                chunk.clear()
+        if chunk:
+            yield bytes(chunk)
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text format, empty unless METRICS is set
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/events/changes")
+async def stream_changes(last_event_id: Optional[str] = Header(None)):
+    # Server-Sent Events, EventSource sends back the id of the last change it got as Last-Event-ID when it reconnects
+    async def messages():
+        async for change in changes.subscribe(last_event_id, heartbeat=15):
+            if change is None:
+                yield ": keepalive\n\n"
+            else:
+                data = orjson.dumps(change.model_dump(), option=orjson.OPT_UTC_Z).decode()
+                yield f"id: {change.position}\ndata: {data}\n\n"
+
+    return StreamingResponse(messages(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/events/stats", response_model=EventStats)
+async def get_event_stats(
+    start_date: Optional[str] = Query(None, alias="start"),
+    end_date: Optional[str] = Query(None, alias="end"),
+    bucket: Optional[str] = Query(None, description="histogram bucket (minute, hour, day), needs start and end")
+):
+
+    start_dt = parse_date(start_date, "start")
+    end_dt = parse_date(end_date, "end")
+    stats = {"count": await adapt_async(event_store.count_events, start_dt, end_dt)}
+    if bucket:
+        if not (start_dt and end_dt):
+            raise HTTPException(status_code=400, detail="a histogram needs both start and end")
+        try:
+            stats["buckets"] = await adapt_async(event_store.histogram, start_dt, end_dt, bucket)
+        except ValueError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+    return stats
+
+
+def page_range(start_dt: Optional[datetime], end_dt: Optional[datetime], cursor: Optional[str], desc: bool):
+    # the events a page can be read from: its cursor moves the bound it starts from
+    try:
+        at = us_to_datetime(unpack_cursor(cursor)[0]) if cursor else None
+    except ValueError:
+        return start_dt, end_dt  # answered with a 400 by get_events
+    if at is not None and desc:
+        end_dt = at if end_dt is None else min(at, convert_to_utc(end_dt))
+    elif at is not None:
+        start_dt = at if start_dt is None else max(at, convert_to_utc(start_dt))
+    return start_dt, end_dt
+
+
+async def range_etag(request: Request, start_dt: Optional[datetime] = None, end_dt: Optional[datetime] = None):
+    """
+    ETag of the response to `request`, from the version of the events it reads (range_version of the engine):
+    None if the engine has no versions. Read before the events, a write in between only costs a later 200.
+    """
+    range_version = getattr(event_store, "range_version", None)
+    if range_version is None:
+        return None
+    version = await adapt_async(range_version, start_dt, end_dt)
+    return '"' + hashlib.sha1(f"{request.url.path}?{request.url.query}:{version}".encode()).hexdigest() + '"'
+
+
+def not_modified(etag: Optional[str], if_none_match: Optional[str]):
+    if etag is None or not if_none_match:
+        return None
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if "*" in tags or etag in tags:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+
 @app.put("/events/{event_id}", response_model=Event)  # make patch available, params not required
 async def update_event(event_id: str, event_input: EventInput):
     return await adapt_async(event_store.update_event, event_id, at=event_input.at_datetime, data=event_input.data)
 
 
 @app.get("/events/{event_id}", response_model=Event)
-async def get_event(event_id: str):
+async def get_event(event_id: str, request: Request, response: Response,
+                    if_none_match: Optional[str] = Header(None)):
+    # the day of the event isn't known before reading it, its version is the one of the whole store
+    etag = await range_etag(request)
+    if (cached := not_modified(etag, if_none_match)) is not None:
+        return cached
+    if etag is not None:
+        response.headers.update({"ETag": etag, "Cache-Control": "no-cache"})
     return await adapt_async(event_store.get_event, event_id)
 
 
 @app.get("/events/", response_model=Union[List[Event], CursorPaginatedEvents])
 async def get_events(
+    request: Request,
     start_date: Optional[str] = Query(None, alias="start"),
     end_date: Optional[str] = Query(None, alias="end"),
     cursor: Optional[str] = Query(None, description="page cursor"),
-    page_size: Optional[int] = Query(None, alias="pageSize", description="page size"),
-    order: Optional[str] = Query("asc", description="at order (asc, desc)")
+    page_size: Optional[int] = Query(None, ge=1, alias="pageSize", description="page size"),
+    order: Optional[str] = Query("asc", description="at order (asc, desc)"),
+    at: Optional[str] = Query(None, description="without cursor, page starting at this date"),
+    offset: Optional[int] = Query(None, ge=0, description="without cursor nor at, page starting this many events in"),
+    query: Optional[str] = Query(None, description="only the events whose data holds every word of it"),
+    if_none_match: Optional[str] = Header(None),
 ):
 
-    start_dt = isoparse(start_date) if start_date else None
-    end_dt = isoparse(end_date) if end_date else None
-    return await adapt_async(event_store.get_events, start_dt, end_dt, cursor, page_size, order == "desc")
+    start_dt = parse_date(start_date, "start")
+    end_dt = parse_date(end_date, "end")
+    desc = order == "desc"
+    if not cursor and at:
+        # kept within the range, a date cursor replaces the bound it moves
+        at_dt = convert_to_utc(parse_date(at, "at"))
+        if desc and end_dt:
+            at_dt = min(at_dt, convert_to_utc(end_dt))
+        elif not desc and start_dt:
+            at_dt = max(at_dt, convert_to_utc(start_dt))
+        cursor = date_cursor(at_dt)
+    elif not cursor and offset:
+        if query:
+            raise HTTPException(status_code=400, detail="offset can't be combined with a query, use the cursor")
+    # read before seeking an offset, whose page depends on the events before it: its version is the whole range's
+    etag = await range_etag(request, *page_range(start_dt, end_dt, cursor, desc))
+    if (cached := not_modified(etag, if_none_match)) is not None:
+        return cached
+    try:
+        if not cursor and offset:
+            cursor = await adapt_async(event_store.seek_cursor, start_dt, end_dt, offset, desc)
+        page = await adapt_async(event_store.get_events, start_dt, end_dt, cursor=cursor, limit=page_size, desc=desc,
+                                 raw=True, query=query)
+    except ValueError:
+        # the messages of the engines are for their callers, not for the clients of the API
+        if cursor:
+            raise HTTPException(status_code=400, detail="invalid cursor")
+        if query:
+            raise HTTPException(status_code=400, detail="queries aren't supported by this event store")
+        raise
+    return EventsResponse(page, headers={"ETag": etag, "Cache-Control": "no-cache"} if etag is not None else None)
 
 
 @app.delete("/events/{event_id}")